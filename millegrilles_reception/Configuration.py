@@ -13,6 +13,62 @@ CONST_INSTANCE_PARAMS = [
     ConstantesMessages.ENV_CA_PEM,
 ]
 
+CONST_RECEPTION_PARAMS = [
+    Constantes.ENV_MESSAGE_TAILLE_MAX,
+    Constantes.ENV_MODE_ACK,
+    Constantes.ENV_DISPATCH_CONCURRENCE,
+    Constantes.ENV_DISPATCH_TENTATIVES_MAX,
+    Constantes.ENV_OUTBOX_ABSORBER,
+    Constantes.ENV_ADMISSION_JSON_CONCURRENCE,
+    Constantes.ENV_ADMISSION_JSON_FILE,
+    Constantes.ENV_ADMISSION_MULTIPART_CONCURRENCE,
+    Constantes.ENV_ADMISSION_MULTIPART_FILE,
+    Constantes.ENV_ADMISSION_BATCH_CONCURRENCE,
+    Constantes.ENV_ADMISSION_BATCH_FILE,
+    Constantes.ENV_ADMISSION_TIMEOUT_ATTENTE,
+    Constantes.ENV_ADMISSION_RETRY_AFTER,
+    Constantes.ENV_UPLOAD_WORKERS,
+    Constantes.ENV_UPLOAD_TAILLE_CHUNK,
+    Constantes.ENV_UPLOAD_CHUNKS_ATTENTE,
+    Constantes.ENV_MULTIPART_TAILLE_MAX,
+    Constantes.ENV_FICHIER_TAILLE_MAX,
+    Constantes.ENV_FICHIERS_MAX,
+    Constantes.ENV_MESSAGE_AVANT_FICHIERS,
+    Constantes.ENV_STAGING_EXPIRATION,
+    Constantes.ENV_STAGING_NETTOYAGE_MAX,
+    Constantes.ENV_LIMITE_REQUETES_TAUX,
+    Constantes.ENV_LIMITE_REQUETES_RAFALE,
+    Constantes.ENV_LIMITE_BYTES_TAUX,
+    Constantes.ENV_LIMITE_BYTES_RAFALE,
+    Constantes.ENV_LIMITE_CLES_MAX,
+    Constantes.ENV_LIMITE_PROXIES_CONFIANCE,
+    Constantes.ENV_PRODUCER,
+    Constantes.ENV_LOOPBACK_LATENCE,
+    Constantes.ENV_LOOPBACK_LATENCE_VARIATION,
+    Constantes.ENV_LOOPBACK_TAUX_ECHEC,
+    Constantes.ENV_LOOPBACK_TAUX_REJET,
+    Constantes.ENV_LOOPBACK_CERTIFICATS,
+    Constantes.ENV_TRACES,
+    Constantes.ENV_TRACES_ECHANTILLONNAGE,
+    Constantes.ENV_TRACES_CONSERVEES,
+    Constantes.ENV_TRACES_FENETRE,
+    Constantes.ENV_TRACES_OTEL,
+    Constantes.ENV_WORKERS,
+    Constantes.ENV_DEDUP,
+    Constantes.ENV_DEDUP_TAILLE,
+    Constantes.ENV_DEDUP_TTL,
+    Constantes.ENV_BATCH_MESSAGES_MAX,
+    Constantes.ENV_BATCH_TAILLE_MAX,
+    Constantes.ENV_BATCH_CONCURRENCE,
+    Constantes.ENV_CRYPTO_WORKERS,
+    Constantes.ENV_CRYPTO_FILE,
+    Constantes.ENV_CRYPTO_LOT,
+    Constantes.ENV_BOUCLE_INTERVALLE,
+    Constantes.ENV_BOUCLE_SEUIL_BLOCAGE,
+    Constantes.ENV_BOUCLE_BLOCAGES_CONSERVES,
+    Constantes.ENV_ADMIN_JETON,
+]
+
 CONST_WEB_PARAMS = [
     Constantes.ENV_WEB_PORT,
     ConstantesMessages.ENV_CA_PEM,
@@ -30,20 +86,111 @@ class ConfigurationReception:
         self.key_pem_path = '/run/secrets/key.pem'
         self.ca_pem_path = '/run/secrets/pki.millegrille.cert'
 
+        # Taille maximale d'un message json (bytes)
+        self.message_taille_max = 1024 * 1024
+
+        # Mode de confirmation des messages. async : reponse 202 et emission posterV1 en arriere-plan
+        self.mode_ack = 'sync'
+        self.dispatch_concurrence = 20
+        # Nombre de tentatives d'emission d'un message de l'outbox avant de le marquer en echec
+        self.dispatch_tentatives_max = 30
+        # Conserver les messages dans l'outbox (202) lorsque MQ n'est pas disponible en mode sync. Desactive par
+        # defaut : apres un timeout de emettre_attendre, le domaine peut avoir deja traite le message et la reemission
+        # depuis l'outbox le livre une deuxieme fois (au moins une fois).
+        self.outbox_absorber = False
+
+        # Controle d'admission (voies json, multipart et batch)
+        self.admission_json_concurrence = 10
+        self.admission_json_file = 100
+        self.admission_multipart_concurrence = 3
+        self.admission_multipart_file = 10
+        self.admission_batch_concurrence = 2
+        self.admission_batch_file = 10
+        self.admission_timeout_attente = 15.0
+        self.admission_retry_after = 5
+
+        # Reception de fichiers (chiffrage dans un pool de threads)
+        self.upload_workers = 4
+        self.upload_taille_chunk = 256 * 1024
+        self.upload_chunks_attente = 8
+
+        # Limites des posts multipart (bytes). Le post est refuse des que la limite est depassee.
+        self.multipart_taille_max = 500 * 1024 * 1024
+        self.fichier_taille_max = 250 * 1024 * 1024
+        self.fichiers_max = 50
+        # Exiger que la part message soit recue avant les fichiers
+        self.message_avant_fichiers = False
+
+        # Nettoyage des batches expirees de dir_staging/upload (secondes, nombre max par passe)
+        self.staging_expiration = 6 * 3600
+        self.staging_nettoyage_max = 200
+
+        # Limites de debit par client (taux par seconde, 0 pour desactiver). Desactivees par defaut.
+        self.limite_requetes_taux = 0.0
+        self.limite_requetes_rafale = 20
+        self.limite_bytes_taux = 0.0
+        self.limite_bytes_rafale = 500 * 1024 * 1024
+        self.limite_cles_max = 100_000
+        # Proxies (e.g. nginx) dont le hop ajoute a X-Forwarded-For identifie le client. Sans proxy de confiance,
+        # l'adresse de la connexion est utilisee.
+        self.limite_proxies_confiance: list[str] = list()
+
+        # Producer loopback : latence (secondes), taux d'echec (timeout) et de rejet (ok: False) simules
+        self.producer = Constantes.PRODUCER_MQ
+        self.loopback_latence = 0.002
+        self.loopback_latence_variation = 0.0
+        self.loopback_taux_echec = 0.0
+        self.loopback_taux_rejet = 0.0
+        self.loopback_certificats: list[str] = list()
+
+        # Tracage (desactive par defaut) : proportion des posts traces, nombre de traces lentes conservees par
+        # fenetre de traces_fenetre secondes
+        self.traces_actives = False
+        self.traces_echantillonnage = 1.0
+        self.traces_conservees = 20
+        self.traces_fenetre = 300
+        self.traces_otel = False
+
+        # Deduplication des fichiers recus par hachage du contenu dechiffre (desactive par defaut)
+        self.dedup_actif = False
+        self.dedup_taille = 10_000
+        self.dedup_ttl = 24 * 3600
+
+        # Nombre de processus workers (pre-fork avec SO_REUSEPORT si plus de 1)
+        self.workers = 1
+
+        # Soumission en lot : nombre de messages et taille maximale du body, messages traites en parallele
+        self.batch_messages_max = 1000
+        self.batch_taille_max = 16 * 1024 * 1024
+        self.batch_concurrence = 32
+
+        # Chiffrage (echange de cle X25519 des fichiers) dans un pool de threads
+        self.crypto_workers = 2
+        self.crypto_file = 256
+        self.crypto_lot = 16
+
+        # Mesure du retard de la boucle asyncio et capture des callbacks bloquants
+        self.boucle_intervalle = 0.1
+        self.boucle_seuil_blocage = 0.25
+        self.boucle_blocages_conserves = 20
+
+        # Jeton des routes d'administration (diagnostics), routes desactivees si None
+        self.admin_jeton: Optional[str] = None
+
     def get_env(self) -> dict:
         """
         Extrait l'information pertinente pour pika de os.environ
         :return: Configuration dict
         """
         config = dict()
-        for opt_param in CONST_INSTANCE_PARAMS:
+        for opt_param in CONST_INSTANCE_PARAMS + CONST_RECEPTION_PARAMS:
             value = os.environ.get(opt_param)
             if value is not None:
                 config[opt_param] = value
 
         return config
 
-    def parse_config(self, args: argparse.Namespace, configuration: Optional[dict] = None):
+    def parse_config(self, args: Optional[argparse.Namespace] = None, configuration: Optional[dict] = None):
         """
         Conserver l'information de configuration
         :param args:
@@ -64,6 +211,102 @@ class ConfigurationReception:
         self.key_pem_path = dict_params.get(Constantes.PARAM_KEY_PATH) or self.key_pem_path
         self.ca_pem_path = dict_params.get(ConstantesMessages.ENV_CA_PEM) or self.ca_pem_path
 
+        self.message_taille_max = int(dict_params.get(Constantes.ENV_MESSAGE_TAILLE_MAX) or self.message_taille_max)
+        self.mode_ack = dict_params.get(Constantes.ENV_MODE_ACK) or self.mode_ack
+        self.dispatch_concurrence = int(dict_params.get(Constantes.ENV_DISPATCH_CONCURRENCE) or self.dispatch_concurrence)
+        self.dispatch_tentatives_max = int(
+            dict_params.get(Constantes.ENV_DISPATCH_TENTATIVES_MAX) or self.dispatch_tentatives_max)
+        outbox_absorber = dict_params.get(Constantes.ENV_OUTBOX_ABSORBER)
+        if outbox_absorber is not None:
+            self.outbox_absorber = outbox_absorber.lower() in ['true', '1']
+
+        self.admission_json_concurrence = int(
+            dict_params.get(Constantes.ENV_ADMISSION_JSON_CONCURRENCE) or self.admission_json_concurrence)
+        self.admission_json_file = int(dict_params.get(Constantes.ENV_ADMISSION_JSON_FILE) or self.admission_json_file)
+        self.admission_multipart_concurrence = int(
+            dict_params.get(Constantes.ENV_ADMISSION_MULTIPART_CONCURRENCE) or self.admission_multipart_concurrence)
+        self.admission_multipart_file = int(
+            dict_params.get(Constantes.ENV_ADMISSION_MULTIPART_FILE) or self.admission_multipart_file)
+        self.admission_batch_concurrence = int(
+            dict_params.get(Constantes.ENV_ADMISSION_BATCH_CONCURRENCE) or self.admission_batch_concurrence)
+        self.admission_batch_file = int(dict_params.get(Constantes.ENV_ADMISSION_BATCH_FILE) or self.admission_batch_file)
+        self.admission_timeout_attente = float(
+            dict_params.get(Constantes.ENV_ADMISSION_TIMEOUT_ATTENTE) or self.admission_timeout_attente)
+        self.admission_retry_after = int(
+            dict_params.get(Constantes.ENV_ADMISSION_RETRY_AFTER) or self.admission_retry_after)
+
+        self.upload_workers = int(dict_params.get(Constantes.ENV_UPLOAD_WORKERS) or self.upload_workers)
+        self.upload_taille_chunk = int(dict_params.get(Constantes.ENV_UPLOAD_TAILLE_CHUNK) or self.upload_taille_chunk)
+        self.upload_chunks_attente = int(dict_params.get(Constantes.ENV_UPLOAD_CHUNKS_ATTENTE) or self.upload_chunks_attente)
+
+        self.multipart_taille_max = int(dict_params.get(Constantes.ENV_MULTIPART_TAILLE_MAX) or self.multipart_taille_max)
+        self.fichier_taille_max = int(dict_params.get(Constantes.ENV_FICHIER_TAILLE_MAX) or self.fichier_taille_max)
+        self.fichiers_max = int(dict_params.get(Constantes.ENV_FICHIERS_MAX) or self.fichiers_max)
+        message_avant_fichiers = dict_params.get(Constantes.ENV_MESSAGE_AVANT_FICHIERS)
+        if message_avant_fichiers is not None:
+            self.message_avant_fichiers = message_avant_fichiers.lower() in ['true', '1']
+
+        self.staging_expiration = int(dict_params.get(Constantes.ENV_STAGING_EXPIRATION) or self.staging_expiration)
+        self.staging_nettoyage_max = int(dict_params.get(Constantes.ENV_STAGING_NETTOYAGE_MAX) or self.staging_nettoyage_max)
+
+        self.limite_requetes_taux = float(dict_params.get(Constantes.ENV_LIMITE_REQUETES_TAUX) or self.limite_requetes_taux)
+        self.limite_requetes_rafale = float(dict_params.get(Constantes.ENV_LIMITE_REQUETES_RAFALE) or self.limite_requetes_rafale)
+        self.limite_bytes_taux = float(dict_params.get(Constantes.ENV_LIMITE_BYTES_TAUX) or self.limite_bytes_taux)
+        self.limite_bytes_rafale = float(dict_params.get(Constantes.ENV_LIMITE_BYTES_RAFALE) or self.limite_bytes_rafale)
+        self.limite_cles_max = int(dict_params.get(Constantes.ENV_LIMITE_CLES_MAX) or self.limite_cles_max)
+        limite_proxies_confiance = dict_params.get(Constantes.ENV_LIMITE_PROXIES_CONFIANCE)
+        if limite_proxies_confiance:
+            self.limite_proxies_confiance = [a.strip() for a in limite_proxies_confiance.split(',') if a.strip()]
+
+        self.producer = dict_params.get(Constantes.ENV_PRODUCER) or self.producer
+        self.loopback_latence = float(dict_params.get(Constantes.ENV_LOOPBACK_LATENCE) or self.loopback_latence)
+        self.loopback_latence_variation = float(
+            dict_params.get(Constantes.ENV_LOOPBACK_LATENCE_VARIATION) or self.loopback_latence_variation)
+        self.loopback_taux_echec = float(dict_params.get(Constantes.ENV_LOOPBACK_TAUX_ECHEC) or self.loopback_taux_echec)
+        self.loopback_taux_rejet = float(dict_params.get(Constantes.ENV_LOOPBACK_TAUX_REJET) or self.loopback_taux_rejet)
+        loopback_certificats = dict_params.get(Constantes.ENV_LOOPBACK_CERTIFICATS)
+        if loopback_certificats:
+            self.loopback_certificats = [p.strip() for p in loopback_certificats.split(',') if p.strip()]
+
+        traces_actives = dict_params.get(Constantes.ENV_TRACES)
+        if traces_actives is not None:
+            self.traces_actives = traces_actives.lower() in ['true', '1']
+        self.traces_echantillonnage = float(
+            dict_params.get(Constantes.ENV_TRACES_ECHANTILLONNAGE) or self.traces_echantillonnage)
+        self.traces_conservees = int(dict_params.get(Constantes.ENV_TRACES_CONSERVEES) or self.traces_conservees)
+        self.traces_fenetre = int(dict_params.get(Constantes.ENV_TRACES_FENETRE) or self.traces_fenetre)
+        traces_otel = dict_params.get(Constantes.ENV_TRACES_OTEL)
+        if traces_otel is not None:
+            self.traces_otel = traces_otel.lower() in ['true', '1']
+
+        dedup_actif = dict_params.get(Constantes.ENV_DEDUP)
+        if dedup_actif is not None:
+            self.dedup_actif = dedup_actif.lower() in ['true', '1']
+        self.dedup_taille = int(dict_params.get(Constantes.ENV_DEDUP_TAILLE) or self.dedup_taille)
+        self.dedup_ttl = int(dict_params.get(Constantes.ENV_DEDUP_TTL) or self.dedup_ttl)
+
+        workers = dict_params.get(Constantes.ENV_WORKERS)
+        if workers is not None:
+            self.workers = int(workers) or os.cpu_count() or 1
+
+        self.batch_messages_max = int(dict_params.get(Constantes.ENV_BATCH_MESSAGES_MAX) or self.batch_messages_max)
+        self.batch_taille_max = int(dict_params.get(Constantes.ENV_BATCH_TAILLE_MAX) or self.batch_taille_max)
+        self.batch_concurrence = int(dict_params.get(Constantes.ENV_BATCH_CONCURRENCE) or self.batch_concurrence)
+
+        crypto_workers = dict_params.get(Constantes.ENV_CRYPTO_WORKERS)
+        if crypto_workers is not None:
+            self.crypto_workers = int(crypto_workers)
+        self.crypto_file = int(dict_params.get(Constantes.ENV_CRYPTO_FILE) or self.crypto_file)
+        self.crypto_lot = int(dict_params.get(Constantes.ENV_CRYPTO_LOT) or self.crypto_lot)
+        self.boucle_intervalle = float(dict_params.get(Constantes.ENV_BOUCLE_INTERVALLE) or self.boucle_intervalle)
+        boucle_seuil_blocage = dict_params.get(Constantes.ENV_BOUCLE_SEUIL_BLOCAGE)
+        if boucle_seuil_blocage is not None:
+            self.boucle_seuil_blocage = float(boucle_seuil_blocage)
+        self.boucle_blocages_conserves = int(
+            dict_params.get(Constantes.ENV_BOUCLE_BLOCAGES_CONSERVES) or self.boucle_blocages_conserves)
+
+        self.admin_jeton = dict_params.get(Constantes.ENV_ADMIN_JETON) or self.admin_jeton
+
     def desactiver_mq(self):
         self.mq_url = None
 
@@ -7,5 +7,91 @@ PARAM_CA_PATH = 'CA_PATH'
 
 ENV_WEB_PORT = 'WEB_PORT'
 
+# Parametres de reception des messages
+ENV_MESSAGE_TAILLE_MAX = 'RECEPTION_MESSAGE_TAILLE_MAX'
+ENV_MODE_ACK = 'RECEPTION_MODE_ACK'  # sync (defaut) ou async
+ENV_DISPATCH_CONCURRENCE = 'RECEPTION_DISPATCH_CONCURRENCE'
+ENV_DISPATCH_TENTATIVES_MAX = 'RECEPTION_DISPATCH_TENTATIVES_MAX'
+ENV_OUTBOX_ABSORBER = 'RECEPTION_OUTBOX_ABSORBER'  # false (defaut) ou true, livraison au moins une fois
+
+# Controle d'admission
+ENV_ADMISSION_JSON_CONCURRENCE = 'RECEPTION_ADMISSION_JSON_CONCURRENCE'
+ENV_ADMISSION_JSON_FILE = 'RECEPTION_ADMISSION_JSON_FILE'
+ENV_ADMISSION_MULTIPART_CONCURRENCE = 'RECEPTION_ADMISSION_MULTIPART_CONCURRENCE'
+ENV_ADMISSION_MULTIPART_FILE = 'RECEPTION_ADMISSION_MULTIPART_FILE'
+ENV_ADMISSION_BATCH_CONCURRENCE = 'RECEPTION_ADMISSION_BATCH_CONCURRENCE'
+ENV_ADMISSION_BATCH_FILE = 'RECEPTION_ADMISSION_BATCH_FILE'
+ENV_ADMISSION_TIMEOUT_ATTENTE = 'RECEPTION_ADMISSION_TIMEOUT_ATTENTE'
+ENV_ADMISSION_RETRY_AFTER = 'RECEPTION_ADMISSION_RETRY_AFTER'
+
+# Parametres de reception des fichiers
+ENV_UPLOAD_WORKERS = 'RECEPTION_UPLOAD_WORKERS'
+ENV_UPLOAD_TAILLE_CHUNK = 'RECEPTION_UPLOAD_TAILLE_CHUNK'
+ENV_UPLOAD_CHUNKS_ATTENTE = 'RECEPTION_UPLOAD_CHUNKS_ATTENTE'
+
+# Limites des posts multipart
+ENV_MULTIPART_TAILLE_MAX = 'RECEPTION_MULTIPART_TAILLE_MAX'
+ENV_FICHIER_TAILLE_MAX = 'RECEPTION_FICHIER_TAILLE_MAX'
+ENV_FICHIERS_MAX = 'RECEPTION_FICHIERS_MAX'
+ENV_MESSAGE_AVANT_FICHIERS = 'RECEPTION_MESSAGE_AVANT_FICHIERS'
+
 APP_NAME = 'reception'
 WEB_APP_PATH = '/reception'
+
+# Nettoyage du repertoire de staging
+ENV_STAGING_EXPIRATION = 'RECEPTION_STAGING_EXPIRATION'
+ENV_STAGING_NETTOYAGE_MAX = 'RECEPTION_STAGING_NETTOYAGE_MAX'
+
+# Limites de debit par client
+ENV_LIMITE_REQUETES_TAUX = 'RECEPTION_LIMITE_REQUETES_TAUX'
+ENV_LIMITE_REQUETES_RAFALE = 'RECEPTION_LIMITE_REQUETES_RAFALE'
+ENV_LIMITE_BYTES_TAUX = 'RECEPTION_LIMITE_BYTES_TAUX'
+ENV_LIMITE_BYTES_RAFALE = 'RECEPTION_LIMITE_BYTES_RAFALE'
+ENV_LIMITE_CLES_MAX = 'RECEPTION_LIMITE_CLES_MAX'
+ENV_LIMITE_PROXIES_CONFIANCE = 'RECEPTION_LIMITE_PROXIES_CONFIANCE'  # Adresses/reseaux separes par des virgules
+
+# Producer : mq (defaut) ou loopback (local, sans MQ, pour tests de performance)
+ENV_PRODUCER = 'RECEPTION_PRODUCER'
+ENV_LOOPBACK_LATENCE = 'RECEPTION_LOOPBACK_LATENCE'
+ENV_LOOPBACK_LATENCE_VARIATION = 'RECEPTION_LOOPBACK_LATENCE_VARIATION'
+ENV_LOOPBACK_TAUX_ECHEC = 'RECEPTION_LOOPBACK_TAUX_ECHEC'
+ENV_LOOPBACK_TAUX_REJET = 'RECEPTION_LOOPBACK_TAUX_REJET'
+ENV_LOOPBACK_CERTIFICATS = 'RECEPTION_LOOPBACK_CERTIFICATS'  # Fichiers PEM separes par des virgules
+
+# Tracage des etapes de traitement des posts
+ENV_TRACES = 'RECEPTION_TRACES'
+ENV_TRACES_ECHANTILLONNAGE = 'RECEPTION_TRACES_ECHANTILLONNAGE'
+ENV_TRACES_CONSERVEES = 'RECEPTION_TRACES_CONSERVEES'
+ENV_TRACES_FENETRE = 'RECEPTION_TRACES_FENETRE'
+ENV_TRACES_OTEL = 'RECEPTION_TRACES_OTEL'
+
+# Deduplication des fichiers recus (opt-in) : nombre d'entrees de l'index, duree de validite (secondes)
+ENV_DEDUP = 'RECEPTION_DEDUP'
+ENV_DEDUP_TAILLE = 'RECEPTION_DEDUP_TAILLE'
+ENV_DEDUP_TTL = 'RECEPTION_DEDUP_TTL'
+
+# Mode pre-fork : nombre de processus workers (0 : un worker par CPU)
+ENV_WORKERS = 'RECEPTION_WORKERS'
+
+# Soumission de messages en lot (/reception/messages/batch)
+ENV_BATCH_MESSAGES_MAX = 'RECEPTION_BATCH_MESSAGES_MAX'
+ENV_BATCH_TAILLE_MAX = 'RECEPTION_BATCH_TAILLE_MAX'
+ENV_BATCH_CONCURRENCE = 'RECEPTION_BATCH_CONCURRENCE'
+
+# Service de chiffrage hors de la boucle asyncio : threads (0 : dans la boucle), jobs en attente, jobs par lot
+ENV_CRYPTO_WORKERS = 'RECEPTION_CRYPTO_WORKERS'
+ENV_CRYPTO_FILE = 'RECEPTION_CRYPTO_FILE'
+ENV_CRYPTO_LOT = 'RECEPTION_CRYPTO_LOT'
+
+# Surveillance de la boucle asyncio : intervalle de mesure du retard (secondes), duree a partir de laquelle la pile
+# d'un callback bloquant est capturee (secondes, 0 : desactive), nombre de blocages conserves
+ENV_BOUCLE_INTERVALLE = 'RECEPTION_BOUCLE_INTERVALLE'
+ENV_BOUCLE_SEUIL_BLOCAGE = 'RECEPTION_BOUCLE_SEUIL_BLOCAGE'
+ENV_BOUCLE_BLOCAGES_CONSERVES = 'RECEPTION_BOUCLE_BLOCAGES_CONSERVES'
+
+# Jeton des routes d'administration (diagnostics sous /reception/admin, header Authorization: Bearer). Les routes
+# ne sont pas exposees si le jeton n'est pas configure.
+ENV_ADMIN_JETON = 'RECEPTION_ADMIN_JETON'
+
+PRODUCER_MQ = 'mq'
+PRODUCER_LOOPBACK = 'loopback'
@@ -0,0 +1,141 @@
+import asyncio
+import time
+
+from contextlib import asynccontextmanager
+
+
+class RefusAdmission(Exception):
+    pass
+
+
+class FileAdmissionPleine(RefusAdmission):
+    pass
+
+
+class AttenteAdmissionExpiree(RefusAdmission):
+    pass
+
+
+class VoieAdmission:
+    """
+    Voie d'admission : nombre maximal de requetes actives et file d'attente bornee avec timeout.
+    """
+
+    def __init__(self, nom: str, concurrence: int, taille_file: int, timeout_attente: float, metriques=None):
+        self.__nom = nom
+        self.__metriques = metriques
+        self.__concurrence = concurrence
+        self.__taille_file = taille_file
+        self.__timeout_attente = timeout_attente
+
+        self.__semaphore = asyncio.Semaphore(value=concurrence)
+
+        # Metriques
+        self.__actifs = 0
+        self.__en_attente = 0
+        self.__admis = 0
+        self.__rejets_file_pleine = 0
+        self.__rejets_timeout = 0
+        self.__attente_totale = 0.0
+        self.__attente_max = 0.0
+
+    async def acquerir(self):
+        """
+        Attend une place dans la voie.
+        :raises FileAdmissionPleine: La file d'attente est pleine, refus immediat
+        :raises AttenteAdmissionExpiree: Aucune place liberee avant le timeout
+        """
+        if self.__semaphore.locked() and self.__en_attente >= self.__taille_file:
+            self.__rejets_file_pleine += 1
+            raise FileAdmissionPleine()
+
+        self.__en_attente += 1
+        debut = time.monotonic()
+        try:
+            await asyncio.wait_for(self.__semaphore.acquire(), self.__timeout_attente)
+        except asyncio.TimeoutError:
+            self.__rejets_timeout += 1
+            raise AttenteAdmissionExpiree()
+        finally:
+            self.__en_attente -= 1
+            attente = time.monotonic() - debut
+            self.__attente_totale += attente
+            if attente > self.__attente_max:
+                self.__attente_max = attente
+            if self.__metriques is not None:
+                self.__metriques.attente_admission.observer(attente, (self.__nom,))
+
+        self.__actifs += 1
+        self.__admis += 1
+
+    def liberer(self):
+        self.__actifs -= 1
+        self.__semaphore.release()
+
+    @asynccontextmanager
+    async def admettre(self):
+        await self.acquerir()
+        try:
+            yield
+        finally:
+            self.liberer()
+
+    @property
+    def nom(self) -> str:
+        return self.__nom
+
+    def get_metriques(self) -> dict:
+        return {
+            'concurrence': self.__concurrence,
+            'taille_file': self.__taille_file,
+            'actifs': self.__actifs,
+            'en_attente': self.__en_attente,
+            'admis': self.__admis,
+            'rejets_file_pleine': self.__rejets_file_pleine,
+            'rejets_timeout': self.__rejets_timeout,
+            'attente_totale': self.__attente_totale,
+            'attente_max': self.__attente_max,
+        }
+
+
+class ControleAdmission:
+    """
+    Controle d'admission des messages recus. Les messages json, multipart (avec fichiers) et les lots de messages ont
+    chacun leur voie pour que les uploads lents et les lots ne bloquent pas les petits messages.
+    """
+
+    def __init__(self, configuration, metriques=None):
+        timeout_attente = configuration.admission_timeout_attente
+        self.__voie_json = VoieAdmission(
+            'json', configuration.admission_json_concurrence, configuration.admission_json_file, timeout_attente,
+            metriques)
+        self.__voie_multipart = VoieAdmission(
+            'multipart', configuration.admission_multipart_concurrence, configuration.admission_multipart_file,
+            timeout_attente, metriques)
+        self.__voie_batch = VoieAdmission(
+            'batch', configuration.admission_batch_concurrence, configuration.admission_batch_file, timeout_attente,
+            metriques)
+        self.__retry_after = configuration.admission_retry_after
+
+    @property
+    def voie_json(self) -> VoieAdmission:
+        return self.__voie_json
+
+    @property
+    def voie_multipart(self) -> VoieAdmission:
+        return self.__voie_multipart
+
+    @property
+    def voie_batch(self) -> VoieAdmission:
+        return self.__voie_batch
+
+    @property
+    def retry_after(self) -> int:
+        return self.__retry_after
+
+    def get_metriques(self) -> dict:
+        return {
+            self.__voie_json.nom: self.__voie_json.get_metriques(),
+            self.__voie_multipart.nom: self.__voie_multipart.get_metriques(),
+            self.__voie_batch.nom: self.__voie_batch.get_metriques(),
+        }
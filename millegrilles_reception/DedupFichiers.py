@@ -0,0 +1,69 @@
+import hashlib
+import time
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+
+def nouveau_hacheur():
+    """ Hachage du contenu dechiffre (cle de l'index de deduplication) """
+    return hashlib.blake2b(digest_size=32)
+
+
+@dataclass(frozen=True)
+class EntreeDedup:
+    """ Information de dechiffrage d'un fichier deja conserve, reutilisee pour un contenu identique """
+    fuuid: str
+    cle_id: str
+    nonce: str
+    format: str
+    taille_chiffre: int
+    date_ajout: float
+
+
+class IndexDedup:
+    """
+    Index LRU des fichiers recus recemment, par hachage du contenu dechiffre. Les entrees sont ajoutees lorsque le
+    fichier est transfere vers ready/ et expirent apres ttl secondes.
+    """
+
+    def __init__(self, taille_max: int, ttl: float):
+        self.__taille_max = taille_max
+        self.__ttl = ttl
+        self.__entrees: OrderedDict[bytes, EntreeDedup] = OrderedDict()
+
+        self.__hits = 0
+        self.__miss = 0
+
+    def get(self, digest: bytes) -> Optional[EntreeDedup]:
+        entree = self.__entrees.get(digest)
+        if entree is not None and entree.date_ajout + self.__ttl < time.time():
+            del self.__entrees[digest]
+            entree = None
+
+        if entree is None:
+            self.__miss += 1
+            return None
+
+        self.__entrees.move_to_end(digest)
+        self.__hits += 1
+        return entree
+
+    def ajouter(self, digest: bytes, entree: EntreeDedup):
+        self.__entrees[digest] = entree
+        self.__entrees.move_to_end(digest)
+        while len(self.__entrees) > self.__taille_max:
+            self.__entrees.popitem(last=False)
+
+    def __len__(self):
+        return len(self.__entrees)
+
+    def get_metriques(self) -> dict:
+        total = self.__hits + self.__miss
+        return {
+            'entrees': len(self.__entrees),
+            'hits': self.__hits,
+            'miss': self.__miss,
+            'taux_hits': self.__hits / total if total > 0 else 0.0,
+        }
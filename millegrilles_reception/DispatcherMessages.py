@@ -0,0 +1,203 @@
+import asyncio
+import datetime
+import json
+import logging
+import time
+
+from os import makedirs, path
+from typing import Optional
+
+from millegrilles_messages.messages import Constantes
+from millegrilles_reception.Outbox import Outbox, EntreeOutbox, ETAT_EN_ATTENTE, ETAT_LIVRE, ETAT_REJETE, \
+    ETAT_ECHEC
+
+
+class DispatcherMessages:
+    """
+    Emet les commandes posterV1 de l'outbox en arriere-plan. Les messages sont emis dans l'ordre de reception avec
+    une concurrence bornee lorsque le producer MQ est pret. Les fichiers de la batch (intake_batch) sont liberes
+    avec le message.
+
+    Un message en erreur d'emission est reporte dans l'outbox (delai exponentiel) et libere sa place : les messages
+    suivants peuvent etre emis avant lui. L'ordre d'emission est donc garanti seulement en l'absence d'erreurs.
+
+    Un message accepte par le domaine est marque livre avant l'intake de ses fichiers : une erreur d'intake est
+    reprise par le marqueur de la batch, sans emettre le message a nouveau. Apres dispatch_tentatives_max erreurs
+    d'emission, le message est marque en echec et ses fichiers sont retires.
+    """
+
+    def __init__(self, web_app):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__web_app = web_app
+        self.__etat = web_app.etat
+        self.__metriques = web_app.etat.metriques
+
+        configuration = self.__etat.configuration_reception
+        self.__concurrence = configuration.dispatch_concurrence
+        self.__tentatives_max = max(1, configuration.dispatch_tentatives_max)
+
+        self.__outbox: Optional[Outbox] = None
+        self.__evenement_message: Optional[asyncio.Event] = None
+        self.__en_cours: set[str] = set()
+        self.__tasks_emission: set[asyncio.Task] = set()
+        self.__semaphore_emission: Optional[asyncio.Semaphore] = None
+
+    async def setup(self):
+        dir_staging = self.__etat.configuration.dir_staging
+        makedirs(dir_staging, exist_ok=True)
+        self.__outbox = Outbox(path.join(dir_staging, 'outbox.sqlite'))
+        await self.__outbox.ouvrir()
+        self.__evenement_message = asyncio.Event()
+        self.__semaphore_emission = asyncio.Semaphore(value=self.__concurrence)
+
+    async def run(self, stop_event: asyncio.Event):
+        tasks = [
+            asyncio.create_task(self.__traiter_outbox(stop_event)),
+            asyncio.create_task(self.__entretien_outbox(stop_event)),
+        ]
+        try:
+            await stop_event.wait()
+        finally:
+            tasks.extend(self.__tasks_emission)
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.__outbox.fermer()
+
+    async def soumettre(self, message_chiffre: dict, message_id: str, batch_id: Optional[str]) -> dict:
+        """
+        Conserve le message dans l'outbox pour emission en arriere-plan.
+        :return: Etat du message
+        """
+        created = await self.__outbox.ajouter(message_id, batch_id, message_chiffre)
+        self.__evenement_message.set()
+        return {'etat': ETAT_EN_ATTENTE, 'created': created}
+
+    async def get_etat(self, message_id: str) -> Optional[dict]:
+        return await self.__outbox.get_etat(message_id)
+
+    async def contient_batch(self, batch_id: str) -> bool:
+        """ :return: True si un message en attente d'emission reference la batch de fichiers """
+        return await self.__outbox.contient_batch(batch_id)
+
+    async def __traiter_outbox(self, stop_event: asyncio.Event):
+        while stop_event.is_set() is False:
+            self.__evenement_message.clear()
+
+            try:
+                await asyncio.wait_for(self.__etat.producer_wait(), 5)
+            except asyncio.TimeoutError:
+                continue  # Producer MQ pas pret, les messages restent dans l'outbox
+
+            entrees = await self.__outbox.get_en_attente(self.__concurrence, self.__en_cours)
+            for entree in entrees:
+                await self.__semaphore_emission.acquire()
+                self.__en_cours.add(entree.message_id)
+                task = asyncio.create_task(self.__emettre(entree))
+                self.__tasks_emission.add(task)
+                task.add_done_callback(self.__tasks_emission.discard)
+
+            try:
+                await asyncio.wait_for(self.__evenement_message.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __emettre(self, entree: EntreeOutbox):
+        try:
+            try:
+                reponse_parsed = await self.__emettre_posterv1(entree)
+            except Exception as e:
+                await self.__erreur_emission(entree, e)
+                return
+
+            # Le message a ete recu par le domaine : les erreurs suivantes ne doivent pas le faire emettre a nouveau
+            try:
+                if reponse_parsed.get('ok') is True:
+                    await self.__livrer(entree, reponse_parsed)
+                else:
+                    if entree.batch_id is not None:
+                        await self.__web_app.fichiers_dechiffres_handler.cleanup_batch(entree.batch_id)
+                    await self.__outbox.marquer_termine(entree.message_id, ETAT_REJETE, reponse_parsed)
+            except Exception:
+                self.__logger.exception("Erreur traitement reponse posterV1 message %s" % entree.message_id)
+        finally:
+            self.__en_cours.discard(entree.message_id)
+            self.__semaphore_emission.release()
+            self.__evenement_message.set()
+
+    async def __emettre_posterv1(self, entree: EntreeOutbox) -> dict:
+        debut = time.perf_counter()
+        producer = await asyncio.wait_for(self.__etat.producer_wait(), 5)
+        self.__metriques.attente_producer.observer(time.perf_counter() - debut)
+
+        rk = ['commande', Constantes.DOMAINE_MESSAGES, 'posterV1']
+        debut = time.perf_counter()
+        reponse = await producer.emettre_attendre(
+            json.dumps(entree.message), '.'.join(rk),
+            exchange=Constantes.SECURITE_PUBLIC,
+            correlation_id=entree.message_id,
+            timeout=10
+        )
+        self.__metriques.emettre_attendre.observer(time.perf_counter() - debut, ('async',))
+
+        reponse_parsed = reponse.parsed
+        del reponse_parsed['__original']
+        return reponse_parsed
+
+    async def __livrer(self, entree: EntreeOutbox, reponse_parsed: dict):
+        """
+        Marque le message livre puis transfere ses fichiers. Le marqueur d'intake est ecrit avant : une erreur
+        d'intake est reprise par reprendre_intake_batches(), le message n'est pas emis a nouveau.
+        """
+        batch_id = entree.batch_id
+        fichiers_handler = self.__web_app.fichiers_dechiffres_handler
+        if batch_id is not None:
+            try:
+                await fichiers_handler.marquer_intake_batch(batch_id)
+            except Exception:
+                self.__logger.exception("Erreur marqueur intake batch %s" % batch_id)
+
+        await self.__outbox.marquer_termine(entree.message_id, ETAT_LIVRE, reponse_parsed)
+
+        if batch_id is not None:
+            self.__logger.info("Submit consignation fichiers batch_id %s" % batch_id)
+            try:
+                await fichiers_handler.intake_batch(batch_id)
+            except Exception:
+                self.__logger.exception("Erreur intake_batch %s, reprise par le marqueur" % batch_id)
+
+    async def __erreur_emission(self, entree: EntreeOutbox, erreur: Exception):
+        tentatives = entree.tentatives + 1
+        # str() est vide pour certaines exceptions (e.g. asyncio.TimeoutError)
+        description_erreur = repr(erreur)
+        self.__logger.warning("Erreur emission message %s (tentative %d/%d) : %s" % (
+            entree.message_id, tentatives, self.__tentatives_max, description_erreur))
+        try:
+            if tentatives >= self.__tentatives_max:
+                await self.__marquer_echec(entree, description_erreur)
+            else:
+                # Delai avant de rendre le message disponible pour une nouvelle emission
+                await self.__outbox.reporter(entree.message_id, min(60, 2 ** min(entree.tentatives, 6)))
+        except Exception:
+            self.__logger.exception("Erreur maj tentatives outbox")
+
+    async def __marquer_echec(self, entree: EntreeOutbox, erreur: str):
+        """ Nombre maximal de tentatives atteint, le message n'est plus emis et ses fichiers sont retires """
+        self.__logger.error("Message %s en echec apres %d tentatives" % (entree.message_id, self.__tentatives_max))
+        await self.__outbox.marquer_termine(entree.message_id, ETAT_ECHEC, {'ok': False, 'err': erreur})
+        self.__metriques.outbox_echecs.incrementer()
+        if entree.batch_id is not None:
+            await self.__web_app.fichiers_dechiffres_handler.cleanup_batch(entree.batch_id)
+
+    async def __entretien_outbox(self, stop_event: asyncio.Event):
+        while stop_event.is_set() is False:
+            try:
+                nombre = await self.__outbox.purger(datetime.timedelta(days=1))
+                if nombre > 0:
+                    self.__logger.info("Outbox : %d messages termines retires" % nombre)
+            except Exception:
+                self.__logger.exception("Erreur entretien outbox")
+            try:
+                await asyncio.wait_for(stop_event.wait(), 3600)
+            except asyncio.TimeoutError:
+                pass
@@ -1,8 +1,12 @@
 import asyncio
 import datetime
+import json
 import logging
+import time
 
 from dataclasses import dataclass
+from os import path, rename
+from typing import Optional
 
 from millegrilles_messages.messages.EnveloppeCertificat import EnveloppeCertificat
 from millegrilles_messages.messages.MessagesModule import MessageWrapper
@@ -11,17 +15,121 @@ from millegrilles_web.Configuration import ConfigurationApplicationWeb
 from millegrilles_web.EtatWeb import EtatWeb
 
 from millegrilles_messages.messages import Constantes
+from millegrilles_reception import Constantes as ConstantesReception
+from millegrilles_reception.Configuration import ConfigurationReception
+from millegrilles_reception.Metriques import MetriquesReception
+from millegrilles_reception.ProducerLoopback import ProducerLoopback
+from millegrilles_reception.ServiceCrypto import ServiceCrypto
+from millegrilles_reception.SurveillanceBoucle import SurveillanceBoucle
+from millegrilles_reception.Traces import Traceur
 
+# Age maximal d'un certificat de chiffrage (nettoyer_certificats_stale)
+EXPIRATION_CERTIFICATS_CHIFFRAGE = datetime.timedelta(minutes=20)
+# Rafraichir les certificats avant leur expiration
+RAFRAICHISSEMENT_CERTIFICATS_CHIFFRAGE = datetime.timedelta(minutes=15)
+# Delai minimal entre deux chargements declenches par l'utilisation des certificats (secondes)
+DELAI_MIN_CHARGEMENT_CERTIFICATS = 10.0
 
-@dataclass
+NOM_FICHIER_CACHE_CERTIFICATS = 'certificats_chiffrage.json'
+
+
+@dataclass(frozen=True)
 class CertificatChiffrage:
     enveloppe: EnveloppeCertificat
     fingerprint: str
     date_ajout: datetime.datetime
+    domaines: frozenset
 
     @staticmethod
-    def from_enveloppe(enveloppe: EnveloppeCertificat):
-        return CertificatChiffrage(enveloppe, enveloppe.fingerprint, datetime.datetime.utcnow())
+    def from_enveloppe(enveloppe: EnveloppeCertificat, date_ajout: Optional[datetime.datetime] = None):
+        date_ajout = date_ajout or datetime.datetime.utcnow()
+        return CertificatChiffrage(enveloppe, enveloppe.fingerprint, date_ajout, frozenset(enveloppe.get_domaines))
+
+
+class SnapshotCertificatsChiffrage:
+    """
+    Ensemble immuable des certificats de chiffrage. Un nouveau snapshot est cree a chaque changement et remplace le
+    precedent de maniere atomique, les lecteurs (incluant les threads de chiffrage) n'utilisent pas de verrou.
+    """
+
+    def __init__(self, version: int, certificats: dict[str, CertificatChiffrage]):
+        self.__version = version
+        self.__certificats = certificats
+        self.__liste = tuple(certificats.values())
+        self.__enveloppes = [c.enveloppe for c in self.__liste]
+        self.__fingerprints = frozenset(certificats.keys())
+        self.__domaines = frozenset().union(*[c.domaines for c in self.__liste])
+
+        # Date a laquelle le plus vieux certificat doit etre rafraichi
+        if len(self.__liste) > 0:
+            self.__date_rafraichissement = min([c.date_ajout for c in self.__liste]) + RAFRAICHISSEMENT_CERTIFICATS_CHIFFRAGE
+        else:
+            self.__date_rafraichissement = None
+
+    @staticmethod
+    def vide():
+        return SnapshotCertificatsChiffrage(0, dict())
+
+    def remplacer(self, certificats: list[CertificatChiffrage]):
+        """ :return: Nouveau snapshot avec les certificats ajoutes/remplaces """
+        certificats_maj = self.__certificats.copy()
+        for certificat in certificats:
+            certificats_maj[certificat.fingerprint] = certificat
+        return SnapshotCertificatsChiffrage(self.__version + 1, certificats_maj)
+
+    def retirer(self, fingerprints: list[str]):
+        """ :return: Nouveau snapshot sans les certificats retires """
+        certificats_maj = {k: v for k, v in self.__certificats.items() if k not in fingerprints}
+        return SnapshotCertificatsChiffrage(self.__version + 1, certificats_maj)
+
+    @property
+    def version(self) -> int:
+        return self.__version
+
+    @property
+    def certificats(self) -> tuple[CertificatChiffrage, ...]:
+        return self.__liste
+
+    @property
+    def enveloppes(self) -> list[EnveloppeCertificat]:
+        """ Liste partagee, ne pas modifier """
+        return self.__enveloppes
+
+    @property
+    def date_rafraichissement(self) -> Optional[datetime.datetime]:
+        """ :return: Date a laquelle le plus vieux certificat doit etre rafraichi, None si aucuns certificats """
+        return self.__date_rafraichissement
+
+    @property
+    def fingerprints(self) -> frozenset:
+        return self.__fingerprints
+
+    @property
+    def domaines(self) -> frozenset:
+        return self.__domaines
+
+    def __len__(self):
+        return len(self.__liste)
+
+    def chiffrer_cles_secretes(self, cles_secretes: list[bytes]) -> list[dict]:
+        """
+        Chiffre une liste de cles secretes pour tous les certificats. Fait une passe par certificat.
+        :param cles_secretes: Cles secretes a chiffrer
+        :return: Liste de dict {fingerprint: cle_chiffree}, dans le meme ordre que cles_secretes
+        """
+        if len(self.__liste) == 0:
+            raise Exception("Aucuns certificats de chiffrage disponible")
+
+        cles_chiffrees = [dict() for _ in cles_secretes]
+
+        for cert in self.__liste:
+            fingerprint = cert.fingerprint
+            enveloppe = cert.enveloppe
+            for cle_secrete, cles_chiffrees_cle in zip(cles_secretes, cles_chiffrees):
+                cle_chiffree, _fingerprint = enveloppe.chiffrage_asymmetrique(cle_secrete)
+                cles_chiffrees_cle[fingerprint] = cle_chiffree
+
+        return cles_chiffrees
 
 
 class EtatReception(EtatWeb):
@@ -31,59 +139,142 @@ class EtatReception(EtatWeb):
 
         self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
 
-        # Certificats par fingerprint
-        self.__certificat_chiffrage: dict[str, CertificatChiffrage] = dict()
+        # Parametres specifiques a la reception (env)
+        self.__configuration_reception = ConfigurationReception()
+        self.__configuration_reception.parse_config()
+
+        # Certificats de chiffrage, remplace au complet a chaque changement
+        self.__certificats_chiffrage = SnapshotCertificatsChiffrage.vide()
+
+        self.__task_sauvegarde_certificats: Optional[asyncio.Task] = None
+
+        # Chargement des certificats en cours, partage par les appels concurrents
+        self.__chargement_certificats: Optional[asyncio.Task] = None
+        self.__debut_dernier_chargement = 0.0
+
+        # Cle publique X25519 de la millegrille, conservee avec son certificat
+        self.__cle_publique_millegrille: Optional[tuple[EnveloppeCertificat, bytes]] = None
+
+        self.__metriques = MetriquesReception()
+        self.__metriques.ajouter_jauge(
+            'reception_certificats_chiffrage', 'Nombre de certificats de chiffrage charges',
+            lambda: [((), len(self.__certificats_chiffrage))])
+        self.__metriques.ajouter_jauge(
+            'reception_certificats_chiffrage_age_secondes', 'Age des certificats de chiffrage charges',
+            self.__get_age_certificats, ('fingerprint',))
+
+        self.__traceur = Traceur(self.__configuration_reception)
+        self.__service_crypto = ServiceCrypto(self.__configuration_reception, self.__metriques)
+        self.__surveillance_boucle = SurveillanceBoucle(self.__configuration_reception, self.__metriques)
+
+        # Producer local (sans MQ) pour les tests de performance hors-ligne
+        self.__producer_loopback: Optional[ProducerLoopback] = None
+        if self.__configuration_reception.producer == ConstantesReception.PRODUCER_LOOPBACK:
+            self.__logger.warning("Producer loopback active, aucun message n'est emis vers MQ")
+            self.__producer_loopback = ProducerLoopback(
+                self.__configuration_reception, lambda pems: self.validateur_certificats.valider(pems))
+
+    @property
+    def producer(self):
+        if self.__producer_loopback is not None:
+            return self.__producer_loopback
+        return super().producer
+
+    async def producer_wait(self):
+        if self.__producer_loopback is not None:
+            return self.__producer_loopback
+        return await super().producer_wait()
+
+    @property
+    def producer_loopback(self) -> Optional[ProducerLoopback]:
+        return self.__producer_loopback
+
+    @property
+    def configuration_reception(self) -> ConfigurationReception:
+        return self.__configuration_reception
 
     async def charger_cles_chiffrage(self):
         """
-        Charge les cles de chiffrage (maitre des cles et domaine messages)
+        Charge les cles de chiffrage (maitre des cles et domaine messages). Les appels concurrents partagent le
+        meme chargement.
         :return:
         """
+        return await asyncio.shield(self.__demarrer_chargement_certificats())
+
+    def verifier_rafraichissement_certificats(self):
+        """
+        Demarre un chargement des certificats en arriere-plan si aucuns certificats ne sont disponibles ou s'ils
+        approchent de l'expiration. Ne bloque pas, doit etre appele a partir de la boucle asyncio.
+        """
+        date_rafraichissement = self.__certificats_chiffrage.date_rafraichissement
+        if date_rafraichissement is not None and datetime.datetime.utcnow() < date_rafraichissement:
+            return  # Certificats a jour
+        if self.__chargement_certificats is not None:
+            return  # Chargement deja en cours
+        if time.monotonic() - self.__debut_dernier_chargement < DELAI_MIN_CHARGEMENT_CERTIFICATS:
+            return  # Eviter de repeter les requetes si MQ ou les domaines ne repondent pas
+
+        chargement = self.__demarrer_chargement_certificats()
+        chargement.add_done_callback(self.__log_erreur_chargement)
+
+    def __demarrer_chargement_certificats(self) -> asyncio.Task:
+        chargement = self.__chargement_certificats
+        if chargement is None:
+            self.__debut_dernier_chargement = time.monotonic()
+            chargement = asyncio.create_task(self.__charger_cles_chiffrage())
+            chargement.add_done_callback(self.__fin_chargement_certificats)
+            self.__chargement_certificats = chargement
+        return chargement
+
+    def __fin_chargement_certificats(self, _chargement: asyncio.Task):
+        self.__chargement_certificats = None
+
+    def __log_erreur_chargement(self, chargement: asyncio.Task):
+        if chargement.cancelled() is False and chargement.exception() is not None:
+            self.__logger.warning("Erreur rafraichissement des certificats de chiffrage : %s" % chargement.exception())
+
+    async def __charger_cles_chiffrage(self):
         producer = self.producer
         if producer is None:
             raise Exception('producer pas pret')
         await asyncio.wait_for(producer.producer_pret().wait(), 5)
 
-        certificat_trouve = False
+        # Requetes aux deux domaines en parallele
+        resultats = await asyncio.gather(
+            self.__requete_certificat(producer, Constantes.DOMAINE_MAITRE_DES_CLES, Constantes.REQUETE_MAITREDESCLES_CERTIFICAT),
+            self.__requete_certificat(producer, Constantes.DOMAINE_MESSAGES, Constantes.REQUETE_MESSAGES_CERTIFICAT),
+        )
+        certificats = [c for c in resultats if c is not None]
 
-        # Charger certificats de maitre des cles
-        try:
-            reponse = await producer.executer_requete(
-                dict(), Constantes.DOMAINE_MAITRE_DES_CLES, Constantes.REQUETE_MAITREDESCLES_CERTIFICAT, Constantes.SECURITE_PUBLIC)
-            certificat = reponse.certificat
-            if Constantes.DOMAINE_MAITRE_DES_CLES in certificat.get_domaines:
-                self.__certificat_chiffrage[certificat.fingerprint] = CertificatChiffrage.from_enveloppe(certificat)
-                certificat_trouve = True
-        except Exception as e:
-            self.__logger.warning("EtatReception.charger_cles_chiffrage Erreur chargement certificats maitre des cles : %s" % str(e))
+        if len(certificats) == 0:
+            raise Exception('Aucun certificat de chiffrage trouve')
 
-        # Charger certificat de domaine messages
+        # Les certificats existants sont conserves, le snapshot n'est jamais vide suite a un chargement
+        self.__maj_certificats_chiffrage(self.__certificats_chiffrage.remplacer(certificats))
+
+    async def __requete_certificat(self, producer, domaine: str, requete: str) -> Optional[CertificatChiffrage]:
         try:
-            reponse = await producer.executer_requete(
-                dict(), Constantes.DOMAINE_MESSAGES, Constantes.REQUETE_MESSAGES_CERTIFICAT, Constantes.SECURITE_PUBLIC)
+            reponse = await producer.executer_requete(dict(), domaine, requete, Constantes.SECURITE_PUBLIC)
             certificat = reponse.certificat
-            if Constantes.DOMAINE_MESSAGES in certificat.get_domaines:
-                self.__certificat_chiffrage[certificat.fingerprint] = CertificatChiffrage.from_enveloppe(certificat)
-                certificat_trouve = True
+            if domaine in certificat.get_domaines:
+                return CertificatChiffrage.from_enveloppe(certificat)
         except Exception as e:
-            self.__logger.warning(
-                "EtatReception.charger_cles_chiffrage Erreur chargement certificats domaine messages : %s" % str(e))
+            self.__logger.warning("EtatReception.charger_cles_chiffrage Erreur chargement certificat %s : %s" % (domaine, str(e)))
 
-        if certificat_trouve is False:
-            raise Exception('Aucun certificat de chiffrage trouve')
+        return None
 
     async def nettoyer_certificats_stale(self):
         fingerprints_stale = list()
 
         # Detecter certificats ajoutes/maj il y a plus de 20 minutes
-        expiration = datetime.datetime.utcnow() - datetime.timedelta(minutes=20)
-        for fingerprint, cert in self.__certificat_chiffrage.items():
+        expiration = datetime.datetime.utcnow() - EXPIRATION_CERTIFICATS_CHIFFRAGE
+        for cert in self.__certificats_chiffrage.certificats:
             if cert.date_ajout < expiration:
-                fingerprints_stale.append(fingerprint)
+                fingerprints_stale.append(cert.fingerprint)
 
         # Retirer certificats stale
-        for fingerprint in fingerprints_stale:
-            del self.__certificat_chiffrage[fingerprint]
+        if len(fingerprints_stale) > 0:
+            self.__maj_certificats_chiffrage(self.__certificats_chiffrage.retirer(fingerprints_stale))
 
     def recevoir_certificat_chiffrage(self, message: MessageWrapper):
         """
@@ -95,20 +286,121 @@ class EtatReception(EtatWeb):
         domaines_certificat = enveloppe.get_domaines
         if Constantes.DOMAINE_MAITRE_DES_CLES not in domaines_certificat and Constantes.DOMAINE_MESSAGES not in domaines_certificat:
             raise Exception('Mauvais certificat, pas maitre des cles / messages')
-        self.__certificat_chiffrage[enveloppe.fingerprint] = CertificatChiffrage.from_enveloppe(enveloppe)
+        certificat = CertificatChiffrage.from_enveloppe(enveloppe)
+        self.__maj_certificats_chiffrage(self.__certificats_chiffrage.remplacer([certificat]))
 
-    def chiffrer_cle_secrete(self, cle_secrete: bytes):
-        cles_chiffrees = dict()
+    async def charger_cache_certificats(self):
+        """
+        Charge les certificats de chiffrage conserves sur disque lors de l'execution precedente. Les certificats sont
+        valides avec la CA et ceux qui sont plus vieux que EXPIRATION_CERTIFICATS_CHIFFRAGE sont ignores.
+        """
+        path_cache = path.join(self.configuration.dir_staging, NOM_FICHIER_CACHE_CERTIFICATS)
+        try:
+            with open(path_cache, 'rt') as fichier:
+                cache = json.load(fichier)
+        except FileNotFoundError:
+            return  # Aucun cache
+        except ValueError:
+            self.__logger.warning("Cache de certificats de chiffrage invalide, ignore")
+            return
 
-        for fingerprint, cert in self.__certificat_chiffrage.items():
-            cle_chiffree, _fingerprint = cert.enveloppe.chiffrage_asymmetrique(cle_secrete)
-            cles_chiffrees[fingerprint] = cle_chiffree
+        expiration = datetime.datetime.utcnow() - EXPIRATION_CERTIFICATS_CHIFFRAGE
+        certificats = list()
+        for info_certificat in cache.get('certificats') or list():
+            date_ajout = datetime.datetime.utcfromtimestamp(info_certificat['date_ajout'])
+            if date_ajout < expiration:
+                continue  # Stale
+            try:
+                enveloppe = await self.validateur_certificats.valider(info_certificat['pems'])
+                domaines = enveloppe.get_domaines
+                if Constantes.DOMAINE_MAITRE_DES_CLES in domaines or Constantes.DOMAINE_MESSAGES in domaines:
+                    certificats.append(CertificatChiffrage.from_enveloppe(enveloppe, date_ajout))
+            except Exception as e:
+                self.__logger.warning("Certificat de chiffrage du cache rejete : %s" % str(e))
 
-        if len(cles_chiffrees) == 0:
-            raise Exception("Aucuns certificats de chiffrage disponible")
+        if len(certificats) > 0:
+            self.__logger.info("Chargement de %d certificats de chiffrage a partir du cache" % len(certificats))
+            self.__certificats_chiffrage = self.__certificats_chiffrage.remplacer(certificats)
 
-        return cles_chiffrees
+    def __maj_certificats_chiffrage(self, certificats_chiffrage: SnapshotCertificatsChiffrage):
+        self.__certificats_chiffrage = certificats_chiffrage
+
+        # Sauvegarder le cache sur disque en arriere-plan
+        if self.__task_sauvegarde_certificats is None:
+            try:
+                self.__task_sauvegarde_certificats = asyncio.get_running_loop().create_task(
+                    self.__sauvegarder_cache_certificats())
+            except RuntimeError:
+                pass  # Aucune boucle (ne devrait pas arriver)
+
+    async def __sauvegarder_cache_certificats(self):
+        try:
+            # Sauvegarder le plus recent snapshot, incluant les changements recus pendant l'ecriture
+            version_sauvegardee = None
+            while version_sauvegardee != self.__certificats_chiffrage.version:
+                certificats_chiffrage = self.__certificats_chiffrage
+                cache = {'certificats': [
+                    {
+                        'pems': c.enveloppe.chaine_pem(),
+                        'date_ajout': int(c.date_ajout.replace(tzinfo=datetime.timezone.utc).timestamp())
+                    }
+                    for c in certificats_chiffrage.certificats
+                ]}
+                path_cache = path.join(self.configuration.dir_staging, NOM_FICHIER_CACHE_CERTIFICATS)
+                await asyncio.to_thread(ecrire_cache_certificats, path_cache, cache)
+                version_sauvegardee = certificats_chiffrage.version
+        except Exception:
+            self.__logger.exception("Erreur sauvegarde du cache de certificats de chiffrage")
+        finally:
+            self.__task_sauvegarde_certificats = None
+
+    def chiffrer_cle_secrete(self, cle_secrete: bytes):
+        return self.__certificats_chiffrage.chiffrer_cles_secretes([cle_secrete])[0]
+
+    def chiffrer_cles_secretes(self, cles_secretes: list[bytes]) -> list[dict]:
+        return self.__certificats_chiffrage.chiffrer_cles_secretes(cles_secretes)
 
     def get_certificats_chiffrage(self) -> list[EnveloppeCertificat]:
-        enveloppes = [c.enveloppe for c in self.__certificat_chiffrage.values()]
-        return enveloppes
+        self.verifier_rafraichissement_certificats()
+        return self.__certificats_chiffrage.enveloppes
+
+    @property
+    def certificats_chiffrage(self) -> SnapshotCertificatsChiffrage:
+        return self.__certificats_chiffrage
+
+    @property
+    def metriques(self) -> MetriquesReception:
+        return self.__metriques
+
+    @property
+    def traceur(self) -> Traceur:
+        return self.__traceur
+
+    @property
+    def service_crypto(self) -> ServiceCrypto:
+        return self.__service_crypto
+
+    @property
+    def surveillance_boucle(self) -> SurveillanceBoucle:
+        return self.__surveillance_boucle
+
+    def __get_age_certificats(self) -> list[tuple[tuple, float]]:
+        now = datetime.datetime.utcnow()
+        return [((c.fingerprint,), (now - c.date_ajout).total_seconds()) for c in self.__certificats_chiffrage.certificats]
+
+    @property
+    def cle_publique_millegrille(self) -> bytes:
+        """ Cle publique X25519 du certificat de la millegrille (chiffrage des fichiers) """
+        certificat_millegrille = self.certificat_millegrille
+        cle_publique = self.__cle_publique_millegrille
+        if cle_publique is None or cle_publique[0] is not certificat_millegrille:
+            cle_publique = (certificat_millegrille, certificat_millegrille.get_public_x25519())
+            self.__cle_publique_millegrille = cle_publique
+        return cle_publique[1]
+
+
+def ecrire_cache_certificats(path_cache: str, cache: dict):
+    path_temp = path_cache + '.work'
+    with open(path_temp, 'wt') as fichier:
+        json.dump(cache, fichier)
+    rename(path_temp, path_cache)
@@ -1,15 +1,20 @@
 import asyncio
 import datetime
+import errno
 import json
 import logging
+import os
 import pathlib
 import shutil
+import time
 
 import pytz
 import uuid
 
 from aiohttp import web
 from aiohttp.web_request import Request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from os import makedirs, path, unlink, rename, listdir
 from typing import Optional
 
@@ -18,6 +23,57 @@ from millegrilles_web import Constantes as ConstantesWeb
 from millegrilles_messages.chiffrage.Mgs4 import CipherMgs4
 from millegrilles_messages.chiffrage.SignatureDomaines import SignatureDomaines
 from millegrilles_web.JwtUtils import creer_token_fichier, get_headers, verify
+from millegrilles_reception.DedupFichiers import EntreeDedup, IndexDedup, nouveau_hacheur
+from millegrilles_reception.SpoolChiffre import SpoolChiffre, estimer_taille_chiffree
+
+# Marqueur d'une batch acceptee dont les fichiers doivent etre transferes vers ready/
+NOM_FICHIER_MARQUEUR_INTAKE = 'intake'
+
+# Chaque fichier recu est ecrit directement dans son slot (upload/<batch_id>/slot_N/0.part). Le repertoire du slot
+# devient ready/<fuuid> avec un seul rename lors de l'intake.
+PREFIXE_SLOT = 'slot_'
+NOM_FICHIER_CONTENU = '0.part'
+
+
+class FichierTropGros(Exception):
+    pass
+
+
+@dataclass
+class StatistiquesUpload:
+    batch_id: str
+    nom: Optional[str]
+    taille_dechiffre: int
+    taille_chiffre: int
+    duree: float
+    attente_chiffrage: float
+
+    @property
+    def debit(self) -> float:
+        """ Debit en bytes/seconde (dechiffre) """
+        if self.duree <= 0:
+            return 0.0
+        return self.taille_dechiffre / self.duree
+
+
+@dataclass
+class InfoBatchStaging:
+    batch_id: str
+    path: str
+    created: float
+    intake: bool
+
+
+@dataclass
+class ClePendante:
+    """ Cle secrete d'un fichier recu, en attente de chiffrage/signature avec le reste de la batch. """
+    fuuid: str
+    cle_secrete: bytes
+    cle_peer: str
+    created: int
+    resultat: dict
+    slot: str
+    digest: Optional[bytes] = None  # Hachage du contenu dechiffre (deduplication)
 
 
 class FichiersDechiffresHandler:
@@ -29,8 +85,32 @@ class FichiersDechiffresHandler:
         self.__fichiers_thread = None
         self.__semaphore_upload_fichier = asyncio.BoundedSemaphore(value=5)
 
+        # Pool de chiffrage/ecriture des fichiers recus, initialise dans setup()
+        self.__executor_chiffrage: Optional[ThreadPoolExecutor] = None
+        self.__taille_chunk = 256 * 1024
+        self.__chunks_attente = 8
+
+        # Cles secretes des fichiers recus par batch_id, en attente de preparer_cles_batch()
+        self.__cles_batch: dict[str, list[ClePendante]] = dict()
+
+        # Deduplication (opt-in) : entrees ajoutees a l'index lorsque la batch est transferee vers ready/
+        self.__index_dedup: Optional[IndexDedup] = None
+        self.__dedup_batch: dict[str, list[tuple[bytes, EntreeDedup]]] = dict()
+
+        # Batches en cours de transfert vers ready/ (intake_batch et reprise)
+        self.__intake_en_cours: set[str] = set()
+
     async def setup(self):
-        pass
+        configuration = self.__web_app.etat.configuration_reception
+        self.__taille_chunk = configuration.upload_taille_chunk
+        self.__chunks_attente = configuration.upload_chunks_attente
+        self.__executor_chiffrage = ThreadPoolExecutor(
+            max_workers=configuration.upload_workers, thread_name_prefix='chiffrage_upload')
+        if configuration.dedup_actif:
+            self.__index_dedup = IndexDedup(configuration.dedup_taille, configuration.dedup_ttl)
+            self.__web_app.etat.metriques.ajouter_jauge(
+                'reception_dedup_entrees', "Nombre d'entrees de l'index de deduplication",
+                lambda: [((), len(self.__index_dedup))])
         # dechiffres_path = f'{self.__web_app.app_path}/fichiers/dechiffres'
         # self.__web_app.app.add_routes([
         #     web.get(dechiffres_path, self.get_token_session),
@@ -90,70 +170,79 @@ class FichiersDechiffresHandler:
     #     reponse = {'fichiers': fichiers_traites}
     #     return web.json_response(reponse, headers=headers, status=201)
 
-    async def recevoir_fichier(self, batch_id, field):
+    async def recevoir_fichier(self, batch_id, field, taille_max: Optional[int] = None):
+        """
+        Chiffre le fichier recu dans le repertoire de staging de la batch.
+        :param taille_max: Taille maximale du contenu dechiffre (bytes)
+        :raises FichierTropGros: Le fichier depasse taille_max, la reception est interrompue
+        """
+        content_length = field.headers.get('Content-Length')
+        if taille_max is not None and content_length is not None and content_length.isdigit() \
+                and int(content_length) > taille_max:
+            raise FichierTropGros()
+
         filename = field.filename
         mimetype = field.headers['Content-Type']
         dir_staging = self.__web_app.etat.configuration.dir_staging
-        path_upload = path.join(dir_staging, 'upload', batch_id)
-        makedirs(path_upload, exist_ok=True)
 
-        nom_fichier_temp = path.join(path_upload, 'upload.tmp')
+        # Le contenu est ecrit directement a sa place finale, seul le repertoire du slot est deplace a l'intake
+        cles_pendantes = self.__cles_batch.setdefault(batch_id, list())
+        slot = '%s%d' % (PREFIXE_SLOT, len(cles_pendantes))
+        path_slot = path.join(dir_staging, 'upload', batch_id, slot)
+        makedirs(path_slot, exist_ok=True)
+
+        nom_fichier_contenu = path.join(path_slot, NOM_FICHIER_CONTENU)
+
+        public_key_bytes = self.__web_app.etat.cle_publique_millegrille
 
-        public_key_bytes = self.__web_app.etat.certificat_millegrille.get_public_x25519()
+        hacheur = nouveau_hacheur() if self.__index_dedup is not None else None
 
         try:
-            cipher = CipherMgs4(public_key_bytes)
+            # Echange de cle X25519, hors de la boucle
+            cipher = await self.__web_app.etat.service_crypto.executer(CipherMgs4, public_key_bytes)
             format_chiffrage = 'mgs4'
-            taille_dechiffre = 0
-            taille_chiffre = 0
-            with open(nom_fichier_temp, 'wb') as fichier:
-                while True:
-                    chunk = await field.read_chunk()
-                    if not chunk:
-                        break
-                    taille_dechiffre += len(chunk)
-
-                    chunk = cipher.update(chunk)
-                    taille_chiffre += len(chunk)
+            with self.__web_app.etat.traceur.span('fichier.chiffrage', fichier=filename) as span, \
+                    SpoolChiffre(nom_fichier_contenu, estimer_taille_chiffree(content_length)) as fichier:
+                statistiques = await self.__pipeline_chiffrage(
+                    batch_id, filename, field, cipher, fichier, taille_max, hacheur)
+                if span is not None:
+                    span.attributs['taille'] = statistiques.taille_dechiffre
+                    span.attributs['attente_chiffrage_ms'] = statistiques.attente_chiffrage * 1000
+            metriques = self.__web_app.etat.metriques
+            metriques.upload_bytes.incrementer(('dechiffre',), statistiques.taille_dechiffre)
+            metriques.upload_bytes.incrementer(('chiffre',), statistiques.taille_chiffre)
+            metriques.debit_chiffrage.observer(statistiques.debit)
+            self.__logger.info("recevoir_fichier batch_id %s : %d bytes en %.3f secs (%.1f MB/s, attente chiffrage %.3f secs)" % (
+                batch_id, statistiques.taille_dechiffre, statistiques.duree, statistiques.debit / 1024 / 1024,
+                statistiques.attente_chiffrage))
+            taille_dechiffre = statistiques.taille_dechiffre
+            taille_chiffre = statistiques.taille_chiffre
+            now_timestamp = int(datetime.datetime.utcnow().timestamp())
 
-                    fichier.write(chunk)
-                chunk = cipher.finalize()
-                taille_chiffre += len(chunk)
-                fichier.write(chunk)
+            digest = None
+            if hacheur is not None:
+                digest = hacheur.digest()
+                entree_dedup = self.__index_dedup.get(digest)
+                metriques.dedup_fichiers.incrementer(('hit' if entree_dedup is not None else 'miss',))
+                if entree_dedup is not None:
+                    # Contenu deja conserve : reutiliser le fichier et sa cle, la copie recue est retiree
+                    shutil.rmtree(path_slot, ignore_errors=True)
+                    return {
+                        'fuuid': entree_dedup.fuuid,
+                        'nom': filename,
+                        'mimetype': mimetype,
+                        'date_fichier': now_timestamp,
+                        'taille_dechiffre': taille_dechiffre,
+                        'taille_chiffre': entree_dedup.taille_chiffre,
+                        'cle_id': entree_dedup.cle_id,
+                        'format': entree_dedup.format,
+                        'nonce': entree_dedup.nonce,
+                    }
 
             enveloppes = list()
-            cle_secrete = cipher.cle_secrete
-            cles_chiffrees = self.__web_app.etat.chiffrer_cle_secrete(cle_secrete)
             params_dechiffrage = cipher.get_info_dechiffrage(enveloppes)
 
             fuuid = params_dechiffrage['hachage_bytes']
-            nom_fichier = path.join(path_upload, fuuid)
-            rename(nom_fichier_temp, nom_fichier)
-
-            nom_etat = path.join(path_upload, fuuid + '.json')
-            signature_domaines = SignatureDomaines.signer_domaines(cle_secrete, ['Messages'], params_dechiffrage['cle'])
-
-            info_cle = {
-                'signature': signature_domaines.to_dict(),
-                'cles': cles_chiffrees,
-            }
-            cle_id = signature_domaines.get_cle_ref()
-
-            commande_cles = self.__web_app.etat.formatteur_message.signer_message(
-                Constantes.KIND_COMMANDE, info_cle, "MaitreDesCles", True, "ajouterCleDomaines")[0]
-
-            now_timestamp = int(datetime.datetime.utcnow().timestamp())
-
-            fichier_etat = {
-                'cles': commande_cles,
-                'cle_id': cle_id,
-                'hachage': fuuid,
-                'retry': 0,
-                'created': now_timestamp
-            }
-
-            with open(nom_etat, 'wt') as fichier:
-                json.dump(fichier_etat, fichier)
 
             resultat = {
                 'fuuid': fuuid,
@@ -162,20 +251,111 @@ class FichiersDechiffresHandler:
                 'date_fichier': now_timestamp,
                 'taille_dechiffre': taille_dechiffre,
                 'taille_chiffre': taille_chiffre,
-                'cle_id': cle_id,
+                'cle_id': None,  # Assigne par preparer_cles_batch()
                 'format': format_chiffrage,
                 'nonce': params_dechiffrage['header'],
             }
 
+            # La cle est chiffree et signee avec les autres cles de la batch (preparer_cles_batch)
+            cle_pendante = ClePendante(
+                fuuid, cipher.cle_secrete, params_dechiffrage['cle'], now_timestamp, resultat, slot, digest)
+            cles_pendantes.append(cle_pendante)
+
             return resultat
         except Exception as e:
-            try:
-                unlink(nom_fichier_temp)
-            except FileNotFoundError:
-                pass  # Ok
+            shutil.rmtree(path_slot, ignore_errors=True)
             raise e
 
-        pass
+    async def __pipeline_chiffrage(self, batch_id: str, filename: Optional[str], field, cipher: CipherMgs4,
+                                   fichier: SpoolChiffre, taille_max: Optional[int] = None,
+                                   hacheur=None) -> StatistiquesUpload:
+        """
+        Lit les chunks du field et les chiffre/ecrit dans le pool de threads. La lecture du prochain chunk se fait
+        pendant le chiffrage du precedent. La lecture est suspendue (backpressure) lorsque trop de chunks sont en
+        attente de chiffrage.
+        :return: Statistiques de l'upload
+        :raises FichierTropGros: Le contenu recu depasse taille_max
+        """
+        loop = asyncio.get_running_loop()
+        debut = time.monotonic()
+        attente_chiffrage = 0.0
+
+        taille_dechiffre = 0
+        taille_chiffre = 0
+        chunks_attente = list()
+        job_chiffrage = None
+        lecture_terminee = False
+
+        try:
+            while lecture_terminee is False:
+                chunk = await field.read_chunk(self.__taille_chunk)
+                if chunk:
+                    taille_dechiffre += len(chunk)
+                    if taille_max is not None and taille_dechiffre > taille_max:
+                        raise FichierTropGros()
+                    chunks_attente.append(chunk)
+                else:
+                    lecture_terminee = True
+
+                if job_chiffrage is not None:
+                    if lecture_terminee or job_chiffrage.done() or len(chunks_attente) >= self.__chunks_attente:
+                        debut_attente = time.monotonic()
+                        taille_chiffre += await job_chiffrage
+                        attente_chiffrage += time.monotonic() - debut_attente
+                        job_chiffrage = None
+
+                if job_chiffrage is None and len(chunks_attente) > 0:
+                    job_chiffrage = loop.run_in_executor(
+                        self.__executor_chiffrage, chiffrer_chunks, cipher, fichier, chunks_attente, hacheur)
+                    chunks_attente = list()
+
+            if job_chiffrage is not None:
+                taille_chiffre += await job_chiffrage
+                job_chiffrage = None
+
+            taille_chiffre += await loop.run_in_executor(self.__executor_chiffrage, finaliser_chiffrage, cipher, fichier)
+        finally:
+            if job_chiffrage is not None:
+                # Erreur de lecture - s'assurer que le thread n'ecrit plus dans le fichier avant de le fermer
+                await asyncio.wait([job_chiffrage])
+
+        duree = time.monotonic() - debut
+        return StatistiquesUpload(batch_id, filename, taille_dechiffre, taille_chiffre, duree, attente_chiffrage)
+
+    async def preparer_cles_batch(self, batch_id: str):
+        """
+        Chiffre et signe les cles de tous les fichiers recus pour la batch. Le travail est fait en une seule passe
+        dans le pool de threads. Ecrit les fichiers d'etat (.json) utilises par intake_batch et assigne le cle_id
+        dans le resultat de chaque fichier.
+        """
+        cles_pendantes = self.__cles_batch.pop(batch_id, None)
+        if not cles_pendantes:
+            return
+
+        dir_staging = self.__web_app.etat.configuration.dir_staging
+        path_upload = path.join(dir_staging, 'upload', batch_id)
+
+        self.__web_app.etat.verifier_rafraichissement_certificats()
+
+        loop = asyncio.get_running_loop()
+        cles_ids = await loop.run_in_executor(
+            self.__executor_chiffrage, preparer_cles, self.__web_app.etat, path_upload, cles_pendantes)
+
+        for cle_pendante, cle_id in zip(cles_pendantes, cles_ids):
+            cle_pendante.resultat['cle_id'] = cle_id
+
+        if self.__index_dedup is not None:
+            now = time.time()
+            self.__dedup_batch[batch_id] = [
+                (c.digest, EntreeDedup(c.fuuid, c.resultat['cle_id'], c.resultat['nonce'], c.resultat['format'],
+                                       c.resultat['taille_chiffre'], now))
+                for c in cles_pendantes if c.digest is not None
+            ]
+
+    def get_metriques_dedup(self) -> Optional[dict]:
+        if self.__index_dedup is None:
+            return None
+        return self.__index_dedup.get_metriques()
 
     # async def delete_session(self, request: Request):
     #     headers = {'Cache-Control': 'no-store'}
@@ -185,38 +365,450 @@ class FichiersDechiffresHandler:
     #     headers = {'Cache-Control': 'no-store'}
     #     return web.HTTPOk()
 
-    def cleanup_batch(self, batch_id):
+    async def recuperer_staging(self):
+        """
+        Passe de recuperation au demarrage, avant la reception de nouveaux fichiers. Retire les uploads interrompus
+        (upload.tmp) et les batches qui n'ont jamais ete acceptees (aucun marqueur d'intake, absentes de l'outbox).
+        Les batches marquees sont reprises par reprendre_intake_batches().
+        """
+        dir_staging = self.__web_app.etat.configuration.dir_staging
+        path_upload = path.join(dir_staging, 'upload')
+        loop = asyncio.get_running_loop()
+
+        batches = await loop.run_in_executor(self.__executor_chiffrage, lister_batches_staging, path_upload)
+
+        taille_recuperee = 0
+        batches_retirees = 0
+        for info_batch in batches:
+            if info_batch.intake:
+                continue  # Repris par reprendre_intake_batches()
+
+            taille_recuperee += await loop.run_in_executor(
+                self.__executor_chiffrage, supprimer_fichier, path.join(info_batch.path, 'upload.tmp'))
+
+            if info_batch.batch_id in self.__cles_batch or await self.__batch_dans_outbox(info_batch.batch_id):
+                continue  # Message en attente d'emission
+
+            taille_recuperee += await loop.run_in_executor(self.__executor_chiffrage, supprimer_repertoire, info_batch.path)
+            batches_retirees += 1
+
+        if taille_recuperee > 0 or batches_retirees > 0:
+            self.__logger.info("recuperer_staging %d batches retirees, %d bytes recuperes" % (batches_retirees, taille_recuperee))
+
+    async def nettoyer_staging(self):
+        """
+        Retire les batches expirees de dir_staging/upload. L'age d'une batch est determine par le champ created de
+        ses fichiers d'etat (.json) ou par la date de modification du repertoire. Les batches sont traitees une a la
+        fois dans le pool de threads, jusqu'a un maximum par passe.
+        """
+        configuration = self.__web_app.etat.configuration_reception
+        dir_staging = self.__web_app.etat.configuration.dir_staging
+        path_upload = path.join(dir_staging, 'upload')
+        loop = asyncio.get_running_loop()
+
+        batches = await loop.run_in_executor(self.__executor_chiffrage, lister_batches_staging, path_upload)
+
+        expiration = time.time() - configuration.staging_expiration
+        batches_expirees = [b for b in batches if b.created < expiration]
+        batches_expirees.sort(key=lambda b: b.created)
+
+        taille_recuperee = 0
+        batches_retirees = 0
+        for info_batch in batches_expirees[:configuration.staging_nettoyage_max]:
+            if info_batch.batch_id in self.__cles_batch:
+                continue  # Upload en cours
+            if info_batch.intake:
+                continue  # Transfert vers ready/ en cours ou a reprendre
+            if await self.__batch_dans_outbox(info_batch.batch_id):
+                continue  # Message en attente d'emission
+            taille_recuperee += await loop.run_in_executor(self.__executor_chiffrage, supprimer_repertoire, info_batch.path)
+            batches_retirees += 1
+
+        if batches_retirees > 0:
+            self.__logger.info("nettoyer_staging %d batches expirees retirees (%d en attente), %d bytes recuperes" % (
+                batches_retirees, len(batches_expirees) - batches_retirees, taille_recuperee))
+
+    async def __batch_dans_outbox(self, batch_id: str) -> bool:
+        reception_handler = self.__web_app.reception_handler
+        if reception_handler is None:
+            return True  # Outbox non disponible, conserver la batch
+        try:
+            return await reception_handler.dispatcher.contient_batch(batch_id)
+        except Exception:
+            self.__logger.exception("Erreur verification outbox pour batch %s" % batch_id)
+            return True
+
+    async def cleanup_batch(self, batch_id):
+        """
+        Retire les fichiers d'une batch dont le message n'a pas ete accepte. Une batch marquee pour l'intake (message
+        accepte) est conservee pour reprendre_intake_batches().
+        """
         dir_staging = self.__web_app.etat.configuration.dir_staging
         path_upload = path.join(dir_staging, 'upload', batch_id)
-        shutil.rmtree(path_upload, ignore_errors=True)
+        # Retrait hors de la boucle, la batch peut contenir plusieurs gros fichiers
+        retiree = await asyncio.get_running_loop().run_in_executor(
+            self.__executor_chiffrage, retirer_batch_non_acceptee, path_upload)
+        if retiree is False:
+            self.__logger.warning("cleanup_batch %s : batch marquee pour l'intake, conservee" % batch_id)
+            return
+        self.__cles_batch.pop(batch_id, None)
+        self.__dedup_batch.pop(batch_id, None)
+
+    async def fermer(self):
+        """ Arret de l'application : termine les jobs de chiffrage en cours et ferme le pool de threads """
+        if self.__executor_chiffrage is not None:
+            await asyncio.to_thread(self.__executor_chiffrage.shutdown, True, cancel_futures=True)
+
+    async def marquer_intake_batch(self, batch_id):
+        """
+        Ecrit le marqueur d'intake de la batch lorsque son message est accepte. Les fichiers sont transferes par
+        reprendre_intake_batches() si intake_batch() echoue.
+        """
+        path_upload_batch = path.join(self.__web_app.etat.configuration.dir_staging, 'upload', batch_id)
+        await asyncio.get_running_loop().run_in_executor(
+            self.__executor_chiffrage, ecrire_marqueur_intake, path_upload_batch)
 
     async def intake_batch(self, batch_id):
-        """ Pousse la batch vers l'intake de fichiers """
+        """
+        Pousse la batch vers l'intake de fichiers. Les fichiers sont deplaces vers ready/ en parallele dans le pool
+        de threads. Si le traitement est interrompu, il est repris par reprendre_intake_batches().
+        """
+        if batch_id in self.__intake_en_cours:
+            return  # Transfert deja en cours (reprise)
+        self.__intake_en_cours.add(batch_id)
+        try:
+            with self.__web_app.etat.traceur.span('intake_batch', batch_id=batch_id):
+                await self.__intake_batch(batch_id)
+        finally:
+            self.__intake_en_cours.discard(batch_id)
+
+    async def __intake_batch(self, batch_id):
         dir_staging = self.__web_app.etat.configuration.dir_staging
         path_upload_batch = path.join(dir_staging, 'upload', batch_id)
         path_ready = path.join(dir_staging, 'ready')
 
-        for nom_fichier in listdir(path_upload_batch):
-            if nom_fichier.endswith(".json") is False:
+        loop = asyncio.get_running_loop()
+        executor = self.__executor_chiffrage
+        debut = time.perf_counter()
+
+        # Le marqueur indique que la batch est acceptee et doit etre transferee meme si le traitement est interrompu
+        noms_fichiers = await loop.run_in_executor(executor, debuter_intake_batch, path_upload_batch, path_ready)
+
+        paths_destination = await asyncio.gather(*[
+            loop.run_in_executor(executor, preparer_fichier_intake, path_upload_batch, path_ready, nom_fichier)
+            for nom_fichier in noms_fichiers
+        ])
+        doublons = len([p for p in paths_destination if p is None])
+        if doublons > 0:
+            self.__logger.info("intake_batch %s : %d fichiers deja presents dans ready/ ou transferes" % (
+                batch_id, doublons))
+            paths_destination = [p for p in paths_destination if p is not None]
+
+        # Un seul fsync de repertoire pour la batch
+        await loop.run_in_executor(executor, fsync_repertoire, path_ready)
+
+        # Ajouter les jobs a l'intake de transfert
+        await asyncio.gather(*[self.__web_app.ajouter_upload(p) for p in paths_destination])
+
+        await loop.run_in_executor(executor, shutil.rmtree, path_upload_batch, True)
+
+        self.__web_app.etat.metriques.intake_batch.observer(time.perf_counter() - debut)
+
+        # Les fichiers sont dans ready/, ils peuvent etre reutilises par les prochains posts
+        entrees_dedup = self.__dedup_batch.pop(batch_id, None)
+        if entrees_dedup:
+            for digest, entree in entrees_dedup:
+                self.__index_dedup.ajouter(digest, entree)
+
+    async def reprendre_intake_batches(self):
+        """
+        Reprend les intake_batch interrompus ou en erreur (marqueur present dans le repertoire de la batch).
+        Execute au demarrage et par les taches d'entretien.
+        """
+        dir_staging = self.__web_app.etat.configuration.dir_staging
+        path_upload = path.join(dir_staging, 'upload')
+        try:
+            batch_ids = await asyncio.to_thread(listdir, path_upload)
+        except FileNotFoundError:
+            return
+
+        for batch_id in batch_ids:
+            if batch_id in self.__intake_en_cours:
                 continue
-            with open(path.join(path_upload_batch, nom_fichier), 'rt') as f:
-                info_fichier = json.load(f)
-
-            # Extraire transaction de cles
-            cles = info_fichier['cles']
-            del info_fichier['cles']
-
-            fuuid = info_fichier['hachage']
-            fichier_contenu = path.join(path_upload_batch, fuuid)
-            path_destination_batch = pathlib.Path(path_ready, fuuid)
-            makedirs(path_destination_batch)
-            with open(path.join(path_destination_batch, ConstantesWeb.FICHIER_ETAT), 'wt') as f:
-                json.dump(info_fichier, f)
-            with open(path.join(path_destination_batch, ConstantesWeb.FICHIER_CLES), 'wt') as f:
-                json.dump(cles, f)
-            rename(fichier_contenu, path.join(path_destination_batch, '0.part'))
-
-            # Ajouter job a l'intake de transfert
-            await self.__web_app.ajouter_upload(path_destination_batch)
-
-        shutil.rmtree(path_upload_batch)
+            if path.exists(path.join(path_upload, batch_id, NOM_FICHIER_MARQUEUR_INTAKE)):
+                self.__logger.info("Reprise de intake_batch pour batch_id %s" % batch_id)
+                try:
+                    await self.intake_batch(batch_id)
+                except Exception:
+                    self.__logger.exception("Erreur reprise intake_batch %s" % batch_id)
+
+
+def chiffrer_chunks(cipher: CipherMgs4, fichier: SpoolChiffre, chunks: list[bytes], hacheur=None) -> int:
+    """
+    Chiffre et ecrit une liste de chunks en une seule ecriture. Execute dans le pool de threads.
+    :param hacheur: Hachage du contenu dechiffre (deduplication), optionnel
+    """
+    if hacheur is not None:
+        for chunk in chunks:
+            hacheur.update(chunk)
+    chunks_chiffres = [cipher.update(chunk) for chunk in chunks]
+    return fichier.ecrire(chunks_chiffres)
+
+
+def finaliser_chiffrage(cipher: CipherMgs4, fichier: SpoolChiffre) -> int:
+    chunk_chiffre = cipher.finalize()
+    return fichier.ecrire([chunk_chiffre])
+
+
+def preparer_cles(etat, path_upload: str, cles_pendantes: list[ClePendante]) -> list[str]:
+    """
+    Chiffre les cles secretes de la batch (une passe par certificat), signe une commande ajouterCleDomaines
+    par fichier et ecrit le fichier d'etat de chaque fichier. Execute dans le pool de threads.
+    :return: Liste des cle_id, dans le meme ordre que cles_pendantes
+    """
+    cles_chiffrees = etat.chiffrer_cles_secretes([c.cle_secrete for c in cles_pendantes])
+
+    cles_ids = list()
+    for cle_pendante, cles_chiffrees_fichier in zip(cles_pendantes, cles_chiffrees):
+        signature_domaines = SignatureDomaines.signer_domaines(
+            cle_pendante.cle_secrete, ['Messages'], cle_pendante.cle_peer)
+
+        info_cle = {
+            'signature': signature_domaines.to_dict(),
+            'cles': cles_chiffrees_fichier,
+        }
+        cle_id = signature_domaines.get_cle_ref()
+
+        commande_cles = etat.formatteur_message.signer_message(
+            Constantes.KIND_COMMANDE, info_cle, "MaitreDesCles", True, "ajouterCleDomaines")[0]
+
+        fichier_etat = {
+            'cles': commande_cles,
+            'cle_id': cle_id,
+            'hachage': cle_pendante.fuuid,
+            'slot': cle_pendante.slot,
+            'retry': 0,
+            'created': cle_pendante.created
+        }
+
+        nom_etat = path.join(path_upload, cle_pendante.fuuid + '.json')
+        with open(nom_etat, 'wt') as fichier:
+            json.dump(fichier_etat, fichier)
+
+        cles_ids.append(cle_id)
+
+    return cles_ids
+
+
+def deplacer_fichier(source: str, destination: str):
+    """
+    Deplace un fichier avec rename. Si la destination est sur un autre systeme de fichiers, le contenu est copie
+    avec sendfile (sans passer par l'espace utilisateur).
+    """
+    try:
+        rename(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise e
+
+    path_temp = destination + '.work'
+    with open(source, 'rb') as fichier_source, open(path_temp, 'wb') as fichier_destination:
+        taille = os.fstat(fichier_source.fileno()).st_size
+        position = 0
+        while position < taille:
+            envoye = os.sendfile(fichier_destination.fileno(), fichier_source.fileno(), position, taille - position)
+            if envoye == 0:
+                break
+            position += envoye
+        os.fsync(fichier_destination.fileno())
+    rename(path_temp, destination)
+    unlink(source)
+
+
+def ecrire_marqueur_intake(path_upload_batch: str):
+    """ Ecrit le marqueur d'intake de la batch. Aucun effet si la batch n'a pas de repertoire (aucun fichier). """
+    path_marqueur = path.join(path_upload_batch, NOM_FICHIER_MARQUEUR_INTAKE)
+    if path.exists(path_marqueur) is False and path.isdir(path_upload_batch):
+        ecrire_fichier_atomique(path_marqueur, b'')
+        fsync_repertoire(path_upload_batch)
+
+
+def retirer_batch_non_acceptee(path_upload_batch: str) -> bool:
+    """ :return: False si la batch a un marqueur d'intake (message accepte) et n'a pas ete retiree """
+    if path.exists(path.join(path_upload_batch, NOM_FICHIER_MARQUEUR_INTAKE)):
+        return False
+    shutil.rmtree(path_upload_batch, ignore_errors=True)
+    return True
+
+
+def debuter_intake_batch(path_upload_batch: str, path_ready: str) -> list[str]:
+    """
+    Ecrit le marqueur d'intake de la batch.
+    :return: Noms des fichiers d'etat (.json) de la batch, aucun si la batch n'a pas de repertoire
+    """
+    makedirs(path_ready, exist_ok=True)
+    if path.isdir(path_upload_batch) is False:
+        return list()  # Aucun fichier recu ou batch deja transferee
+    ecrire_marqueur_intake(path_upload_batch)
+
+    return [n for n in listdir(path_upload_batch) if n.endswith('.json')]
+
+
+def preparer_fichier_intake(path_upload_batch: str, path_ready: str, nom_fichier: str) -> Optional[pathlib.Path]:
+    """
+    Place un fichier de la batch dans ready/<fuuid>. Les fichiers de cles et d'etat sont ecrits dans le slot
+    du fichier, puis le slot est renomme vers ready/<fuuid> (un seul rename de repertoire). Chaque etape peut etre
+    refaite si le traitement a ete interrompu.
+    :return: Repertoire de destination a ajouter a l'intake, None si le fuuid est deja dans ready/ (doublon) ou
+             si le fichier a deja ete transfere (reprise)
+    """
+    with open(path.join(path_upload_batch, nom_fichier), 'rt') as f:
+        info_fichier = json.load(f)
+
+    # Extraire transaction de cles
+    cles = info_fichier['cles']
+    del info_fichier['cles']
+    slot = info_fichier.pop('slot', None)
+
+    fuuid = info_fichier['hachage']
+    path_destination = pathlib.Path(path_ready, fuuid)
+    path_etat = path.join(path_destination, ConstantesWeb.FICHIER_ETAT)
+
+    if slot is None:
+        # Batch recue avant le placement par slot
+        return preparer_fichier_intake_fuuid(path_upload_batch, path_destination, fuuid, cles, info_fichier)
+
+    path_slot = path.join(path_upload_batch, slot)
+    if path.exists(path_etat):
+        if path.exists(path_slot):
+            # Le meme contenu est deja dans ready/ : ne pas le placer ni emettre la commande de cles a nouveau
+            shutil.rmtree(path_slot, ignore_errors=True)
+            return None
+        return path_destination  # Deja place (reprise)
+    if path.exists(path_slot) is False:
+        # Place dans ready/ puis consomme par le transfert avant l'interruption : rien a reprendre
+        return None
+
+    ecrire_fichier_atomique(path.join(path_slot, ConstantesWeb.FICHIER_CLES), json.dumps(cles).encode('utf-8'))
+    ecrire_fichier_atomique(path.join(path_slot, ConstantesWeb.FICHIER_ETAT), json.dumps(info_fichier).encode('utf-8'))
+    deplacer_repertoire(path_slot, str(path_destination))
+
+    return path_destination
+
+
+def preparer_fichier_intake_fuuid(path_upload_batch: str, path_destination: pathlib.Path, fuuid: str, cles: dict,
+                                  info_fichier: dict) -> Optional[pathlib.Path]:
+    """ Deplace un fichier upload/<batch_id>/<fuuid> vers ready/<fuuid>/0.part (batches sans slot). """
+    path_etat = path.join(path_destination, ConstantesWeb.FICHIER_ETAT)
+    if path.exists(path_etat):
+        return path_destination  # Deja complete (reprise)
+    fichier_contenu = path.join(path_upload_batch, fuuid)
+    if path.exists(fichier_contenu) is False and path.exists(path_destination) is False:
+        return None  # Deja transfere puis retire de ready/ (reprise)
+
+    makedirs(path_destination, exist_ok=True)
+    ecrire_fichier_atomique(path.join(path_destination, ConstantesWeb.FICHIER_CLES), json.dumps(cles).encode('utf-8'))
+
+    path_part = path.join(path_destination, NOM_FICHIER_CONTENU)
+    try:
+        deplacer_fichier(fichier_contenu, path_part)
+    except FileNotFoundError:
+        if path.exists(path_part) is False:
+            raise  # Contenu perdu
+
+    ecrire_fichier_atomique(path_etat, json.dumps(info_fichier).encode('utf-8'))
+
+    return path_destination
+
+
+def deplacer_repertoire(source: str, destination: str):
+    """
+    Deplace un repertoire avec rename. Si la destination est sur un autre systeme de fichiers, les fichiers sont
+    deplaces un a un (deplacer_fichier), le fichier d'etat en dernier.
+    """
+    try:
+        rename(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise e
+
+    makedirs(destination, exist_ok=True)
+    noms_fichiers = sorted(listdir(source), key=lambda n: n == ConstantesWeb.FICHIER_ETAT)
+    for nom_fichier in noms_fichiers:
+        deplacer_fichier(path.join(source, nom_fichier), path.join(destination, nom_fichier))
+    shutil.rmtree(source, ignore_errors=True)
+
+
+def ecrire_fichier_atomique(path_fichier: str, contenu: bytes):
+    """ Ecrit un fichier temporaire, fsync et rename vers path_fichier. """
+    path_temp = path_fichier + '.work'
+    with open(path_temp, 'wb') as f:
+        f.write(contenu)
+        f.flush()
+        os.fsync(f.fileno())
+    rename(path_temp, path_fichier)
+
+
+def fsync_repertoire(path_repertoire: str):
+    fd = os.open(path_repertoire, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def lister_batches_staging(path_upload: str) -> list[InfoBatchStaging]:
+    """ :return: Batches du repertoire upload avec leur date de creation """
+    batches = list()
+    try:
+        entrees = list(os.scandir(path_upload))
+    except FileNotFoundError:
+        return batches
+
+    for entree in entrees:
+        if entree.is_dir() is False:
+            continue
+        created = None
+        intake = False
+        try:
+            for fichier in os.scandir(entree.path):
+                if fichier.name == NOM_FICHIER_MARQUEUR_INTAKE:
+                    intake = True
+                elif created is None and fichier.name.endswith('.json'):
+                    try:
+                        with open(fichier.path, 'rt') as f:
+                            created = json.load(f)['created']
+                    except (ValueError, KeyError, OSError):
+                        pass
+            if created is None:
+                created = entree.stat().st_mtime
+        except FileNotFoundError:
+            continue  # Retire pendant le parcours
+        batches.append(InfoBatchStaging(entree.name, entree.path, created, intake))
+
+    return batches
+
+
+def supprimer_fichier(path_fichier: str) -> int:
+    """ :return: Taille du fichier retire """
+    try:
+        taille = os.stat(path_fichier).st_size
+        unlink(path_fichier)
+        return taille
+    except FileNotFoundError:
+        return 0
+
+
+def supprimer_repertoire(path_repertoire: str) -> int:
+    """ :return: Taille des fichiers retires """
+    taille = 0
+    for repertoire, _sous_repertoires, fichiers in os.walk(path_repertoire):
+        for fichier in fichiers:
+            try:
+                taille += os.stat(path.join(repertoire, fichier)).st_size
+            except FileNotFoundError:
+                pass
+    shutil.rmtree(path_repertoire, ignore_errors=True)
+    return taille
@@ -0,0 +1,48 @@
+from typing import AsyncIterable, AsyncIterator
+
+
+class BatchTropGrosse(Exception):
+    pass
+
+
+async def iterer_ndjson(chunks: AsyncIterable[bytes], taille_max: int, messages_max: int,
+                        taille_max_message: int) -> AsyncIterator[tuple[int, bytes]]:
+    """
+    Decoupe un flux NDJSON en lignes au fur et a mesure de la reception. Les lignes vides sont ignorees.
+    :param chunks: Contenu recu (ex. request.content.iter_any())
+    :param taille_max: Taille maximale du flux en bytes
+    :param messages_max: Nombre maximal de lignes
+    :param taille_max_message: Taille maximale d'une ligne en bytes
+    :raises BatchTropGrosse: Body, ligne ou nombre de messages au-dela des limites
+    """
+    tampon = bytearray()
+    taille_totale = 0
+    index = 0
+    async for chunk in chunks:
+        taille_totale += len(chunk)
+        if taille_totale > taille_max:
+            raise BatchTropGrosse('batch trop grosse (max %d bytes)' % taille_max)
+        tampon.extend(chunk)
+
+        debut = 0
+        while True:
+            fin = tampon.find(b'\n', debut)
+            if fin == -1:
+                break
+            ligne = bytes(tampon[debut:fin]).strip()
+            debut = fin + 1
+            if ligne:
+                if index >= messages_max:
+                    raise BatchTropGrosse('trop de messages (max %d)' % messages_max)
+                yield index, ligne
+                index += 1
+        del tampon[:debut]
+
+        if len(tampon) > taille_max_message:
+            raise BatchTropGrosse('message trop gros (max %d bytes)' % taille_max_message)
+
+    ligne = bytes(tampon).strip()
+    if ligne:
+        if index >= messages_max:
+            raise BatchTropGrosse('trop de messages (max %d)' % messages_max)
+        yield index, ligne
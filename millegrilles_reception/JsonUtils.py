@@ -0,0 +1,20 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Optionnel, json est utilise par defaut
+
+
+def json_loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(data) -> str:
+    if orjson is not None:
+        # Les cles des headers aiohttp (dict(request.headers)) sont des multidict.istr, refusees sans
+        # OPT_NON_STR_KEYS
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(data)
@@ -0,0 +1,193 @@
+import ipaddress
+import time
+
+from collections import OrderedDict
+from typing import Iterable, Optional, Union
+
+from aiohttp import web
+from aiohttp.web_request import Request
+
+
+class LimiteurGcra:
+    """
+    Limiteur de debit GCRA (generic cell rate algorithm) par cle. Conserve uniquement l'heure theorique d'arrivee
+    (TAT) de chaque cle, les cles inactives sont retirees en ordre LRU.
+    """
+
+    def __init__(self, taux: float, rafale: float, nombre_cles_max: int):
+        """
+        :param taux: Unites par seconde
+        :param rafale: Nombre d'unites pouvant etre consommees d'un coup
+        :param nombre_cles_max: Nombre maximal de cles conservees
+        """
+        self.__intervalle = 1.0 / taux
+        self.__tolerance = self.__intervalle * rafale
+        self.__nombre_cles_max = nombre_cles_max
+        self.__tat: OrderedDict[str, float] = OrderedDict()
+
+        self.__acceptes = 0
+        self.__refuses = 0
+
+    def verifier(self, cle: str, cout: float = 1.0) -> Optional[float]:
+        """
+        Consomme cout unites pour la cle.
+        :return: None si accepte, sinon le nombre de secondes a attendre
+        """
+        now = time.monotonic()
+        tat = self.__tat.get(cle)
+        if tat is None or tat < now:
+            tat = now
+
+        nouveau_tat = tat + self.__intervalle * cout
+        attente = nouveau_tat - self.__tolerance - now
+        if attente > 0:
+            self.__refuses += 1
+            return attente
+
+        self.__tat[cle] = nouveau_tat
+        self.__tat.move_to_end(cle)
+        if len(self.__tat) > self.__nombre_cles_max:
+            self.__tat.popitem(last=False)
+
+        self.__acceptes += 1
+        return None
+
+    def consommer(self, cle: str, cout: float):
+        """ Consomme cout unites deja recues pour la cle, sans refus. Les prochaines requetes attendent la dette. """
+        now = time.monotonic()
+        tat = self.__tat.get(cle)
+        if tat is None or tat < now:
+            tat = now
+
+        self.__tat[cle] = tat + self.__intervalle * cout
+        self.__tat.move_to_end(cle)
+        if len(self.__tat) > self.__nombre_cles_max:
+            self.__tat.popitem(last=False)
+
+    def get_metriques(self) -> dict:
+        return {'cles': len(self.__tat), 'acceptes': self.__acceptes, 'refuses': self.__refuses}
+
+
+Reseau = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+def parse_reseaux(adresses: Iterable[str]) -> list[Reseau]:
+    """ :param adresses: Adresses ou reseaux (CIDR) """
+    return [ipaddress.ip_network(a.strip(), strict=False) for a in adresses if a.strip()]
+
+
+def dans_reseaux(adresse: str, reseaux: list[Reseau]) -> bool:
+    try:
+        ip = ipaddress.ip_address(adresse)
+    except ValueError:
+        return False
+    return any(ip in reseau for reseau in reseaux)
+
+
+def get_adresse_client(request: Request, proxies_confiance: list[Reseau]) -> str:
+    """
+    Adresse du client. X-Forwarded-For est utilise seulement si la connexion provient d'un proxy de confiance : les
+    hops sont lus de droite a gauche, la premiere adresse qui n'est pas un proxy de confiance est retenue. Les
+    entrees de gauche (et X-Real-IP) sont fournies par le client et ne sont pas utilisees.
+    """
+    adresse = request.remote or ''
+    if len(proxies_confiance) == 0 or dans_reseaux(adresse, proxies_confiance) is False:
+        return adresse
+
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if forwarded_for:
+        for hop in reversed(forwarded_for.split(',')):
+            hop = hop.strip()
+            if hop == '':
+                continue
+            adresse = hop
+            if dans_reseaux(hop, proxies_confiance) is False:
+                break
+
+    return adresse
+
+
+class LimiteurDebitReception:
+    """
+    Middleware aiohttp qui limite le nombre de requetes et le volume des posts multipart par client. Le refus
+    (HTTP 429) est fait avant la lecture du body. Le volume est compte selon Content-Length, ou selon les bytes
+    effectivement recus pour les posts sans Content-Length (chunked) : la requete est acceptee si le client n'a
+    pas de dette et les bytes recus sont consommes a la fin.
+    """
+
+    def __init__(self, configuration, paths: list[str], paths_lots: Iterable[str] = ()):
+        """
+        :param paths: Paths limites, un jeton par requete
+        :param paths_lots: Paths de soumission en lot, un jeton par message (verifier_messages). Le middleware
+                           refuse seulement les clients deja au-dela de leur limite.
+        """
+        self.__paths_lots = set(paths_lots)
+        self.__paths = set(paths) | self.__paths_lots
+        self.__proxies_confiance = parse_reseaux(configuration.limite_proxies_confiance)
+
+        nombre_cles_max = configuration.limite_cles_max
+        self.__limiteur_requetes: Optional[LimiteurGcra] = None
+        if configuration.limite_requetes_taux > 0:
+            self.__limiteur_requetes = LimiteurGcra(
+                configuration.limite_requetes_taux, configuration.limite_requetes_rafale, nombre_cles_max)
+
+        self.__limiteur_bytes: Optional[LimiteurGcra] = None
+        if configuration.limite_bytes_taux > 0:
+            self.__limiteur_bytes = LimiteurGcra(
+                configuration.limite_bytes_taux, configuration.limite_bytes_rafale, nombre_cles_max)
+
+    @web.middleware
+    async def middleware(self, request: Request, handler):
+        if request.method == 'POST' and request.path in self.__paths:
+            attente = self.verifier(request)
+            if attente is not None:
+                return web.HTTPTooManyRequests(headers={'Retry-After': str(int(attente) + 1)})
+
+            if self.__limiteur_bytes is not None and request.content_length is None \
+                    and request.content_type.startswith('multipart'):
+                try:
+                    return await handler(request)
+                finally:
+                    # Body chunked : consommer les bytes recus, incluant une reception interrompue
+                    self.__limiteur_bytes.consommer(self.get_adresse_client(request), request.content.total_bytes)
+
+        return await handler(request)
+
+    def get_adresse_client(self, request: Request) -> str:
+        return get_adresse_client(request, self.__proxies_confiance)
+
+    def verifier(self, request: Request) -> Optional[float]:
+        """ :return: None si la requete est acceptee, sinon le nombre de secondes a attendre """
+        adresse = self.get_adresse_client(request)
+
+        if self.__limiteur_requetes is not None:
+            cout = 0.0 if request.path in self.__paths_lots else 1.0
+            attente = self.__limiteur_requetes.verifier(adresse, cout)
+            if attente is not None:
+                return attente
+
+        if self.__limiteur_bytes is not None and request.content_type.startswith('multipart'):
+            # Sans Content-Length, verifier seulement la dette du client (bytes consommes a la fin du post)
+            taille = request.content_length or 0
+            attente = self.__limiteur_bytes.verifier(adresse, taille)
+            if attente is not None:
+                return attente
+
+        return None
+
+    def verifier_messages(self, request: Request, nombre: int = 1) -> Optional[float]:
+        """
+        Consomme un jeton par message d'un lot.
+        :return: None si les messages sont acceptes, sinon le nombre de secondes a attendre
+        """
+        if self.__limiteur_requetes is None:
+            return None
+        return self.__limiteur_requetes.verifier(self.get_adresse_client(request), nombre)
+
+    def get_metriques(self) -> dict:
+        metriques = dict()
+        if self.__limiteur_requetes is not None:
+            metriques['requetes'] = self.__limiteur_requetes.get_metriques()
+        if self.__limiteur_bytes is not None:
+            metriques['bytes'] = self.__limiteur_bytes.get_metriques()
+        return metriques
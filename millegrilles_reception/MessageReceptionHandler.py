@@ -2,6 +2,7 @@ import asyncio
 import datetime
 import json
 import logging
+import time
 import uuid
 import shutil
 
@@ -10,7 +11,55 @@ from aiohttp.web_request import Request
 from typing import Optional
 
 from millegrilles_messages.messages import Constantes
+from millegrilles_reception import Constantes as ConstantesReception
+from millegrilles_reception.ControleAdmission import ControleAdmission, RefusAdmission
+from millegrilles_reception.DispatcherMessages import DispatcherMessages
 from millegrilles_reception.EtatReception import EtatReception
+from millegrilles_reception.FichiersDechiffresHandler import FichierTropGros
+from millegrilles_reception.JsonUtils import orjson, json_loads, json_dumps
+
+
+class MessageInvalide(Exception):
+    pass
+
+
+class MessageTropGros(Exception):
+    pass
+
+
+async def lire_body(request: Request, taille_max: int) -> bytes:
+    """
+    Lit le body de la requete en verifiant la taille maximale au fur et a mesure.
+    :raises MessageTropGros: Si le body depasse taille_max
+    """
+    content_length = request.content_length
+    if content_length is not None and content_length > taille_max:
+        raise MessageTropGros()
+
+    body = bytearray()
+    async for chunk in request.content.iter_any():
+        body.extend(chunk)
+        if len(body) > taille_max:
+            raise MessageTropGros()
+
+    return bytes(body)
+
+
+async def lire_field(field, taille_max: int) -> bytes:
+    """
+    Lit une part multipart en verifiant la taille maximale au fur et a mesure.
+    :raises MessageTropGros: Si la part depasse taille_max
+    """
+    body = bytearray()
+    while True:
+        chunk = await field.read_chunk()
+        if not chunk:
+            break
+        body.extend(chunk)
+        if len(body) > taille_max:
+            raise MessageTropGros()
+
+    return field.decode(bytes(body))
 
 
 class MessagePrepare:
@@ -24,6 +73,9 @@ class MessagePrepare:
 
     @staticmethod
     def parse(message_recu: dict):
+        if not isinstance(message_recu, dict):
+            raise MessageInvalide('message invalide')
+
         message = MessagePrepare()
 
         if message_recu.get('sig'):
@@ -38,7 +90,10 @@ class MessagePrepare:
         raise NotImplementedError("todo")
 
     def parse_dechiffre(self, message_recu: dict):
-        self.contenu = message_recu['contenu']
+        contenu = message_recu.get('contenu')
+        if not isinstance(contenu, str):
+            raise MessageInvalide('contenu invalide')
+        self.contenu = contenu
 
         user_id = message_recu.get('user_id')
         if user_id is not None:
@@ -47,18 +102,25 @@ class MessagePrepare:
             elif isinstance(user_id, list):
                 self.user_id = user_id
             else:
-                raise Exception('user_id invalide')
+                raise MessageInvalide('user_id invalide')
 
-        destinataire = message_recu['destinataires']
+        destinataire = message_recu.get('destinataires')
         if isinstance(destinataire, str):
             self.destinataires = [destinataire]
-        elif isinstance(destinataire, list):
+        elif isinstance(destinataire, list) and all(isinstance(d, str) for d in destinataire):
             self.destinataires = destinataire
         else:
-            raise Exception('destinataire invalide')
+            raise MessageInvalide('destinataire invalide')
 
-        self.reply_to = message_recu.get('reply_to')
-        self.auteur = message_recu.get('auteur')
+        reply_to = message_recu.get('reply_to')
+        if reply_to is not None and not isinstance(reply_to, str):
+            raise MessageInvalide('reply_to invalide')
+        self.reply_to = reply_to
+
+        auteur = message_recu.get('auteur')
+        if auteur is not None and not isinstance(auteur, str):
+            raise MessageInvalide('auteur invalide')
+        self.auteur = auteur
 
         self.date_post = int(datetime.datetime.utcnow().timestamp())
 
@@ -82,6 +144,7 @@ class MessagePrepare:
         if self.auteur:
             message_dechiffre['auteur'] = self.auteur
 
+        # Coroutine du formatteur, executee dans la boucle de l'application
         certificats_chiffrage = etat.get_certificats_chiffrage()
         message_chiffre = await etat.formatteur_message.chiffrer_message(
             certificats_chiffrage, 8, message_dechiffre, Constantes.DOMAINE_MESSAGES, 'posterV1')
@@ -89,6 +152,10 @@ class MessagePrepare:
         return message_chiffre
 
 
+MODE_ACK_SYNC = 'sync'
+MODE_ACK_ASYNC = 'async'
+
+
 class MessageReceptionHandler:
 
     def __init__(self, web_app):
@@ -96,88 +163,293 @@ class MessageReceptionHandler:
         self.__web_app = web_app
         self.__etat = web_app.etat
 
-        self.__semaphore_messages = asyncio.BoundedSemaphore(value=3)
+        self.__metriques = self.__etat.metriques
+        self.__traceur = self.__etat.traceur
+        self.__admission = ControleAdmission(self.__etat.configuration_reception, self.__metriques)
+        self.__taille_max_message = self.__etat.configuration_reception.message_taille_max
+        self.__mode_async = self.__etat.configuration_reception.mode_ack == MODE_ACK_ASYNC
+        self.__absorber_erreurs_mq = self.__etat.configuration_reception.outbox_absorber
 
-    async def recevoir_post_web(self, request: Request):
-        batch_id = str(uuid.uuid4())
-        fichiers_traites = None
+        self.__multipart_taille_max = self.__etat.configuration_reception.multipart_taille_max
+        self.__fichier_taille_max = self.__etat.configuration_reception.fichier_taille_max
+        self.__fichiers_max = self.__etat.configuration_reception.fichiers_max
+        self.__message_avant_fichiers = self.__etat.configuration_reception.message_avant_fichiers
 
-        async with self.__semaphore_messages:
-            headers_web = dict(request.headers)
-            self.__logger.debug("Reception recevoir_post_web headers:\n%s" % json.dumps(headers_web, indent=2))
+        self.__dispatcher = DispatcherMessages(web_app)
 
-            if request.content_type.startswith('multipart'):
-                # On recoit un message avec des fichiers attaches
-                reader = await request.multipart()
-
-                message_post = dict()
-                fichiers_traites = list()
-
-                async for field in reader:
-                    if field.name == 'files[]':
-                        fichier_traiter = await self.__web_app.fichiers_dechiffres_handler.recevoir_fichier(batch_id, field)
-                        fichiers_traites.append(fichier_traiter)
-                    elif field.name == 'message':
-                        message_post = await field.read(decode=True)
-                        message_post = json.loads(message_post.decode('utf-8'))
-                    else:
-                        return web.HTTPBadRequest(reason="champ non supporte, utiliser files[] et message")
-            elif request.content_type == 'application/json':
-                message_post = await request.json()
-                # Desactiver traitement fichiers (aucuns recus)
-                batch_id = None
-                fichiers_traites = None
-            else:
-                return web.HTTPBadRequest(reason="mimetype non supporte")
+    async def setup(self):
+        await self.__dispatcher.setup()
 
-            try:
-                origine = json.dumps(headers_web)
+    async def run(self, stop_event: asyncio.Event):
+        await self.__dispatcher.run(stop_event)
+
+    async def recevoir_post_web(self, request: Request):
+        code = 500
+        try:
+            with self.__traceur.trace('reception.post', content_type=request.content_type) as trace:
+                reponse = await self.__recevoir_post_web(request)
+                code = reponse.status
+                if trace is not None:
+                    trace.attributs['code'] = code
+            return reponse
+        finally:
+            self.__metriques.compter_post(request.content_type, code)
+
+    async def __recevoir_post_web(self, request: Request):
+        if request.content_type == 'application/json':
+            return await self.recevoir_post_json(request)
+        elif request.content_type.startswith('multipart') is False:
+            return web.HTTPBadRequest(reason="mimetype non supporte")
+
+        # Refuser le post avant la lecture du body si la taille annoncee depasse la limite
+        content_length = request.content_length
+        if content_length is not None and content_length > self.__multipart_taille_max:
+            return web.HTTPRequestEntityTooLarge(self.__multipart_taille_max, content_length)
+
+        try:
+            async with self.__admission.voie_multipart.admettre():
+                batch_id = str(uuid.uuid4())
+                self.__traceur.ajouter_attributs(batch_id=batch_id)
+                try:
+                    return await self.__recevoir_multipart(request, batch_id)
+                except Exception as e:
+                    # Reception interrompue (e.g. connexion fermee), retirer les fichiers deja recus
+                    await self.__web_app.fichiers_dechiffres_handler.cleanup_batch(batch_id)
+                    raise e
+        except RefusAdmission:
+            return self.__reponse_surcharge()
+
+    async def __recevoir_multipart(self, request: Request, batch_id: str):
+        """
+        Reception d'un message avec des fichiers attaches. Les limites sont verifiees au fur et a mesure de la
+        reception des parts : le post est refuse (413/400) des qu'une limite est depassee ou que le message est
+        invalide, sans chiffrer le reste des fichiers.
+        """
+        try:
+            with self.__traceur.span('multipart.lecture'):
+                message_prepare, fichiers_traites = await self.__lire_parts_multipart(request, batch_id)
+        except (MessageTropGros, FichierTropGros):
+            await self.__web_app.fichiers_dechiffres_handler.cleanup_batch(batch_id)
+            return web.HTTPRequestEntityTooLarge(self.__multipart_taille_max, request.content_length or 0)
+        except MessageInvalide as e:
+            await self.__web_app.fichiers_dechiffres_handler.cleanup_batch(batch_id)
+            return web.HTTPBadRequest(reason=str(e))
+
+        if len(fichiers_traites) > 0:
+            # Chiffrer et signer les cles de tous les fichiers de la batch en une passe
+            with self.__traceur.span('fichiers.cles', fichiers=len(fichiers_traites)):
+                await self.__web_app.fichiers_dechiffres_handler.preparer_cles_batch(batch_id)
+
+        return await self.__traiter_message(request, message_prepare, batch_id, fichiers_traites)
+
+    async def __lire_parts_multipart(self, request: Request, batch_id: str):
+        """
+        :return: Message prepare, liste des fichiers recus
+        :raises MessageTropGros: La part message ou le post depasse sa taille maximale
+        :raises FichierTropGros: Un fichier depasse sa taille maximale ou celle restante pour le post
+        :raises MessageInvalide: Part non supportee, nombre de fichiers depasse, message absent ou invalide
+        """
+        fichiers_handler = self.__web_app.fichiers_dechiffres_handler
+        reader = await request.multipart()
+
+        message_prepare: Optional[MessagePrepare] = None
+        fichiers_traites = list()
+        taille_recue = 0
+
+        async for field in reader:
+            if field.name == 'files[]':
+                if message_prepare is None and self.__message_avant_fichiers:
+                    raise MessageInvalide("la part message doit preceder les fichiers")
+                if len(fichiers_traites) >= self.__fichiers_max:
+                    raise MessageInvalide("nombre de fichiers maximal (%d) depasse" % self.__fichiers_max)
+
+                taille_restante = self.__multipart_taille_max - taille_recue
+                taille_max = min(self.__fichier_taille_max, taille_restante)
+                fichier_traite = await fichiers_handler.recevoir_fichier(batch_id, field, taille_max)
+                fichiers_traites.append(fichier_traite)
+                taille_recue += fichier_traite['taille_dechiffre']
+            elif field.name == 'message':
+                if message_prepare is not None:
+                    raise MessageInvalide("part message recue plusieurs fois")
+                body = await lire_field(field, self.__taille_max_message)
+                taille_recue += len(body)
+                try:
+                    message_post = json_loads(body)
+                except ValueError:
+                    raise MessageInvalide("json invalide")
+                # Valider immediatement, les fichiers suivants ne sont pas chiffres si le message est invalide
                 message_prepare = MessagePrepare.parse(message_post)
-                return await self.submit_message(message_prepare, {'origine': origine}, batch_id, fichiers_traites)
-            except asyncio.TimeoutError:
-                self.__logger.error("Timeout error sur posterV1")
-                return web.HTTPInternalServerError()
-            except Exception:
-                self.__logger.exception("Exception sur posterV1")
-                return web.HTTPInternalServerError()
+            else:
+                raise MessageInvalide("champ non supporte, utiliser files[] et message")
 
-        # shutil.rmtree()
+        if message_prepare is None:
+            raise MessageInvalide("part message manquante")
 
-    async def submit_message(self, message_prepare: MessagePrepare, headers_web: dict,
-                             fichiers_batch_id: Optional[str] = None, fichiers_traites: Optional[list] = None):
-        producer = await asyncio.wait_for(self.__etat.producer_wait(), 5)
+        return message_prepare, fichiers_traites
+
+    async def recevoir_post_json(self, request: Request):
+        """
+        Traitement rapide d'un message sans fichiers (application/json).
+        """
+        try:
+            async with self.__admission.voie_json.admettre():
+                return await self.__recevoir_json(request)
+        except RefusAdmission:
+            return self.__reponse_surcharge()
+
+    async def __recevoir_json(self, request: Request):
+        try:
+            body = await lire_body(request, self.__taille_max_message)
+        except MessageTropGros:
+            return web.HTTPRequestEntityTooLarge(self.__taille_max_message, request.content_length or 0)
 
-        if producer is None:
-            raise Exception('producer non pret')
+        try:
+            message_post = json_loads(body)
+            message_prepare = MessagePrepare.parse(message_post)
+        except ValueError:
+            return web.HTTPBadRequest(reason="json invalide")
+        except MessageInvalide as e:
+            return web.HTTPBadRequest(reason=str(e))
+
+        # Desactiver traitement fichiers (aucuns recus)
+        return await self.__traiter_message(request, message_prepare, None, None)
+
+    async def __traiter_message(self, request: Request, message_prepare: MessagePrepare,
+                                batch_id: Optional[str], fichiers_traites: Optional[list]):
+        headers_web = dict(request.headers)
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug("Reception recevoir_post_web headers:\n%s" % json.dumps(headers_web, indent=2))
+
+        # Mode asynchrone : configure pour tous les messages ou demande par le client (Prefer: respond-async)
+        mode_async = self.__mode_async or 'respond-async' in request.headers.get('Prefer', '')
 
+        try:
+            origine = json_dumps(headers_web)
+            return await self.submit_message(message_prepare, {'origine': origine}, batch_id, fichiers_traites,
+                                             mode_async=mode_async)
+        except asyncio.TimeoutError:
+            self.__logger.error("Timeout error sur posterV1")
+        except Exception:
+            self.__logger.exception("Exception sur posterV1")
+
+        # Le message n'a pas ete accepte (submit_message ne leve plus d'erreur apres posterV1), retirer les fichiers
+        # recus. Une batch marquee pour l'intake n'est pas retiree par cleanup_batch.
+        if batch_id is not None:
+            await self.__web_app.fichiers_dechiffres_handler.cleanup_batch(batch_id)
+
+        return web.HTTPInternalServerError()
+
+    def __reponse_surcharge(self):
+        """ HTTP 503 : La file d'admission est pleine ou l'attente a expire """
+        return web.HTTPServiceUnavailable(headers={'Retry-After': str(self.__admission.retry_after)})
+
+    async def __soumettre_outbox(self, message_chiffre: dict, message_id: str, batch_id: Optional[str]):
+        etat_message = await self.__dispatcher.soumettre(message_chiffre, message_id, batch_id)
+        reponse = {'ok': True, 'id': message_id, 'etat': etat_message['etat']}
+        headers = {'Location': f'{ConstantesReception.WEB_APP_PATH}/message/{message_id}'}
+        # HTTP 202 : Message accepte, traitement en cours
+        return web.HTTPAccepted(body=json_dumps(reponse), headers=headers)
+
+    async def emettre_posterv1(self, producer, message_chiffre: dict, message_id: str) -> dict:
+        """
+        Emet la commande posterV1 et attend la reponse du domaine Messages.
+        :return: Reponse parsed
+        """
+        rk = ['commande', Constantes.DOMAINE_MESSAGES, 'posterV1']
+        debut = time.perf_counter()
+        with self.__traceur.span('mq.emettre_attendre', correlation_id=message_id):
+            reponse = await producer.emettre_attendre(
+                json_dumps(message_chiffre), '.'.join(rk),
+                exchange=Constantes.SECURITE_PUBLIC,
+                correlation_id=message_id,
+                timeout=10
+            )
+        self.__metriques.emettre_attendre.observer(time.perf_counter() - debut, ('sync',))
+
+        reponse_parsed = reponse.parsed
+        del reponse_parsed['__original']
+        return reponse_parsed
+
+    async def __intake_batch(self, batch_id: str):
+        """
+        Transfere les fichiers d'un message accepte. Les erreurs ne sont pas retournees au client : le message est
+        livre, un nouveau post serait un doublon. La batch marquee est reprise par reprendre_intake_batches().
+        """
+        fichiers_handler = self.__web_app.fichiers_dechiffres_handler
+        self.__logger.info("submit_message Submit consignation fichiers batch_id %s" % batch_id)
+        try:
+            await fichiers_handler.marquer_intake_batch(batch_id)
+        except Exception:
+            self.__logger.exception("submit_message Erreur marqueur intake batch %s" % batch_id)
+        try:
+            await fichiers_handler.intake_batch(batch_id)
+        except Exception:
+            self.__logger.exception("submit_message Erreur intake_batch %s, reprise par le marqueur" % batch_id)
+
+    async def get_etat_message(self, request: Request):
+        message_id = request.match_info['message_id']
+        etat_message = await self.__dispatcher.get_etat(message_id)
+        if etat_message is None:
+            return web.HTTPNotFound()
+        reponse = {'id': message_id}
+        reponse.update(etat_message)
+        return web.json_response(reponse, headers={'Cache-Control': 'no-store'})
+
+    @property
+    def dispatcher(self) -> DispatcherMessages:
+        return self.__dispatcher
+
+    @property
+    def admission(self) -> ControleAdmission:
+        return self.__admission
+
+    def get_metriques_admission(self) -> dict:
+        return self.__admission.get_metriques()
+
+    async def submit_message(self, message_prepare: MessagePrepare, headers_web: dict,
+                             fichiers_batch_id: Optional[str] = None, fichiers_traites: Optional[list] = None,
+                             mode_async=False):
         try:
             additionnel = headers_web.copy()
             if fichiers_traites is not None and len(fichiers_traites) > 0:
                 additionnel['fichiers'] = fichiers_traites
-            message_chiffre, message_id = await message_prepare.generer(self.__etat, additionnel)
+            debut = time.perf_counter()
+            with self.__traceur.span('message.chiffrer'):
+                message_chiffre, message_id = await message_prepare.generer(self.__etat, additionnel)
+            self.__metriques.chiffrer_message.observer(time.perf_counter() - debut)
+            self.__traceur.ajouter_attributs(correlation_id=message_id)
         except KeyError:
             return web.HTTPOk(body=json.dumps({'ok': False, 'code': 2, 'err': 'Cles de chiffrage non recues, reessayer dans 30 secondes'}))
 
-        message_bytes = json.dumps(message_chiffre)
+        if mode_async:
+            # Le message est conserve localement et emis en arriere-plan
+            with self.__traceur.span('outbox.ajouter'):
+                return await self.__soumettre_outbox(message_chiffre, message_id, fichiers_batch_id)
 
-        rk = ['commande', Constantes.DOMAINE_MESSAGES, 'posterV1']
-        reponse = await producer.emettre_attendre(
-            message_bytes, '.'.join(rk),
-            exchange=Constantes.SECURITE_PUBLIC,
-            correlation_id=message_id,
-            timeout=10
-        )
-
-        reponse_parsed = reponse.parsed
-        del reponse_parsed['__original']
+        try:
+            debut = time.perf_counter()
+            with self.__traceur.span('producer.attente'):
+                producer = await asyncio.wait_for(self.__etat.producer_wait(), 5)
+            self.__metriques.attente_producer.observer(time.perf_counter() - debut)
+
+            if producer is None:
+                raise Exception('producer non pret')
+
+            reponse_parsed = await self.emettre_posterv1(producer, message_chiffre, message_id)
+        except Exception as e:
+            if self.__absorber_erreurs_mq is False:
+                raise e
+            # MQ non disponible : conserver le message dans l'outbox, il sera emis lorsque MQ sera pret
+            self.__logger.warning("submit_message Erreur emission posterV1 (%s), message %s conserve dans l'outbox" % (
+                str(e), message_id))
+            return await self.__soumettre_outbox(message_chiffre, message_id, fichiers_batch_id)
 
         if reponse_parsed.get('ok') is True:
             if fichiers_batch_id is not None:
-                self.__logger.info("submit_message Submit consignation fichiers batch_id %s" % fichiers_batch_id)
-                await self.__web_app.fichiers_dechiffres_handler.intake_batch(fichiers_batch_id)
+                await self.__intake_batch(fichiers_batch_id)
 
             # HTTP 201 : Indiquer que le message a ete cree
-            return web.HTTPCreated(body=json.dumps(reponse_parsed))
+            return web.HTTPCreated(body=json_dumps(reponse_parsed))
         else:
             # HTTP 200 : Indique un resultat en erreur
-            return web.HTTPOk(body=json.dumps(reponse_parsed))
+            return web.HTTPOk(body=json_dumps(reponse_parsed))
@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+from aiohttp.web_request import Request
+from typing import AsyncIterator, Optional, Union
+
+from millegrilles_reception.ControleAdmission import RefusAdmission
+from millegrilles_reception.FluxNdjson import BatchTropGrosse, iterer_ndjson
+from millegrilles_reception.LimiteurDebit import LimiteurDebitReception
+from millegrilles_reception.MessageReceptionHandler import MessageReceptionHandler, MessagePrepare, \
+    MessageInvalide, MessageTropGros, MODE_ACK_ASYNC, json_dumps, json_loads, lire_body
+
+CONTENT_TYPE_NDJSON = 'application/x-ndjson'
+
+
+class MessagesBatchHandler:
+    """
+    Soumission de messages en lot (POST /reception/messages/batch). Le body est une liste JSON ou un flux NDJSON
+    (un message par ligne). Les messages sont valides et chiffres en parallele, puis emis sur le meme producer avec
+    un nombre borne de correlations en attente. Le resultat de chaque message est retourne en NDJSON au fur et a
+    mesure : {"index", "code", "ok", "id", "err"}.
+
+    Les lots ont leur propre voie d'admission. La limite de debit par client consomme un jeton par message : les
+    messages au-dela de la limite ne sont pas traites, une ligne 429 (retry_after) termine le resultat.
+    """
+
+    def __init__(self, etat, messages_handler: MessageReceptionHandler,
+                 limiteur_debit: Optional[LimiteurDebitReception] = None):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__etat = etat
+        self.__messages_handler = messages_handler
+        self.__limiteur_debit = limiteur_debit
+
+        configuration = etat.configuration_reception
+        self.__metriques = etat.metriques
+        self.__traceur = etat.traceur
+        self.__messages_max = configuration.batch_messages_max
+        self.__taille_max = configuration.batch_taille_max
+        self.__concurrence = configuration.batch_concurrence
+        self.__taille_max_message = configuration.message_taille_max
+        self.__mode_async = configuration.mode_ack == MODE_ACK_ASYNC
+        self.__absorber_erreurs_mq = configuration.outbox_absorber
+
+    async def recevoir_post_batch(self, request: Request):
+        code = 500
+        try:
+            with self.__traceur.trace('reception.batch', content_type=request.content_type) as trace:
+                try:
+                    async with self.__messages_handler.admission.voie_batch.admettre():
+                        reponse = await self.__recevoir_batch(request)
+                except RefusAdmission:
+                    admission = self.__messages_handler.admission
+                    reponse = web.HTTPServiceUnavailable(headers={'Retry-After': str(admission.retry_after)})
+                code = reponse.status
+                if trace is not None:
+                    trace.attributs['code'] = code
+            return reponse
+        finally:
+            self.__metriques.posts.incrementer(('batch', code))
+
+    async def __recevoir_batch(self, request: Request):
+        content_type = request.content_type
+        if content_type == 'application/json':
+            try:
+                body = await lire_body(request, self.__taille_max)
+            except MessageTropGros:
+                return web.HTTPRequestEntityTooLarge(self.__taille_max, request.content_length or 0)
+            try:
+                messages = json_loads(body)
+            except ValueError:
+                return web.HTTPBadRequest(reason="json invalide")
+            if not isinstance(messages, list):
+                return web.HTTPBadRequest(reason="liste de messages attendue")
+            if len(messages) > self.__messages_max:
+                return web.HTTPBadRequest(reason="trop de messages (max %d)" % self.__messages_max)
+            source = iterer_liste(messages)
+        elif content_type == CONTENT_TYPE_NDJSON:
+            content_length = request.content_length
+            if content_length is not None and content_length > self.__taille_max:
+                return web.HTTPRequestEntityTooLarge(self.__taille_max, content_length)
+            source = iterer_ndjson(request.content.iter_any(), self.__taille_max, self.__messages_max,
+                                   self.__taille_max_message)
+        else:
+            return web.HTTPUnsupportedMediaType()
+
+        headers_web = dict(request.headers)
+        mode_async = self.__mode_async or 'respond-async' in request.headers.get('Prefer', '')
+
+        reponse = web.StreamResponse(headers={'Content-Type': CONTENT_TYPE_NDJSON, 'Cache-Control': 'no-store'})
+        await reponse.prepare(request)
+
+        resultats: asyncio.Queue[Optional[dict]] = asyncio.Queue()
+        tache_ecriture = asyncio.create_task(ecrire_resultats(reponse, resultats))
+        try:
+            nombre = await self.__traiter_messages(request, source, json_dumps(headers_web), mode_async, resultats)
+        finally:
+            await resultats.put(None)
+            await tache_ecriture
+
+        self.__traceur.ajouter_attributs(nombre=nombre)
+        await reponse.write_eof()
+        return reponse
+
+    async def __traiter_messages(self, request: Request, source: AsyncIterator[tuple[int, Union[dict, bytes]]],
+                                 origine: str, mode_async: bool, resultats: asyncio.Queue) -> int:
+        """
+        Lance le traitement des messages de la source. Le semaphore borne le nombre de messages en cours
+        (chiffrage et correlations MQ en attente) et ralentit la lecture du body lorsqu'il est plein.
+        :return: Nombre de messages recus
+        """
+        producer = None
+        if mode_async is False:
+            producer = await self.__get_producer()
+
+        semaphore = asyncio.Semaphore(self.__concurrence)
+        taches = set()
+        nombre = 0
+
+        async def traiter(index_message: int, message_recu: Union[dict, bytes]):
+            try:
+                resultat = await self.__traiter_message(message_recu, origine, mode_async, producer)
+            except Exception as e:
+                self.__logger.exception("Erreur traitement message batch index %d" % index_message)
+                resultat = {'code': 500, 'ok': False, 'err': str(e)}
+            finally:
+                semaphore.release()
+            await resultats.put({'index': index_message, **resultat})
+
+        try:
+            async for index, message in source:
+                if self.__limiteur_debit is not None:
+                    attente = self.__limiteur_debit.verifier_messages(request)
+                    if attente is not None:
+                        await resultats.put({'index': index, 'code': 429, 'ok': False, 'err': 'limite de debit',
+                                             'retry_after': int(attente) + 1})
+                        break
+                await semaphore.acquire()
+                tache = asyncio.create_task(traiter(index, message))
+                taches.add(tache)
+                tache.add_done_callback(taches.discard)
+                nombre = index + 1
+        except BatchTropGrosse as e:
+            await resultats.put({'index': nombre, 'code': 413, 'ok': False, 'err': str(e)})
+        except BaseException:
+            # Source interrompue (ex. deconnexion du client) : les messages en cours sont annules avant que
+            # l'appelant ne termine la file des resultats
+            taches_en_cours = list(taches)
+            for tache in taches_en_cours:
+                tache.cancel()
+            await asyncio.gather(*taches_en_cours, return_exceptions=True)
+            raise
+
+        if len(taches) > 0:
+            await asyncio.gather(*taches)
+
+        return nombre
+
+    async def __get_producer(self):
+        try:
+            debut = time.perf_counter()
+            with self.__traceur.span('producer.attente'):
+                producer = await asyncio.wait_for(self.__etat.producer_wait(), 5)
+            self.__metriques.attente_producer.observer(time.perf_counter() - debut)
+            return producer
+        except asyncio.TimeoutError:
+            self.__logger.warning("Batch : producer non pret")
+            return None
+
+    async def __traiter_message(self, message_recu: Union[dict, bytes], origine: str, mode_async: bool,
+                                producer) -> dict:
+        try:
+            if isinstance(message_recu, bytes):
+                message_recu = json_loads(message_recu)
+            message_prepare = MessagePrepare.parse(message_recu)
+        except ValueError:
+            return {'code': 400, 'ok': False, 'err': 'json invalide'}
+        except MessageInvalide as e:
+            return {'code': 400, 'ok': False, 'err': str(e)}
+
+        try:
+            debut = time.perf_counter()
+            message_chiffre, message_id = await message_prepare.generer(self.__etat, {'origine': origine})
+            self.__metriques.chiffrer_message.observer(time.perf_counter() - debut)
+        except KeyError:
+            return {'code': 200, 'ok': False, 'err': 'Cles de chiffrage non recues, reessayer dans 30 secondes'}
+
+        if mode_async is False and producer is not None:
+            try:
+                reponse_parsed = await self.__messages_handler.emettre_posterv1(producer, message_chiffre, message_id)
+            except Exception as e:
+                if self.__absorber_erreurs_mq is False:
+                    return {'code': 500, 'ok': False, 'id': message_id, 'err': str(e)}
+                self.__logger.warning("Batch Erreur emission posterV1 (%s), message %s conserve dans l'outbox" % (
+                    str(e), message_id))
+            else:
+                if reponse_parsed.get('ok') is True:
+                    return {'code': 201, 'ok': True, 'id': message_id}
+                return {'code': 200, 'ok': False, 'id': message_id, 'err': reponse_parsed.get('err')}
+        elif mode_async is False and self.__absorber_erreurs_mq is False:
+            return {'code': 500, 'ok': False, 'id': message_id, 'err': 'producer non pret'}
+
+        # Mode asynchrone ou MQ non disponible : le message est conserve dans l'outbox
+        etat_message = await self.__messages_handler.dispatcher.soumettre(message_chiffre, message_id, None)
+        return {'code': 202, 'ok': True, 'id': message_id, 'etat': etat_message['etat']}
+
+
+async def iterer_liste(messages: list) -> AsyncIterator[tuple[int, dict]]:
+    for index, message in enumerate(messages):
+        yield index, message
+
+
+async def ecrire_resultats(reponse: web.StreamResponse, resultats: asyncio.Queue):
+    """
+    Ecrit les resultats en NDJSON. Les resultats deja disponibles sont regroupes dans une seule ecriture.
+    Si le client se deconnecte, les resultats restants sont consommes sans etre ecrits.
+    """
+    connecte = True
+    termine = False
+    while termine is False:
+        lignes = list()
+        resultat = await resultats.get()
+        while resultat is not None:
+            lignes.append(json_dumps(resultat))
+            if resultats.empty():
+                break
+            resultat = resultats.get_nowait()
+        if resultat is None:
+            termine = True
+
+        if connecte and len(lignes) > 0:
+            try:
+                await reponse.write(('\n'.join(lignes) + '\n').encode('utf-8'))
+            except (ConnectionResetError, RuntimeError):
+                connecte = False
@@ -0,0 +1,199 @@
+import math
+
+from bisect import bisect_left
+from typing import Callable, Iterable, Optional
+
+CONTENT_TYPE_METRIQUES = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Buckets (secondes) des durees de traitement
+BUCKETS_DUREE = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Buckets (bytes/seconde) du debit de chiffrage des fichiers
+BUCKETS_DEBIT = tuple(float(m * 1024 * 1024) for m in (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+# Buckets (secondes) du retard de la boucle asyncio
+BUCKETS_RETARD = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Buckets (nombre de jobs) des lots du service crypto
+BUCKETS_LOT = (1, 2, 4, 8, 16, 32, 64)
+
+
+def formatter_labels(noms_labels: tuple, valeurs: tuple, additionnel: str = '') -> str:
+    labels = ['%s="%s"' % (nom, str(valeur).replace('\\', '\\\\').replace('"', '\\"'))
+              for nom, valeur in zip(noms_labels, valeurs)]
+    if additionnel:
+        labels.append(additionnel)
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(labels) + '}'
+
+
+def formatter_valeur(valeur: float) -> str:
+    if math.isinf(valeur):
+        return '+Inf' if valeur > 0 else '-Inf'
+    if float(valeur).is_integer():
+        return str(int(valeur))
+    return repr(float(valeur))
+
+
+class Compteur:
+    """
+    Compteur monotone. Les metriques sont mises a jour a partir de la thread de l'event loop, aucun lock.
+    """
+
+    def __init__(self, nom: str, aide: str, noms_labels: tuple = ()):
+        self.__nom = nom
+        self.__aide = aide
+        self.__noms_labels = noms_labels
+        self.__valeurs: dict[tuple, float] = dict()
+
+    def incrementer(self, labels: tuple = (), valeur: float = 1.0):
+        self.__valeurs[labels] = self.__valeurs.get(labels, 0.0) + valeur
+
+    def exporter(self) -> Iterable[str]:
+        yield '# HELP %s %s' % (self.__nom, self.__aide)
+        yield '# TYPE %s counter' % self.__nom
+        for labels, valeur in list(self.__valeurs.items()):
+            yield '%s%s %s' % (self.__nom, formatter_labels(self.__noms_labels, labels), formatter_valeur(valeur))
+
+
+class SerieHistogramme:
+    __slots__ = ('compteurs', 'somme', 'nombre')
+
+    def __init__(self, nombre_buckets: int):
+        # Le dernier compteur recoit les valeurs plus grandes que le dernier bucket (+Inf)
+        self.compteurs = [0] * (nombre_buckets + 1)
+        self.somme = 0.0
+        self.nombre = 0
+
+
+class Histogramme:
+    """
+    Histogramme a buckets fixes. Les compteurs de chaque serie sont prealloues, une observation est une recherche
+    binaire et trois additions.
+    """
+
+    def __init__(self, nom: str, aide: str, buckets: tuple, noms_labels: tuple = ()):
+        self.__nom = nom
+        self.__aide = aide
+        self.__buckets = buckets
+        self.__noms_labels = noms_labels
+        self.__series: dict[tuple, SerieHistogramme] = dict()
+
+    def observer(self, valeur: float, labels: tuple = ()):
+        serie = self.__series.get(labels)
+        if serie is None:
+            serie = SerieHistogramme(len(self.__buckets))
+            self.__series[labels] = serie
+        serie.compteurs[bisect_left(self.__buckets, valeur)] += 1
+        serie.somme += valeur
+        serie.nombre += 1
+
+    def exporter(self) -> Iterable[str]:
+        nom = self.__nom
+        yield '# HELP %s %s' % (nom, self.__aide)
+        yield '# TYPE %s histogram' % nom
+        bornes = [formatter_valeur(b) for b in self.__buckets] + ['+Inf']
+        for labels, serie in list(self.__series.items()):
+            cumul = 0
+            for borne, compteur in zip(bornes, serie.compteurs):
+                cumul += compteur
+                yield '%s_bucket%s %d' % (nom, formatter_labels(self.__noms_labels, labels, 'le="%s"' % borne), cumul)
+            labels_serie = formatter_labels(self.__noms_labels, labels)
+            yield '%s_sum%s %s' % (nom, labels_serie, formatter_valeur(serie.somme))
+            yield '%s_count%s %d' % (nom, labels_serie, serie.nombre)
+
+
+class Jauge:
+    """
+    Jauge evaluee au moment de l'export.
+    :param fonction: Retourne une liste de (labels, valeur)
+    """
+
+    def __init__(self, nom: str, aide: str, fonction: Callable[[], list[tuple[tuple, float]]],
+                 noms_labels: tuple = ()):
+        self.__nom = nom
+        self.__aide = aide
+        self.__fonction = fonction
+        self.__noms_labels = noms_labels
+
+    def exporter(self) -> Iterable[str]:
+        yield '# HELP %s %s' % (self.__nom, self.__aide)
+        yield '# TYPE %s gauge' % self.__nom
+        for labels, valeur in self.__fonction():
+            yield '%s%s %s' % (self.__nom, formatter_labels(self.__noms_labels, labels), formatter_valeur(valeur))
+
+
+class MetriquesReception:
+    """
+    Metriques du pipeline de reception, exportees en format texte Prometheus sous /reception/metrics (jeton
+    d'administration requis).
+    """
+
+    def __init__(self):
+        self.posts = Compteur(
+            'reception_posts_total', 'Posts recus par type de contenu et code de reponse',
+            ('content_type', 'code'))
+        self.attente_admission = Histogramme(
+            'reception_attente_admission_secondes', "Attente d'une place dans la voie d'admission",
+            BUCKETS_DUREE, ('voie',))
+        self.attente_producer = Histogramme(
+            'reception_attente_producer_secondes', 'Attente du producer MQ (producer_wait)', BUCKETS_DUREE)
+        self.chiffrer_message = Histogramme(
+            'reception_chiffrer_message_secondes', 'Duree de preparation et chiffrage du message (generer)',
+            BUCKETS_DUREE)
+        self.emettre_attendre = Histogramme(
+            'reception_emettre_attendre_secondes', 'Duree de emettre_attendre pour la commande posterV1',
+            BUCKETS_DUREE, ('mode',))
+        self.outbox_echecs = Compteur(
+            'reception_outbox_echecs_total', "Messages de l'outbox en echec (nombre maximal de tentatives atteint)")
+        self.upload_bytes = Compteur(
+            'reception_upload_bytes_total', 'Bytes des fichiers recus, contenu dechiffre et chiffre', ('contenu',))
+        self.debit_chiffrage = Histogramme(
+            'reception_debit_chiffrage_bytes_par_seconde', 'Debit de reception et chiffrage par fichier',
+            BUCKETS_DEBIT)
+        self.dedup_fichiers = Compteur(
+            'reception_dedup_fichiers_total', "Fichiers recus trouves (hit) ou non (miss) dans l'index de deduplication",
+            ('resultat',))
+        self.intake_batch = Histogramme(
+            'reception_intake_batch_secondes', 'Duree de transfert des fichiers de la batch vers ready/ (intake_batch)',
+            BUCKETS_DUREE)
+        self.crypto_jobs = Compteur(
+            'reception_crypto_jobs_total', 'Jobs de chiffrage executes dans la boucle (inline) ou le pool',
+            ('mode',))
+        self.crypto_attente = Histogramme(
+            'reception_crypto_attente_secondes', "Attente d'un job de chiffrage avant son execution",
+            BUCKETS_DUREE)
+        self.crypto_lot = Histogramme(
+            'reception_crypto_lot_jobs', 'Nombre de jobs par lot soumis au pool de chiffrage', BUCKETS_LOT)
+        self.boucle_retard = Histogramme(
+            'reception_boucle_retard_secondes', 'Retard de planification de la boucle asyncio', BUCKETS_RETARD)
+        self.boucle_blocages = Compteur(
+            'reception_boucle_blocages_total', 'Callbacks ayant bloque la boucle asyncio au-dela du seuil')
+
+        self.__jauges: list[Jauge] = list()
+
+    def ajouter_jauge(self, nom: str, aide: str, fonction: Callable[[], list[tuple[tuple, float]]],
+                      noms_labels: tuple = ()):
+        self.__jauges.append(Jauge(nom, aide, fonction, noms_labels))
+
+    def compter_post(self, content_type: Optional[str], code: int):
+        if content_type == 'application/json':
+            type_post = 'json'
+        elif content_type is not None and content_type.startswith('multipart'):
+            type_post = 'multipart'
+        else:
+            type_post = 'autre'
+        self.posts.incrementer((type_post, code))
+
+    def exporter(self) -> str:
+        metriques = [
+            self.posts, self.attente_admission, self.attente_producer, self.chiffrer_message, self.emettre_attendre,
+            self.outbox_echecs, self.upload_bytes, self.debit_chiffrage, self.dedup_fichiers, self.intake_batch,
+            self.crypto_jobs, self.crypto_attente, self.crypto_lot, self.boucle_retard, self.boucle_blocages,
+        ]
+        metriques.extend(self.__jauges)
+
+        lignes = list()
+        for metrique in metriques:
+            lignes.extend(metrique.exporter())
+        lignes.append('')
+
+        return '\n'.join(lignes)
@@ -0,0 +1,228 @@
+import asyncio
+import datetime
+import json
+import logging
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+ETAT_EN_ATTENTE = 'en_attente'
+ETAT_LIVRE = 'livre'
+ETAT_REJETE = 'rejete'
+ETAT_ECHEC = 'echec'  # Nombre maximal de tentatives d'emission atteint
+
+SQL_CREATE = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id TEXT NOT NULL UNIQUE,
+    batch_id TEXT,
+    message TEXT,
+    etat TEXT NOT NULL,
+    created INTEGER NOT NULL,
+    tentatives INTEGER NOT NULL DEFAULT 0,
+    prochaine_tentative REAL NOT NULL DEFAULT 0,
+    reponse TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_etat_seq ON outbox (etat, seq);
+CREATE INDEX IF NOT EXISTS outbox_batch_id ON outbox (batch_id);
+"""
+
+
+@dataclass
+class EntreeOutbox:
+    seq: int
+    message_id: str
+    batch_id: Optional[str]
+    message: dict
+    created: int
+    tentatives: int
+
+
+class Outbox:
+    """
+    Outbox durable des commandes posterV1 (sqlite en mode WAL sous dir_staging). Les ajouts concurrents sont
+    regroupes dans une meme transaction (un seul fsync par groupe). Toutes les operations sqlite sont faites
+    dans un thread dedie.
+    """
+
+    def __init__(self, path_db: str, delai_groupe: float = 0.002):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__path_db = path_db
+        self.__delai_groupe = delai_groupe
+
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+        self.__connexion: Optional[sqlite3.Connection] = None
+
+        self.__ajouts_pending: list[tuple[tuple, asyncio.Future]] = list()
+        self.__flush_task: Optional[asyncio.Task] = None
+
+    async def ouvrir(self):
+        await self.__executer(self.__ouvrir)
+
+    async def fermer(self):
+        if self.__flush_task is not None:
+            await self.__flush_task
+        await self.__executer(self.__fermer)
+        self.__executor.shutdown(wait=False)
+
+    async def ajouter(self, message_id: str, batch_id: Optional[str], message: dict):
+        """
+        Ajoute un message a l'outbox. Retourne lorsque l'ajout est persiste sur disque.
+        """
+        now_timestamp = int(datetime.datetime.utcnow().timestamp())
+        ligne = (message_id, batch_id, json.dumps(message), ETAT_EN_ATTENTE, now_timestamp)
+
+        future = asyncio.get_running_loop().create_future()
+        self.__ajouts_pending.append((ligne, future))
+        if self.__flush_task is None:
+            self.__flush_task = asyncio.create_task(self.__flush_ajouts())
+
+        await future
+        return now_timestamp
+
+    async def get_en_attente(self, limite: int, exclure: set) -> list[EntreeOutbox]:
+        """ :return: Messages en attente dont le delai de reprise est ecoule, en ordre de reception """
+        return await self.__executer(self.__get_en_attente, limite, exclure, time.time())
+
+    async def marquer_termine(self, message_id: str, etat: str, reponse: dict):
+        await self.__executer(self.__marquer_termine, message_id, etat, reponse)
+
+    async def reporter(self, message_id: str, delai: float):
+        """ Incremente les tentatives, le message n'est pas retourne par get_en_attente avant delai secondes """
+        await self.__executer(self.__reporter, message_id, time.time() + delai)
+
+    async def get_etat(self, message_id: str) -> Optional[dict]:
+        return await self.__executer(self.__get_etat, message_id)
+
+    async def contient_batch(self, batch_id: str) -> bool:
+        return await self.__executer(self.__contient_batch, batch_id)
+
+    async def purger(self, age: datetime.timedelta) -> int:
+        """ Retire les messages termines (livres, rejetes, en echec) plus vieux que age. """
+        expiration = int((datetime.datetime.utcnow() - age).timestamp())
+        return await self.__executer(self.__purger, expiration)
+
+    async def __flush_ajouts(self):
+        try:
+            # Laisser les autres requetes concurrentes s'ajouter au groupe
+            await asyncio.sleep(self.__delai_groupe)
+            while len(self.__ajouts_pending) > 0:
+                ajouts = self.__ajouts_pending
+                self.__ajouts_pending = list()
+                try:
+                    await self.__executer(self.__inserer, [a[0] for a in ajouts])
+                except Exception as e:
+                    for _ligne, future in ajouts:
+                        future.set_exception(e)
+                else:
+                    for _ligne, future in ajouts:
+                        future.set_result(None)
+        finally:
+            self.__flush_task = None
+
+    async def __executer(self, fonction, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, fonction, *args)
+
+    def __ouvrir(self):
+        self.__connexion = sqlite3.connect(self.__path_db, isolation_level=None, check_same_thread=False)
+        self.__connexion.execute('PRAGMA journal_mode=WAL')
+        self.__connexion.execute('PRAGMA synchronous=FULL')
+        self.__connexion.executescript(SQL_CREATE)
+
+    def __fermer(self):
+        if self.__connexion is not None:
+            self.__connexion.close()
+            self.__connexion = None
+
+    def __inserer(self, lignes: list[tuple]):
+        connexion = self.__connexion
+        connexion.execute('BEGIN')
+        try:
+            connexion.executemany(
+                'INSERT OR IGNORE INTO outbox (message_id, batch_id, message, etat, created) VALUES (?, ?, ?, ?, ?)',
+                lignes)
+        except Exception:
+            connexion.execute('ROLLBACK')
+            raise
+        connexion.execute('COMMIT')
+
+    def __get_en_attente(self, limite: int, exclure: set, now: float) -> list[EntreeOutbox]:
+        curseur = self.__connexion.execute(
+            'SELECT seq, message_id, batch_id, message, created, tentatives FROM outbox '
+            'WHERE etat = ? AND prochaine_tentative <= ? ORDER BY seq LIMIT ?',
+            (ETAT_EN_ATTENTE, now, limite + len(exclure)))
+
+        entrees = list()
+        for seq, message_id, batch_id, message, created, tentatives in curseur:
+            if message_id in exclure:
+                continue
+            entrees.append(EntreeOutbox(seq, message_id, batch_id, json.loads(message), created, tentatives))
+            if len(entrees) >= limite:
+                break
+
+        return entrees
+
+    def __marquer_termine(self, message_id: str, etat: str, reponse: dict):
+        # Le message chiffre n'est plus requis une fois livre, rejete ou en echec
+        self.__connexion.execute(
+            'UPDATE outbox SET etat = ?, reponse = ?, message = NULL WHERE message_id = ?',
+            (etat, json.dumps(reponse), message_id))
+
+    def __reporter(self, message_id: str, prochaine_tentative: float):
+        self.__connexion.execute(
+            'UPDATE outbox SET tentatives = tentatives + 1, prochaine_tentative = ? WHERE message_id = ?',
+            (prochaine_tentative, message_id))
+
+    def __get_etat(self, message_id: str) -> Optional[dict]:
+        ligne = self.__connexion.execute(
+            'SELECT etat, created, tentatives, reponse FROM outbox WHERE message_id = ?', (message_id,)).fetchone()
+        if ligne is None:
+            return None
+
+        etat, created, tentatives, reponse = ligne
+        etat_message = {'etat': etat, 'created': created, 'tentatives': tentatives}
+        if reponse is not None:
+            etat_message['reponse'] = json.loads(reponse)
+
+        return etat_message
+
+    def __contient_batch(self, batch_id: str) -> bool:
+        ligne = self.__connexion.execute(
+            'SELECT 1 FROM outbox WHERE batch_id = ? AND etat = ?', (batch_id, ETAT_EN_ATTENTE)).fetchone()
+        return ligne is not None
+
+    def __purger(self, expiration: int) -> int:
+        curseur = self.__connexion.execute(
+            'DELETE FROM outbox WHERE etat != ? AND created < ?', (ETAT_EN_ATTENTE, expiration))
+        return curseur.rowcount
+
+
+def fusionner_outbox(path_source: str, path_destination: str) -> int:
+    """
+    Ajoute les messages d'une outbox a une autre (ex. staging d'un worker retire). Les messages gardent leur etat
+    et leur ordre de reception, les messages en attente sont emis par l'outbox de destination. Doit etre execute
+    avant l'ouverture de l'outbox de destination.
+    :return: Nombre de messages ajoutes
+    """
+    connexion = sqlite3.connect(path_destination, isolation_level=None)
+    try:
+        connexion.execute('PRAGMA journal_mode=WAL')
+        connexion.executescript(SQL_CREATE)
+        connexion.execute('ATTACH DATABASE ? AS source', (path_source,))
+        connexion.execute('BEGIN')
+        try:
+            curseur = connexion.execute(
+                'INSERT OR IGNORE INTO outbox (message_id, batch_id, message, etat, created, tentatives, reponse) '
+                'SELECT message_id, batch_id, message, etat, created, tentatives, reponse FROM source.outbox '
+                'ORDER BY seq')
+        except Exception:
+            connexion.execute('ROLLBACK')
+            raise
+        connexion.execute('COMMIT')
+        connexion.execute('DETACH DATABASE source')
+        return curseur.rowcount
+    finally:
+        connexion.close()
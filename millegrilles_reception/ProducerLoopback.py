@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import random
+
+from collections import deque
+from typing import Awaitable, Callable, Optional, Union
+
+from millegrilles_messages.messages import Constantes
+from millegrilles_messages.messages.EnveloppeCertificat import EnveloppeCertificat
+
+# Actions conservees dans les queues en memoire du producer loopback
+ACTION_POSTER = 'posterV1'
+ACTION_AJOUTER_CLE_DOMAINES = 'ajouterCleDomaines'
+AUTRES_ACTIONS = 'autres'
+
+TAILLE_QUEUES_LOOPBACK = 10_000
+
+FIN_PEM = '-----END CERTIFICATE-----'
+
+
+class ReponseLoopback:
+    """ Reponse equivalente a MessageWrapper (parsed, certificat) """
+
+    def __init__(self, parsed: dict, certificat: Optional[EnveloppeCertificat] = None):
+        self.parsed = parsed
+        self.certificat = certificat
+
+
+class ProducerLoopback:
+    """
+    Producer local, sans MQ, pour les tests de performance hors-ligne. Les commandes sont conservees dans des queues
+    en memoire (posterV1, ajouterCleDomaines, autres) et recoivent une reponse ok apres la latence configuree.
+    Les requetes de certificat de chiffrage retournent les certificats charges a partir des fichiers PEM configures.
+    """
+
+    def __init__(self, configuration, valider_certificat: Callable[[list[str]], Awaitable[EnveloppeCertificat]]):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__latence = configuration.loopback_latence
+        self.__latence_variation = configuration.loopback_latence_variation
+        self.__taux_echec = configuration.loopback_taux_echec
+        self.__taux_rejet = configuration.loopback_taux_rejet
+        self.__fichiers_certificats = configuration.loopback_certificats
+        self.__valider_certificat = valider_certificat
+
+        self.__pret = asyncio.Event()
+        self.__pret.set()
+
+        self.__queues: dict[str, deque] = {
+            ACTION_POSTER: deque(maxlen=TAILLE_QUEUES_LOOPBACK),
+            ACTION_AJOUTER_CLE_DOMAINES: deque(maxlen=TAILLE_QUEUES_LOOPBACK),
+            AUTRES_ACTIONS: deque(maxlen=TAILLE_QUEUES_LOOPBACK),
+        }
+        self.__certificats: Optional[list[EnveloppeCertificat]] = None
+
+        self.__emis = 0
+        self.__echecs = 0
+        self.__rejets = 0
+
+    def producer_pret(self) -> asyncio.Event:
+        return self.__pret
+
+    async def emettre_attendre(self, message: Union[str, bytes, dict], routing_key: Optional[str] = None,
+                               exchange: Optional[str] = None, correlation_id: Optional[str] = None,
+                               reply_to: Optional[str] = None, timeout=15, **kwargs) -> ReponseLoopback:
+        action = routing_key.split('.')[-1] if routing_key else None
+        return await self.__traiter(action, message)
+
+    async def executer_commande(self, commande: dict, domaine: str, action: str, exchange: Optional[str] = None,
+                                timeout=15, nowait=False, **kwargs) -> Optional[ReponseLoopback]:
+        reponse = await self.__traiter(action, commande)
+        if nowait:
+            return None
+        return reponse
+
+    async def executer_requete(self, requete: dict, domaine: str, action: str, exchange: Optional[str] = None,
+                               timeout=15, **kwargs) -> ReponseLoopback:
+        await self.__simuler_latence()
+        if action in [Constantes.REQUETE_MAITREDESCLES_CERTIFICAT, Constantes.REQUETE_MESSAGES_CERTIFICAT]:
+            certificat = await self.__get_certificat(domaine)
+            if certificat is None:
+                raise asyncio.TimeoutError('loopback : aucun certificat pour %s' % domaine)
+            return ReponseLoopback({'ok': True, '__original': None}, certificat)
+
+        return ReponseLoopback({'ok': True, '__original': None})
+
+    def get_messages(self, action: str) -> list:
+        """ :return: Messages recus pour l'action (posterV1, ajouterCleDomaines, autres) """
+        return list(self.__queues[action])
+
+    def get_metriques(self) -> dict:
+        metriques = {'emis': self.__emis, 'echecs': self.__echecs, 'rejets': self.__rejets}
+        metriques.update({'queue_%s' % action: len(queue) for action, queue in self.__queues.items()})
+        return metriques
+
+    async def __traiter(self, action: Optional[str], message) -> ReponseLoopback:
+        await self.__simuler_latence()
+
+        if self.__taux_echec > 0 and random.random() < self.__taux_echec:
+            self.__echecs += 1
+            raise asyncio.TimeoutError('loopback : echec simule')
+
+        queue = self.__queues.get(action) or self.__queues[AUTRES_ACTIONS]
+        queue.append(message)
+        self.__emis += 1
+
+        if self.__taux_rejet > 0 and random.random() < self.__taux_rejet:
+            self.__rejets += 1
+            return ReponseLoopback({'ok': False, 'err': 'loopback : rejet simule', '__original': None})
+
+        return ReponseLoopback({'ok': True, '__original': None})
+
+    async def __simuler_latence(self):
+        latence = self.__latence
+        if self.__latence_variation > 0:
+            latence += random.uniform(-self.__latence_variation, self.__latence_variation)
+        if latence > 0:
+            await asyncio.sleep(latence)
+
+    async def __get_certificat(self, domaine: str) -> Optional[EnveloppeCertificat]:
+        if self.__certificats is None:
+            certificats = list()
+            for path_fichier in self.__fichiers_certificats:
+                try:
+                    with open(path_fichier, 'rt') as fichier:
+                        pems = [p.strip() + '\n' + FIN_PEM for p in fichier.read().split(FIN_PEM) if p.strip()]
+                    certificats.append(await self.__valider_certificat(pems))
+                except Exception as e:
+                    self.__logger.warning("Certificat loopback %s rejete : %s" % (path_fichier, str(e)))
+            self.__certificats = certificats
+
+        for certificat in self.__certificats:
+            if domaine in certificat.get_domaines:
+                return certificat
+
+        return None
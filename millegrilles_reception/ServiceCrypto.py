@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+class JobCrypto:
+    __slots__ = ('fonction', 'args', 'kwargs', 'future', 'date_soumission')
+
+    def __init__(self, fonction: Callable, args: tuple, kwargs: dict, future: asyncio.Future):
+        self.fonction = fonction
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.date_soumission = time.perf_counter()
+
+
+def executer_lot(boucle: asyncio.AbstractEventLoop, jobs: list[JobCrypto], completer: Callable[[list], None]):
+    """ Execute un lot de jobs dans un thread du pool. Les resultats sont retournes a la boucle en un seul appel. """
+    resultats = list()
+    for job in jobs:
+        debut = time.perf_counter()
+        try:
+            resultats.append((job, debut, job.fonction(*job.args, **job.kwargs), None))
+        except BaseException as e:
+            resultats.append((job, debut, None, e))
+    boucle.call_soon_threadsafe(completer, resultats)
+
+
+class ServiceCrypto:
+    """
+    Execution du chiffrage (fonctions synchrones) hors de la boucle asyncio, dans un pool de threads.
+
+    Les jobs soumis pendant une meme iteration de la boucle sont regroupes en lots (au plus crypto_lot jobs) pour
+    reduire les changements de thread. Le nombre de jobs en attente est borne (crypto_file), les appelants attendent
+    une place lorsque le pool est sature. Avec crypto_workers=0, les jobs sont executes directement dans la boucle.
+    """
+
+    def __init__(self, configuration, metriques):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__metriques = metriques
+        self.__workers = configuration.crypto_workers
+        self.__taille_lot = max(1, configuration.crypto_lot)
+
+        self.__executor: Optional[ThreadPoolExecutor] = None
+        if self.__workers > 0:
+            self.__executor = ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix='crypto')
+
+        # Cree a la premiere utilisation, dans la boucle de l'application
+        self.__places: Optional[asyncio.Semaphore] = None
+        self.__taille_file = max(1, configuration.crypto_file)
+        self.__jobs_attente: list[JobCrypto] = list()
+        self.__jobs_en_cours = 0
+
+        metriques.ajouter_jauge(
+            'reception_crypto_jobs_en_cours', 'Jobs de chiffrage en attente ou en execution dans le pool',
+            lambda: [((), self.__jobs_en_cours)])
+
+    async def executer(self, fonction: Callable, *args, **kwargs):
+        """ :return: Resultat de fonction(*args, **kwargs) """
+        if self.__executor is None:
+            self.__metriques.crypto_jobs.incrementer(('inline',))
+            return fonction(*args, **kwargs)
+
+        if self.__places is None:
+            self.__places = asyncio.Semaphore(self.__taille_file)
+
+        async with self.__places:
+            self.__jobs_en_cours += 1
+            try:
+                boucle = asyncio.get_running_loop()
+                job = JobCrypto(fonction, args, kwargs, boucle.create_future())
+                self.__jobs_attente.append(job)
+                if len(self.__jobs_attente) == 1:
+                    boucle.call_soon(self.__soumettre_jobs)
+                elif len(self.__jobs_attente) >= self.__taille_lot:
+                    self.__soumettre_jobs()
+                self.__metriques.crypto_jobs.incrementer(('pool',))
+                return await job.future
+            finally:
+                self.__jobs_en_cours -= 1
+
+    def __soumettre_jobs(self):
+        jobs = self.__jobs_attente
+        if len(jobs) == 0:
+            return  # Deja soumis (lot plein)
+        self.__jobs_attente = list()
+
+        self.__metriques.crypto_lot.observer(len(jobs))
+        self.__executor.submit(executer_lot, asyncio.get_running_loop(), jobs, self.__completer_lot)
+
+    def __completer_lot(self, resultats: list[tuple[JobCrypto, float, Any, Optional[BaseException]]]):
+        """ Appele dans la boucle a la fin d'un lot, les metriques sont mises a jour a partir de la boucle """
+        for job, debut, resultat, erreur in resultats:
+            self.__metriques.crypto_attente.observer(debut - job.date_soumission)
+            if job.future.cancelled():
+                continue
+            if erreur is not None:
+                job.future.set_exception(erreur)
+            else:
+                job.future.set_result(resultat)
+
+    def fermer(self):
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False)
+
+    def get_metriques(self) -> dict:
+        return {
+            'workers': self.__workers,
+            'taille_lot': self.__taille_lot,
+            'jobs_en_cours': self.__jobs_en_cours,
+        }
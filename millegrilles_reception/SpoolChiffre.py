@@ -0,0 +1,76 @@
+import os
+
+from typing import Optional
+
+# Nombre maximal de buffers par appel writev
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+# Format mgs4 : chaque bloc de 64 kB de contenu chiffre a 17 bytes de plus (tag et header)
+MGS4_TAILLE_BLOC = 64 * 1024
+MGS4_OVERHEAD_BLOC = 17
+
+
+class SpoolChiffre:
+    """
+    Fichier de reception du contenu chiffre. Les chunks d'un job de chiffrage sont ecrits avec un seul appel
+    writev (sans tampon intermediaire). Si la taille est connue, le fichier est prealloue (posix_fallocate) puis
+    ramene a la taille reelle a la fermeture.
+    """
+
+    def __init__(self, path_fichier: str, taille_prevue: Optional[int] = None):
+        self.__fd = os.open(path_fichier, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        self.__taille = 0
+        self.__prealloue = False
+
+        if taille_prevue and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.__fd, 0, taille_prevue)
+                self.__prealloue = True
+            except OSError:
+                pass  # Non supporte par le systeme de fichiers
+
+    def ecrire(self, buffers: list[bytes]) -> int:
+        """ :return: Nombre de bytes ecrits """
+        buffers = [b for b in buffers if len(b) > 0]
+        taille_totale = sum([len(b) for b in buffers])
+
+        while len(buffers) > 0:
+            ecrit = os.writev(self.__fd, buffers[:IOV_MAX])
+            # Ecriture partielle : retirer ce qui a ete ecrit et continuer
+            idx = 0
+            while idx < len(buffers) and ecrit >= len(buffers[idx]):
+                ecrit -= len(buffers[idx])
+                idx += 1
+            buffers = buffers[idx:]
+            if ecrit > 0:
+                buffers[0] = memoryview(buffers[0])[ecrit:]
+
+        self.__taille += taille_totale
+        return taille_totale
+
+    def fermer(self):
+        if self.__fd is None:
+            return
+        try:
+            if self.__prealloue:
+                os.ftruncate(self.__fd, self.__taille)
+        finally:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.fermer()
+
+
+def estimer_taille_chiffree(content_length: Optional[str]) -> Optional[int]:
+    """ :return: Taille approximative du contenu chiffre pour la preallocation, None si inconnue """
+    try:
+        taille = int(content_length)
+    except (TypeError, ValueError):
+        return None
+    if taille <= 0:
+        return None
+    return taille + (taille // MGS4_TAILLE_BLOC + 2) * MGS4_OVERHEAD_BLOC
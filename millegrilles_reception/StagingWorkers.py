@@ -0,0 +1,94 @@
+import logging
+import os
+import re
+import shutil
+
+from os import path
+from typing import Optional
+
+from millegrilles_reception.Outbox import fusionner_outbox
+
+NOM_FICHIER_OUTBOX = 'outbox.sqlite'
+REPERTOIRES_REPRIS = ('upload', 'ready')
+
+RE_REPERTOIRE_WORKER = re.compile(r'^worker_(\d+)$')
+
+logger = logging.getLogger(__name__)
+
+
+def get_dir_staging_worker(dir_staging: str, worker_id: Optional[int]) -> str:
+    """ :return: Staging du worker (outbox, uploads, cache des certificats), dir_staging si un seul processus """
+    if worker_id is None:
+        return dir_staging
+    return path.join(dir_staging, 'worker_%d' % worker_id)
+
+
+def lister_staging_orphelins(dir_staging: str, worker_id: Optional[int], nombre_workers: int) -> list[str]:
+    """
+    Repertoires de staging qui ne sont plus utilises apres un changement du nombre de workers et qui sont repris
+    par ce worker :
+      - worker_K avec K >= nombre_workers est repris par le worker K % nombre_workers;
+      - un seul processus (worker_id None) reprend tous les worker_K;
+      - le worker 0 reprend le staging de dir_staging (execution precedente sans workers).
+    """
+    try:
+        noms = os.listdir(dir_staging)
+    except FileNotFoundError:
+        return list()
+
+    orphelins = list()
+    for nom in sorted(noms):
+        match = RE_REPERTOIRE_WORKER.match(nom)
+        if match is None:
+            continue
+        id_orphelin = int(match.group(1))
+        if worker_id is None or (id_orphelin >= nombre_workers and id_orphelin % nombre_workers == worker_id):
+            orphelins.append(path.join(dir_staging, nom))
+
+    if worker_id == 0:
+        orphelins.append(dir_staging)
+
+    return orphelins
+
+
+def reprendre_staging(dir_source: str, dir_destination: str):
+    """
+    Transfere les messages de l'outbox et les batches (upload/, ready/) d'un staging orphelin vers le staging du
+    worker. Execute au demarrage du worker, avant l'ouverture de son outbox. Une reprise interrompue peut etre
+    executee a nouveau, les messages deja transferes sont ignores.
+    """
+    os.makedirs(dir_destination, exist_ok=True)
+    conserver = False
+
+    path_outbox = path.join(dir_source, NOM_FICHIER_OUTBOX)
+    if path.exists(path_outbox):
+        nombre_messages = fusionner_outbox(path_outbox, path.join(dir_destination, NOM_FICHIER_OUTBOX))
+        for suffixe in ('', '-wal', '-shm'):
+            try:
+                os.unlink(path_outbox + suffixe)
+            except FileNotFoundError:
+                pass
+        logger.info("Staging %s : %d messages de l'outbox repris" % (dir_source, nombre_messages))
+
+    for nom_repertoire in REPERTOIRES_REPRIS:
+        path_repertoire = path.join(dir_source, nom_repertoire)
+        try:
+            noms = os.listdir(path_repertoire)
+        except FileNotFoundError:
+            continue
+        path_repertoire_destination = path.join(dir_destination, nom_repertoire)
+        os.makedirs(path_repertoire_destination, exist_ok=True)
+        for nom in noms:
+            path_destination = path.join(path_repertoire_destination, nom)
+            if path.exists(path_destination):
+                logger.warning("Staging %s : %s/%s deja present dans %s, conserve" % (
+                    dir_source, nom_repertoire, nom, dir_destination))
+                conserver = True
+                continue
+            os.rename(path.join(path_repertoire, nom), path_destination)
+        if len(noms) > 0:
+            logger.info("Staging %s : %d entrees de %s/ reprises" % (dir_source, len(noms), nom_repertoire))
+
+    if conserver is False and RE_REPERTOIRE_WORKER.match(path.basename(dir_source)):
+        # Reste le cache des certificats, recharge par le worker
+        shutil.rmtree(dir_source)
@@ -0,0 +1,99 @@
+import logging
+import os
+import signal
+import socket
+import time
+
+from typing import Callable
+
+# Delai avant de redemarrer un worker termine en erreur (secondes)
+DELAI_REDEMARRAGE_WORKER = 5.0
+
+
+def creer_socket_reuseport(port: int, host: str = '0.0.0.0', backlog: int = 1024) -> socket.socket:
+    """
+    Socket d'ecoute avec SO_REUSEPORT. Chaque worker ouvre son propre socket sur le meme port, le kernel repartit
+    les connexions entre les workers.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class SuperviseurWorkers:
+    """
+    Mode pre-fork : demarre N processus workers (application complete, connexion MQ et staging propres a chaque
+    worker). Les signaux SIGINT/SIGTERM sont relayes aux workers pour un arret via exit_gracefully. Un worker
+    termine en erreur est redemarre.
+    """
+
+    def __init__(self, nombre_workers: int, executer_worker: Callable[[int], None]):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__nombre_workers = nombre_workers
+        self.__executer_worker = executer_worker
+        self.__workers: dict[int, int] = dict()  # pid: worker_id
+        self.__arret = False
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.exit_gracefully)
+        signal.signal(signal.SIGTERM, self.exit_gracefully)
+
+        for worker_id in range(self.__nombre_workers):
+            self.__demarrer_worker(worker_id)
+
+        while len(self.__workers) > 0:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            worker_id = self.__workers.pop(pid, None)
+            if worker_id is None:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            if self.__arret is False:
+                self.__logger.error("Worker %d (pid %d) termine avec code %d, redemarrage" % (worker_id, pid, code))
+                time.sleep(DELAI_REDEMARRAGE_WORKER)
+                if self.__arret is False:
+                    self.__demarrer_worker(worker_id)
+            else:
+                self.__logger.info("Worker %d (pid %d) arrete (code %d)" % (worker_id, pid, code))
+
+        self.__logger.info("Tous les workers sont arretes")
+
+    def exit_gracefully(self, signum=None, frame=None):
+        self.__logger.info("Arret des workers, signal: %s" % signum)
+        self.__arret = True
+        for pid in list(self.__workers.keys()):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def __demarrer_worker(self, worker_id: int):
+        pid = os.fork()
+        if pid == 0:
+            # Processus worker
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                self.__executer_worker(worker_id)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                logging.getLogger(__name__).exception("Erreur worker %d" % worker_id)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+
+        self.__logger.info("Worker %d demarre (pid %d)" % (worker_id, pid))
+        self.__workers[pid] = worker_id
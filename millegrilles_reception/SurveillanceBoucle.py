@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from collections import deque
+from typing import Optional
+
+from millegrilles_reception.Metriques import MetriquesReception
+
+# Nombre maximal de frames conservees pour la pile d'un blocage
+PROFONDEUR_PILE = 30
+
+
+class SurveillanceBoucle:
+    """
+    Surveillance de la boucle asyncio.
+
+    Le retard de planification est mesure en repetant un sleep de boucle_intervalle secondes : le temps en surplus
+    au reveil est expose dans reception_boucle_retard_secondes.
+
+    Une thread de surveillance verifie le battement de la boucle. Lorsque la boucle ne s'est pas reveillee depuis
+    plus de boucle_seuil_blocage secondes, la pile de la thread de la boucle et la tache asyncio courante sont
+    capturees (sys._current_frames) pendant que le callback bloquant est encore en execution. Les blocages les plus
+    recents sont disponibles sous /reception/admin/boucle (RECEPTION_ADMIN_JETON).
+    """
+
+    def __init__(self, configuration, metriques: MetriquesReception):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__metriques = metriques
+        self.__intervalle = configuration.boucle_intervalle
+        self.__seuil_blocage = configuration.boucle_seuil_blocage
+
+        self.__retard_dernier = 0.0
+        self.__retard_max = 0.0
+
+        # Battement de la boucle (time.monotonic), lu par la thread de surveillance
+        self.__battement = 0.0
+        # Blocages ajoutes par la thread de surveillance et lus par la boucle (get_blocages), sous verrou
+        self.__verrou_blocages = threading.Lock()
+        self.__blocages: deque[dict] = deque(maxlen=configuration.boucle_blocages_conserves)
+        self.__blocage_courant: Optional[dict] = None
+        self.__nombre_blocages = 0
+
+    async def run(self, stop_event: asyncio.Event):
+        boucle = asyncio.get_running_loop()
+        intervalle = self.__intervalle
+        observer = self.__metriques.boucle_retard.observer
+
+        arret_surveillance = threading.Event()
+        thread_surveillance = None
+        if self.__seuil_blocage > 0:
+            self.__battement = time.monotonic()
+            thread_surveillance = threading.Thread(
+                target=self.__surveiller, args=(boucle, threading.get_ident(), arret_surveillance),
+                name='surveillance_boucle', daemon=True)
+            thread_surveillance.start()
+
+        try:
+            while stop_event.is_set() is False:
+                debut = boucle.time()
+                await asyncio.sleep(intervalle)
+                retard = max(0.0, boucle.time() - debut - intervalle)
+                self.__battement = time.monotonic()
+                observer(retard)
+                self.__retard_dernier = retard
+                if retard > self.__retard_max:
+                    self.__retard_max = retard
+
+                blocage = self.__blocage_courant
+                if blocage is not None:
+                    # Fin du blocage detecte par la thread de surveillance
+                    self.__blocage_courant = None
+                    blocage['duree'] = retard
+                    self.__metriques.boucle_blocages.incrementer()
+                    self.__logger.warning("Boucle bloquee %.3f secs, tache %s\n%s" % (
+                        retard, blocage['tache'], ''.join(blocage['pile'][-5:])))
+        finally:
+            arret_surveillance.set()
+            if thread_surveillance is not None:
+                thread_surveillance.join(1)
+
+    def __surveiller(self, boucle: asyncio.AbstractEventLoop, thread_boucle: int, arret: threading.Event):
+        """ Thread de surveillance, capture la pile de la boucle lorsque le battement est en retard """
+        limite = self.__intervalle + self.__seuil_blocage
+        periode = max(0.01, self.__seuil_blocage / 2)
+        battement_signale = None
+        while arret.wait(periode) is False:
+            battement = self.__battement
+            if battement == battement_signale:
+                continue  # Blocage deja capture
+            retard = time.monotonic() - battement
+            if retard < limite:
+                continue
+
+            battement_signale = battement
+            frame = sys._current_frames().get(thread_boucle)
+            pile = traceback.format_stack(frame, limit=PROFONDEUR_PILE) if frame is not None else list()
+            tache = None
+            try:
+                tache_courante = asyncio.current_task(boucle)
+                if tache_courante is not None:
+                    tache = '%s (%s)' % (tache_courante.get_name(), tache_courante.get_coro().__qualname__)
+            except RuntimeError:
+                pass
+
+            blocage = {'date': time.time(), 'duree': None, 'tache': tache, 'pile': pile}
+            with self.__verrou_blocages:
+                self.__nombre_blocages += 1
+                self.__blocages.append(blocage)
+            self.__blocage_courant = blocage
+
+    def get_metriques(self) -> dict:
+        return {
+            'intervalle': self.__intervalle,
+            'seuil_blocage': self.__seuil_blocage,
+            'retard_dernier': self.__retard_dernier,
+            'retard_max': self.__retard_max,
+            'blocages': self.__nombre_blocages,
+        }
+
+    def get_blocages(self) -> dict:
+        """ :return: Metriques et blocages les plus recents, du plus recent au plus ancien """
+        with self.__verrou_blocages:
+            reponse = self.get_metriques()
+            reponse['derniers_blocages'] = list(reversed(self.__blocages))
+        return reponse
@@ -0,0 +1,181 @@
+import heapq
+import itertools
+import random
+import time
+
+from contextlib import nullcontext
+from contextvars import ContextVar
+from typing import Optional
+
+try:
+    from opentelemetry import context as otel_context, trace as otel_trace
+except ImportError:
+    otel_context = None
+    otel_trace = None  # Optionnel, export des spans vers OpenTelemetry
+
+# Contexte partage (reutilisable) retourne lorsque le tracage est desactive ou que la requete n'est pas echantillonnee
+NOOP = nullcontext()
+
+_span_courant: ContextVar[Optional['Span']] = ContextVar('reception_span_courant', default=None)
+
+
+class Span:
+    """
+    Etape d'une requete. Les spans enfants sont crees dans le contexte (contextvars) du span courant.
+    """
+    __slots__ = ('nom', 'attributs', 'racine', 'enfants', 'debut', 'fin', '_token', '_otel', '_otel_token')
+
+    def __init__(self, nom: str, attributs: dict, racine: Optional['TraceRequete'] = None):
+        self.nom = nom
+        self.attributs = attributs
+        self.racine = racine or self
+        self.enfants: list[Span] = list()
+        self.debut = 0.0
+        self.fin = 0.0
+        self._token = None
+        self._otel = None
+        self._otel_token = None
+
+    def __enter__(self):
+        parent = _span_courant.get()
+        if parent is not None:
+            parent.enfants.append(self)
+        tracer_otel = self.racine.tracer_otel
+        if tracer_otel is not None:
+            # Span enfant du span OTel parent, rendu courant pour l'instrumentation (e.g. clients MQ/HTTP)
+            contexte_parent = None
+            if parent is not None and parent._otel is not None:
+                contexte_parent = otel_trace.set_span_in_context(parent._otel)
+            self._otel = tracer_otel.start_span(self.nom, context=contexte_parent, attributes=self.attributs)
+            self._otel_token = otel_context.attach(otel_trace.set_span_in_context(self._otel))
+        self._token = _span_courant.set(self)
+        self.debut = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.fin = time.perf_counter()
+        _span_courant.reset(self._token)
+        if exc_type is not None:
+            self.attributs['erreur'] = exc_type.__name__
+        if self._otel is not None:
+            otel_context.detach(self._otel_token)
+            self._otel.set_attributes(self.attributs)
+            self._otel.end()
+        return False
+
+    @property
+    def duree(self) -> float:
+        return self.fin - self.debut
+
+    def to_dict(self, origine: float) -> dict:
+        valeur = {
+            'nom': self.nom,
+            'debut_ms': (self.debut - origine) * 1000,
+            'duree_ms': self.duree * 1000,
+        }
+        if self.attributs:
+            valeur['attributs'] = self.attributs
+        if self.enfants:
+            valeur['enfants'] = [e.to_dict(origine) for e in self.enfants]
+        return valeur
+
+
+class TraceRequete(Span):
+    """ Span racine d'une requete. Conserve par le Traceur a la fin si elle fait partie des plus lentes. """
+    __slots__ = ('traceur', 'tracer_otel', 'date')
+
+    def __init__(self, traceur: 'Traceur', nom: str, attributs: dict, tracer_otel=None):
+        self.traceur = traceur
+        self.tracer_otel = tracer_otel
+        self.date = time.time()
+        super().__init__(nom, attributs)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        super().__exit__(exc_type, exc_val, exc_tb)
+        self.traceur.terminer(self)
+        return False
+
+    def to_dict(self, origine: Optional[float] = None) -> dict:
+        valeur = super().to_dict(self.debut)
+        valeur['date'] = self.date
+        return valeur
+
+
+class Traceur:
+    """
+    Tracage optionnel des etapes du traitement des posts. Lorsque desactive, trace() et span() retournent un
+    contexte no-op partage. Les traces les plus lentes de la fenetre courante et de la precedente (traces_fenetre
+    secondes) sont conservees en memoire (admin /reception/admin/traces).
+    """
+
+    def __init__(self, configuration):
+        self.__actif = configuration.traces_actives
+        self.__echantillonnage = configuration.traces_echantillonnage
+        self.__nombre_conservees = configuration.traces_conservees
+        self.__fenetre = configuration.traces_fenetre
+
+        self.__tracer_otel = None
+        if self.__actif and configuration.traces_otel and otel_trace is not None:
+            self.__tracer_otel = otel_trace.get_tracer('millegrilles_reception')
+
+        # Heap min des traces les plus lentes de la fenetre courante : (duree, sequence, trace)
+        self.__plus_lentes: list[tuple[float, int, dict]] = list()
+        self.__plus_lentes_precedentes: list[tuple[float, int, dict]] = list()
+        self.__debut_fenetre = time.monotonic()
+        self.__sequence = itertools.count()
+        self.__nombre_traces = 0
+
+    @property
+    def actif(self) -> bool:
+        return self.__actif
+
+    def trace(self, nom: str, **attributs):
+        """ Demarre la trace d'une requete (span racine) """
+        if self.__actif is False:
+            return NOOP
+        if self.__echantillonnage < 1.0 and random.random() >= self.__echantillonnage:
+            return NOOP
+        return TraceRequete(self, nom, attributs, self.__tracer_otel)
+
+    @staticmethod
+    def span(nom: str, **attributs):
+        """ Span enfant du span courant, no-op si aucune trace n'est en cours """
+        parent = _span_courant.get()
+        if parent is None:
+            return NOOP
+        return Span(nom, attributs, parent.racine)
+
+    @staticmethod
+    def ajouter_attributs(**attributs):
+        """ Ajoute des attributs (e.g. batch_id, correlation_id) a la trace en cours """
+        span = _span_courant.get()
+        if span is not None:
+            span.racine.attributs.update(attributs)
+
+    def __rotation(self):
+        """ Debute une nouvelle fenetre lorsque la courante est expiree, elle devient la fenetre precedente """
+        now = time.monotonic()
+        ecoule = now - self.__debut_fenetre
+        if ecoule < self.__fenetre:
+            return
+        self.__plus_lentes_precedentes = self.__plus_lentes if ecoule < 2 * self.__fenetre else list()
+        self.__plus_lentes = list()
+        self.__debut_fenetre = now
+
+    def terminer(self, trace: TraceRequete):
+        self.__nombre_traces += 1
+        self.__rotation()
+        duree = trace.duree
+        plus_lentes = self.__plus_lentes
+        if len(plus_lentes) < self.__nombre_conservees:
+            heapq.heappush(plus_lentes, (duree, next(self.__sequence), trace.to_dict()))
+        elif duree > plus_lentes[0][0]:
+            heapq.heapreplace(plus_lentes, (duree, next(self.__sequence), trace.to_dict()))
+
+    def get_traces(self) -> dict:
+        """ :return: Traces les plus lentes des fenetres courante et precedente, de la plus lente a la plus rapide """
+        self.__rotation()
+        plus_lentes = sorted(self.__plus_lentes + self.__plus_lentes_precedentes, reverse=True)
+        traces = [t[2] for t in plus_lentes[:self.__nombre_conservees]]
+        return {'actif': self.__actif, 'nombre_traces': self.__nombre_traces, 'fenetre': self.__fenetre,
+                'traces': traces}
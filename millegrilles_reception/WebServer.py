@@ -1,6 +1,8 @@
 import asyncio
+import hmac
 import logging
 import pathlib
+import ssl
 
 from aiohttp import web
 from aiohttp.web_request import Request
@@ -10,25 +12,41 @@ from millegrilles_web.WebServer import WebServer
 from millegrilles_web.TransfertFichiers import ReceptionFichiersMiddleware
 
 from millegrilles_reception import Constantes as ConstantesReception
+from millegrilles_reception.Configuration import ConfigurationWeb
+from millegrilles_reception.LimiteurDebit import LimiteurDebitReception
+from millegrilles_reception.Metriques import CONTENT_TYPE_METRIQUES
+from millegrilles_reception.SuperviseurWorkers import creer_socket_reuseport
 from millegrilles_reception.MessageReceptionHandler import MessageReceptionHandler
+from millegrilles_reception.MessagesBatchHandler import MessagesBatchHandler
 from millegrilles_reception.FichiersDechiffresHandler import FichiersDechiffresHandler
 
 
 class WebServerReception(WebServer):
 
     def __init__(self, etat, commandes, messages_handler: MessageReceptionHandler,
-                 fichiers_dechiffres_handler: FichiersDechiffresHandler):
+                 fichiers_dechiffres_handler: FichiersDechiffresHandler, reuse_port=False):
         self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
 
         super().__init__(ConstantesReception.WEB_APP_PATH, etat, commandes)
         self.__messages_handler = messages_handler
         self.__fichiers_dechiffres_handler = fichiers_dechiffres_handler
+        # Mode pre-fork : chaque worker ecoute sur son propre socket SO_REUSEPORT
+        self.__reuse_port = reuse_port
+        self.__configuration_web: Optional[ConfigurationWeb] = None
+        self.__ssl_context_reuse_port: Optional[ssl.SSLContext] = None
 
         self.__semaphore_web = asyncio.BoundedSemaphore(value=5)
 
         self.__reception_fichiers = ReceptionFichiersMiddleware(
             self.app, self.etat, '/reception/fichiers/upload')
 
+        # Limites de debit par client sur la reception de messages, appliquees avant la lecture du body. Les lots
+        # consomment un jeton par message (MessagesBatchHandler).
+        self.__limiteur_debit = LimiteurDebitReception(
+            self.etat.configuration_reception, [f'{self.app_path}/message'], [f'{self.app_path}/messages/batch'])
+        self.app.middlewares.append(self.__limiteur_debit.middleware)
+        self.__batch_handler = MessagesBatchHandler(etat, messages_handler, self.__limiteur_debit)
+
     def get_nom_app(self) -> str:
         return ConstantesReception.APP_NAME
 
@@ -41,8 +59,16 @@ class WebServerReception(WebServer):
 
         self._charger_configuration(configuration)
         self._charger_ssl()
+
+        if self.__reuse_port:
+            # Site ouvert par ce worker (__run_site_reuse_port) avec la meme configuration que setup
+            self.__configuration_web = ConfigurationWeb()
+            self.__configuration_web.parse_config(configuration)
+            self.__ssl_context_reuse_port = creer_ssl_context(self.__configuration_web)
+
         await self._preparer_routes()
         await self.__reception_fichiers.setup()
+        await self.__messages_handler.setup()
 
     async def setup_socketio(self):
         pass  # Socket-io n'est pas utilise
@@ -53,8 +79,19 @@ class WebServerReception(WebServer):
         self._app.add_routes([
             web.get(f'{self.app_path}/info.json', self.handle_info_session),
             web.post(f'{self.app_path}/message', self.__messages_handler.recevoir_post_web),
+            web.get(f'{self.app_path}/message/{{message_id}}', self.__messages_handler.get_etat_message),
+            web.post(f'{self.app_path}/messages/batch', self.__batch_handler.recevoir_post_batch),
         ])
 
+        if self.etat.configuration_reception.admin_jeton:
+            # Diagnostics internes, exposes seulement avec le jeton d'administration
+            self._app.add_routes([
+                web.get(f'{self.app_path}/metrics', self.handle_metrics),
+                web.get(f'{self.app_path}/admin/info.json', self.handle_admin_info),
+                web.get(f'{self.app_path}/admin/traces', self.handle_traces),
+                web.get(f'{self.app_path}/admin/boucle', self.handle_boucle),
+            ])
+
     async def run(self):
         """
         Override pour ajouter thread reception fichiers
@@ -62,22 +99,96 @@ class WebServerReception(WebServer):
         """
         self.__logger.info("Running")
 
+        if self.__reuse_port:
+            run_site = self.__run_site_reuse_port()
+        else:
+            run_site = super().run()
+
         tasks = [
-            super().run(),
-            self.__reception_fichiers.run(self._stop_event)
+            run_site,
+            self.__reception_fichiers.run(self._stop_event),
+            self.__messages_handler.run(self._stop_event),
         ]
 
         await asyncio.tasks.wait(tasks, return_when=asyncio.tasks.FIRST_COMPLETED)
 
         self.__logger.info("Run termine")
 
+    async def __run_site_reuse_port(self):
+        configuration_web = self.__configuration_web
+
+        runner = web.AppRunner(self._app)
+        await runner.setup()
+        sock = creer_socket_reuseport(configuration_web.port)
+        site = web.SockSite(runner, sock, ssl_context=self.__ssl_context_reuse_port)
+        try:
+            await site.start()
+            self.__logger.info("Site demarre sur le port %d (SO_REUSEPORT)" % configuration_web.port)
+            await self._stop_event.wait()
+        finally:
+            await runner.cleanup()
+
     async def handle_info_session(self, request: Request):
         async with self.__semaphore_web:
             return web.HTTPOk()
 
+    def __verifier_admin(self, request: Request) -> bool:
+        """ :return: True si la requete presente le jeton d'administration (Authorization: Bearer) """
+        jeton = self.etat.configuration_reception.admin_jeton
+        autorisation = request.headers.get('Authorization', '')
+        if jeton is None or autorisation.startswith('Bearer ') is False:
+            return False
+        return hmac.compare_digest(autorisation[7:].encode('utf-8'), jeton.encode('utf-8'))
+
+    async def handle_admin_info(self, request: Request):
+        """ Etat de l'admission, des limites de debit, du service crypto et de la boucle """
+        if self.__verifier_admin(request) is False:
+            return web.HTTPUnauthorized()
+        async with self.__semaphore_web:
+            reponse = {
+                'admission': self.__messages_handler.get_metriques_admission(),
+                'limites': self.__limiteur_debit.get_metriques(),
+                'crypto': self.etat.service_crypto.get_metriques(),
+                'boucle': self.etat.surveillance_boucle.get_metriques(),
+            }
+            metriques_dedup = self.__fichiers_dechiffres_handler.get_metriques_dedup()
+            if metriques_dedup is not None:
+                reponse['dedup'] = metriques_dedup
+            producer_loopback = self.etat.producer_loopback
+            if producer_loopback is not None:
+                reponse['producer_loopback'] = producer_loopback.get_metriques()
+            return web.json_response(reponse, headers={'Cache-Control': 'no-store'})
+
+    async def handle_metrics(self, request: Request):
+        """ Metriques en format texte Prometheus (scrape avec authorization Bearer) """
+        if self.__verifier_admin(request) is False:
+            return web.HTTPUnauthorized()
+        body = self.etat.metriques.exporter()
+        return web.Response(body=body.encode('utf-8'), headers={
+            'Content-Type': CONTENT_TYPE_METRIQUES, 'Cache-Control': 'no-store'})
+
+    async def handle_traces(self, request: Request):
+        """ Traces des posts les plus lents (RECEPTION_TRACES) """
+        if self.__verifier_admin(request) is False:
+            return web.HTTPUnauthorized()
+        return web.json_response(self.etat.traceur.get_traces(), headers={'Cache-Control': 'no-store'})
+
+    async def handle_boucle(self, request: Request):
+        """ Retard de la boucle asyncio et piles des callbacks bloquants les plus recents """
+        if self.__verifier_admin(request) is False:
+            return web.HTTPUnauthorized()
+        return web.json_response(self.etat.surveillance_boucle.get_blocages(), headers={'Cache-Control': 'no-store'})
+
     @property
     def fichiers_dechiffres_handler(self):
         return self.__fichiers_dechiffres_handler
 
     async def ajouter_upload(self, path_upload: pathlib.Path):
         await self.__reception_fichiers.ajouter_upload(path_upload)
+
+
+def creer_ssl_context(configuration: ConfigurationWeb) -> ssl.SSLContext:
+    """ Contexte TLS du serveur avec le certificat web de la configuration (aucun certificat client requis) """
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(configuration.web_cert_pem_path, configuration.web_key_pem_path)
+    return ssl_context
@@ -11,6 +11,10 @@ from millegrilles_messages.docker.Entretien import TacheEntretien
 
 from millegrilles_web.WebAppMain import WebAppMain, LOGGING_NAMES as LOGGING_NAMES_WEB, adjust_logging
 from millegrilles_reception.WebServer import WebServerReception
+from millegrilles_reception.Configuration import ConfigurationReception
+from millegrilles_reception.StagingWorkers import get_dir_staging_worker, lister_staging_orphelins, \
+    reprendre_staging
+from millegrilles_reception.SuperviseurWorkers import SuperviseurWorkers
 from millegrilles_reception.Commandes import CommandReceptionHandler
 from millegrilles_reception.EtatReception import EtatReception
 from millegrilles_reception.MessageReceptionHandler import MessageReceptionHandler
@@ -24,13 +28,26 @@ LOGGING_NAMES.extend(LOGGING_NAMES_WEB)
 
 class ReceptionAppMain(WebAppMain):
 
-    def __init__(self):
+    def __init__(self, worker_id: Optional[int] = None, nombre_workers: int = 1):
         self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
         super().__init__()
+        # Mode pre-fork : identifiant du worker, None si un seul processus
+        self.__worker_id = worker_id
+        self.__nombre_workers = nombre_workers
         self.__reception_handler: Optional[MessageReceptionHandler] = None
         self.__fichier_dechiffres_handler: Optional[FichiersDechiffresHandler] = None
+        self.__task_reprise_intake: Optional[asyncio.Task] = None
+        self.__task_surveillance_boucle: Optional[asyncio.Task] = None
 
     def init_etat(self):
+        # Chaque worker a son propre staging (outbox, uploads, cache des certificats)
+        dir_staging = self.config.dir_staging
+        self.config.dir_staging = get_dir_staging_worker(dir_staging, self.__worker_id)
+
+        # Reprise du staging des workers retires lorsque le nombre de workers change
+        for dir_orphelin in lister_staging_orphelins(dir_staging, self.__worker_id, self.__nombre_workers):
+            reprendre_staging(dir_orphelin, self.config.dir_staging)
+
         return EtatReception(self.config)
 
     def init_command_handler(self) -> CommandReceptionHandler:
@@ -42,19 +59,46 @@ class ReceptionAppMain(WebAppMain):
 
     async def configurer(self):
         await super().configurer()
+
+        # Surveillance de la boucle asyncio : retard (reception_boucle_retard_secondes) et callbacks bloquants
+        self.__task_surveillance_boucle = asyncio.create_task(self.etat.surveillance_boucle.run(self._stop_event))
+
         await self.__fichier_dechiffres_handler.setup()
 
+        # Certificats de chiffrage de l'execution precedente, rafraichis par les taches d'entretien
+        await self.etat.charger_cache_certificats()
+
+        # Recuperation du staging avant la reception de nouveaux fichiers
+        await self.__fichier_dechiffres_handler.recuperer_staging()
+
+        # Reprendre les transferts de batches interrompus (execute en arriere-plan, requiert le serveur web)
+        self.__task_reprise_intake = asyncio.create_task(self.__fichier_dechiffres_handler.reprendre_intake_batches())
+
         self.etat.ajouter_tache_entretien(
             TacheEntretien(datetime.timedelta(minutes=10), self.etat.charger_cles_chiffrage))
         self.etat.ajouter_tache_entretien(
             TacheEntretien(datetime.timedelta(minutes=20), self.etat.nettoyer_certificats_stale))
+        self.etat.ajouter_tache_entretien(
+            TacheEntretien(datetime.timedelta(minutes=15), self.__fichier_dechiffres_handler.nettoyer_staging))
+        # Reprise des intake_batch en erreur apres l'acceptation du message (marqueur d'intake)
+        self.etat.ajouter_tache_entretien(
+            TacheEntretien(datetime.timedelta(minutes=5), self.__fichier_dechiffres_handler.reprendre_intake_batches))
 
     async def configurer_web_server(self):
         self.__reception_handler = MessageReceptionHandler(self)
         self._web_server = WebServerReception(self.etat, self._commandes_handler, self.__reception_handler,
-                                              self.__fichier_dechiffres_handler)
+                                              self.__fichier_dechiffres_handler,
+                                              reuse_port=self.__worker_id is not None)
         await self._web_server.setup(stop_event=self._stop_event)
 
+    async def run(self):
+        try:
+            await super().run()
+        finally:
+            # Fermer les pools de threads (chiffrage des fichiers, crypto des messages)
+            await self.__fichier_dechiffres_handler.fermer()
+            self.etat.service_crypto.fermer()
+
     def exit_gracefully(self, signum=None, frame=None):
         self.__logger.info("Fermer application, signal: %d" % signum)
         self._stop_event.set()
@@ -80,8 +124,8 @@ class ReceptionAppMain(WebAppMain):
         await self._web_server.ajouter_upload(path_upload)
 
 
-async def demarrer():
-    main_inst = ReceptionAppMain()
+async def demarrer(worker_id: Optional[int] = None, nombre_workers: int = 1):
+    main_inst = ReceptionAppMain(worker_id, nombre_workers)
 
     signal.signal(signal.SIGINT, main_inst.exit_gracefully)
     signal.signal(signal.SIGTERM, main_inst.exit_gracefully)
@@ -100,7 +144,16 @@ def main():
     logging.basicConfig()
     for log in LOGGING_NAMES:
         logging.getLogger(log).setLevel(logging.INFO)
-    asyncio.run(demarrer())
+
+    configuration = ConfigurationReception()
+    configuration.parse_config()
+    if configuration.workers > 1:
+        # Mode pre-fork, les workers sont demarres avant toute connexion (MQ, event loop)
+        superviseur = SuperviseurWorkers(
+            configuration.workers, lambda worker_id: asyncio.run(demarrer(worker_id, configuration.workers)))
+        superviseur.run()
+    else:
+        asyncio.run(demarrer())
 
 
 if __name__ == '__main__':
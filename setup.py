@@ -28,5 +28,6 @@ setup(
     author='Mathieu Dugre',
     author_email='mathieu.dugre@mdugre.info',
     description="Serveur de reception externe pour MilleGrilles",
-    install_requires=[]
+    install_requires=[],
+    extras_require={'orjson': ['orjson']},
 )
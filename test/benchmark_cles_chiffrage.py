@@ -0,0 +1,95 @@
+"""
+Benchmark du chiffrage des cles des fichiers d'un post (key wrapping) pour les certificats de chiffrage, avant et
+apres le SnapshotCertificatsChiffrage.
+
+Le snapshot partage la liste des enveloppes au lieu de la reconstruire a chaque message. Les cles publiques X25519
+des certificats ne sont pas pre-extraites : chaque cle secrete passe par enveloppe.chiffrage_asymmetrique de
+millegrilles_messages, qui derive la cle publique du certificat a chaque appel. Le cout mesure est donc le meme
+avant et apres, aucune acceleration n'est attendue de ce benchmark.
+
+Les enveloppes sont simulees avec des cles X25519 generees (cryptography) et re-extraient la cle publique a chaque
+chiffrage comme EnveloppeCertificat, sans requerir une millegrille.
+
+Usage : python test/benchmark_cles_chiffrage.py [nombre_messages] [fichiers_par_message]
+"""
+import base64
+import datetime
+import os
+import sys
+import time
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives import serialization
+
+from millegrilles_reception.EtatReception import CertificatChiffrage, SnapshotCertificatsChiffrage
+
+
+class EnveloppeSimulee:
+
+    def __init__(self, domaine: str):
+        cle_privee = X25519PrivateKey.generate()
+        self.__public_bytes = cle_privee.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        self.fingerprint = os.urandom(16).hex()
+        self.get_domaines = [domaine]
+
+    def get_public_x25519(self) -> bytes:
+        # La cle publique est extraite du certificat a chaque appel, comme EnveloppeCertificat
+        return X25519PublicKey.from_public_bytes(self.__public_bytes).public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+    def chiffrage_asymmetrique(self, cle_secrete: bytes):
+        """ :return: Cle chiffree (str, inseree telle quelle dans les commandes signees) et fingerprint """
+        cle_publique = X25519PublicKey.from_public_bytes(self.get_public_x25519())
+        ephemere = X25519PrivateKey.generate()
+        cle_partagee = ephemere.exchange(cle_publique)
+        nonce = os.urandom(12)
+        cle_chiffree = ChaCha20Poly1305(cle_partagee).encrypt(nonce, cle_secrete, None)
+        return base64.b64encode(nonce + cle_chiffree).decode('utf-8'), self.fingerprint
+
+
+def chiffrage_original(certificats: dict, cles: list[bytes]):
+    """ Une passe par cle, comme avant le snapshot """
+    for cle_secrete in cles:
+        cles_chiffrees = dict()
+        for fingerprint, cert in certificats.items():
+            cle_chiffree, _fingerprint = cert.enveloppe.chiffrage_asymmetrique(cle_secrete)
+            cles_chiffrees[fingerprint] = cle_chiffree
+
+
+def chiffrage_snapshot(snapshot_certificats: SnapshotCertificatsChiffrage, cles: list[bytes]):
+    snapshot_certificats.chiffrer_cles_secretes(cles)
+
+
+def mesurer(nombre_messages: int, fonction, *args) -> float:
+    """ :return: Duree CPU par message (us) """
+    debut = time.process_time()
+    for _ in range(nombre_messages):
+        fonction(*args)
+    return (time.process_time() - debut) / nombre_messages * 1_000_000
+
+
+def main():
+    nombre_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    fichiers_par_message = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    enveloppes = [EnveloppeSimulee('MaitreDesCles'), EnveloppeSimulee('MaitreDesCles'), EnveloppeSimulee('Messages')]
+    certificats = {
+        e.fingerprint: CertificatChiffrage(e, e.fingerprint, datetime.datetime.utcnow(), frozenset(e.get_domaines))
+        for e in enveloppes
+    }
+    snapshot_certificats = SnapshotCertificatsChiffrage.vide().remplacer(list(certificats.values()))
+    cles = [os.urandom(32) for _ in range(fichiers_par_message)]
+
+    us_chiffrage_original = mesurer(nombre_messages, chiffrage_original, certificats, cles)
+    us_chiffrage_snapshot = mesurer(nombre_messages, chiffrage_snapshot, snapshot_certificats, cles)
+
+    print("%d messages, %d fichiers/message, %d certificats" % (
+        nombre_messages, fichiers_par_message, len(snapshot_certificats)))
+    print("Chiffrage des cles : original %.1f us/message, snapshot %.1f us/message" % (
+        us_chiffrage_original, us_chiffrage_snapshot))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Microbenchmark du traitement d'un post application/json (parse, validation, serialisation des headers).
+Compare le chemin d'origine (json, double serialisation des headers) au chemin rapide de MessageReceptionHandler.
+
+Usage : python test/benchmark_message_json.py [nombre_iterations]
+"""
+import json
+import sys
+import time
+
+from millegrilles_reception import MessageReceptionHandler as Handler
+from millegrilles_reception.MessageReceptionHandler import MessagePrepare
+
+MESSAGE = json.dumps({
+    'destinataires': ['proprietaire', 'bouzou'],
+    'contenu': "<p>Un message de moi.</p><p><br></p><p>Test</p>" * 20,
+    'reply_to': 'pas_proprietaire',
+    'auteur': 'C\'est moi'
+}).encode('utf-8')
+
+HEADERS = {
+    'Host': 'reception.example.com',
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/124.0',
+    'Accept': '*/*',
+    'Accept-Language': 'fr-CA,fr;q=0.8,en-US;q=0.5,en;q=0.3',
+    'Content-Type': 'application/json',
+    'Content-Length': str(len(MESSAGE)),
+    'X-Forwarded-For': '192.0.2.10',
+    'X-Real-IP': '192.0.2.10',
+}
+
+
+def traiter_original():
+    headers_web = dict(HEADERS)
+    json.dumps(headers_web, indent=2)  # Log debug construit meme si desactive
+    message_post = json.loads(MESSAGE)
+    origine = json.dumps(headers_web)
+    MessagePrepare.parse(message_post)
+    return {'origine': origine}.copy()
+
+
+def traiter_rapide():
+    headers_web = dict(HEADERS)
+    message_post = Handler.json_loads(MESSAGE)
+    message_prepare = MessagePrepare.parse(message_post)
+    origine = Handler.json_dumps(headers_web)
+    return message_prepare, {'origine': origine}
+
+
+def mesurer(fonction, iterations: int) -> float:
+    debut = time.process_time()
+    for _ in range(iterations):
+        fonction()
+    duree = time.process_time() - debut
+    return iterations / duree
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    print("Codec json rapide : %s" % ('orjson' if Handler.orjson is not None else 'aucun (json)'))
+
+    original = mesurer(traiter_original, iterations)
+    rapide = mesurer(traiter_rapide, iterations)
+
+    print("Original : %.0f req/s/coeur" % original)
+    print("Rapide   : %.0f req/s/coeur" % rapide)
+    print("Gain     : x%.2f" % (rapide / original))
+
+
+if __name__ == '__main__':
+    main()
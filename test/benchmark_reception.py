@@ -0,0 +1,395 @@
+"""
+Benchmark de charge de la reception de messages.
+
+Demarre WebServerReception dans le processus avec un etat simule (producer MQ qui repond a posterV1, certificats
+X25519 generes) et envoie des posts json, multipart (N fichiers de M bytes) ou un melange des deux avec une
+concurrence configurable. Avec --url, les posts sont envoyes a un serveur existant (remplace submit_message.py).
+
+Les resultats (req/s, percentiles de latence, CPU par requete, RSS max) sont affiches et ecrits en json (--sortie)
+pour comparer les executions.
+
+Usage :
+    python test/benchmark_reception.py --scenario json --requetes 2000 --concurrence 20
+    python test/benchmark_reception.py --scenario multipart --fichiers 3 --taille-fichier 1048576
+    python test/benchmark_reception.py --scenario mixte --ratio-multipart 0.2 --sortie resultats.json
+    python test/benchmark_reception.py --url https://reception.example.com/reception/message --requetes 1
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+
+import aiohttp
+
+from aiohttp import web
+from typing import Optional
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+from benchmark_cles_chiffrage import EnveloppeSimulee
+
+from millegrilles_reception import Constantes as ConstantesReception
+from millegrilles_reception.Configuration import ConfigurationReception
+from millegrilles_reception.EtatReception import CertificatChiffrage, SnapshotCertificatsChiffrage
+from millegrilles_reception.FichiersDechiffresHandler import FichiersDechiffresHandler
+from millegrilles_reception.MessageReceptionHandler import MessageReceptionHandler
+from millegrilles_reception.Metriques import MetriquesReception
+from millegrilles_reception.ServiceCrypto import ServiceCrypto
+from millegrilles_reception.SurveillanceBoucle import SurveillanceBoucle
+from millegrilles_reception.Traces import Traceur
+from millegrilles_reception.WebServer import WebServerReception
+
+MESSAGE = {
+    'destinataires': ['proprietaire', 'bouzou'],
+    'contenu': """<p>Un message de moi.</p><p><br></p><p>Test</p>
+<p>Heuille c'est pas pire, ca marche.</p>
+    """,
+    'reply_to': 'pas_proprietaire',
+    'auteur': 'C\'est moi'
+}
+
+
+class ReponseSimulee:
+
+    def __init__(self, parsed: dict):
+        self.parsed = parsed
+
+
+class ProducerSimule:
+    """ Repond ok a posterV1 apres un delai (latence MQ) """
+
+    def __init__(self, latence: float):
+        self.__latence = latence
+        self.messages_recus = 0
+
+    async def emettre_attendre(self, message, routing_key: str, exchange=None, correlation_id=None, timeout=None):
+        self.messages_recus += 1
+        if self.__latence > 0:
+            await asyncio.sleep(self.__latence)
+        return ReponseSimulee({'ok': True, '__original': None})
+
+
+class FormatteurSimule:
+    """
+    Chiffrage (ChaCha20Poly1305, cle secrete chiffree pour chaque certificat) et signature (Ed25519) d'un cout
+    comparable au formatteur de millegrilles_messages.
+    """
+
+    def __init__(self):
+        self.__cle_signature = Ed25519PrivateKey.generate()
+
+    def signer_message(self, kind: int, contenu: dict, domaine=None, ajouter_chaine=False, action=None):
+        message_id = os.urandom(32).hex()
+        contenu_bytes = json.dumps(contenu).encode('utf-8')
+        signature = self.__cle_signature.sign(contenu_bytes + message_id.encode('utf-8'))
+        message = {'id': message_id, 'kind': kind, 'contenu': contenu_bytes.decode('utf-8'),
+                   'routage': {'domaine': domaine, 'action': action}, 'sig': signature.hex()}
+        return message, message_id
+
+    async def chiffrer_message(self, certificats: list, kind: int, message: dict, domaine=None, action=None):
+        cle_secrete = ChaCha20Poly1305.generate_key()
+        nonce = os.urandom(12)
+        contenu_chiffre = ChaCha20Poly1305(cle_secrete).encrypt(nonce, json.dumps(message).encode('utf-8'), None)
+        cles = dict()
+        for enveloppe in certificats:
+            cle_chiffree, fingerprint = enveloppe.chiffrage_asymmetrique(cle_secrete)
+            cles[fingerprint] = cle_chiffree
+        contenu = {'nonce': nonce.hex(), 'contenu': contenu_chiffre.hex(), 'cles': cles}
+        return self.signer_message(kind, contenu, domaine, False, action)
+
+
+class ConfigurationSimulee:
+
+    def __init__(self, dir_staging: str):
+        self.dir_staging = dir_staging
+
+
+class EtatSimule:
+    """ Remplace EtatReception : aucune connexion MQ ni certificats de millegrille requis """
+
+    def __init__(self, dir_staging: str, configuration_reception: ConfigurationReception, latence_mq: float):
+        self.configuration = ConfigurationSimulee(dir_staging)
+        self.configuration_reception = configuration_reception
+        self.metriques = MetriquesReception()
+        self.traceur = Traceur(configuration_reception)
+        self.formatteur_message = FormatteurSimule()
+        self.producer = ProducerSimule(latence_mq)
+        self.service_crypto = ServiceCrypto(configuration_reception, self.metriques)
+        self.surveillance_boucle = SurveillanceBoucle(configuration_reception, self.metriques)
+
+        enveloppes = [EnveloppeSimulee('MaitreDesCles'), EnveloppeSimulee('MaitreDesCles'), EnveloppeSimulee('Messages')]
+        self.certificats_chiffrage = SnapshotCertificatsChiffrage.vide().remplacer([
+            CertificatChiffrage(e, e.fingerprint, datetime.datetime.utcnow(), frozenset(e.get_domaines))
+            for e in enveloppes
+        ])
+        self.cle_publique_millegrille = EnveloppeSimulee('millegrille').get_public_x25519()
+
+    async def producer_wait(self):
+        return self.producer
+
+    def verifier_rafraichissement_certificats(self):
+        pass
+
+    def get_certificats_chiffrage(self):
+        return self.certificats_chiffrage.enveloppes
+
+    def chiffrer_cles_secretes(self, cles_secretes: list[bytes]) -> list[dict]:
+        return self.certificats_chiffrage.chiffrer_cles_secretes(cles_secretes)
+
+
+class AppSimulee:
+    """ Remplace ReceptionAppMain pour les handlers. L'intake des fichiers est ignore. """
+
+    def __init__(self, etat: EtatSimule):
+        self.etat = etat
+        self.fichiers_dechiffres_handler = FichiersDechiffresHandler(self)
+        self.reception_handler = MessageReceptionHandler(self)
+        self.uploads = 0
+
+    async def ajouter_upload(self, path_upload):
+        self.uploads += 1
+
+
+class WebServerBenchmark(WebServerReception):
+    """ Serveur sans TLS sur 127.0.0.1 """
+
+    def __init__(self, app: AppSimulee):
+        super().__init__(app.etat, None, app.reception_handler, app.fichiers_dechiffres_handler)
+        self.__app_simulee = app
+        self.__runner: Optional[web.AppRunner] = None
+        self.__task_handler: Optional[asyncio.Task] = None
+        self.__task_surveillance: Optional[asyncio.Task] = None
+
+    async def demarrer(self, stop_event: asyncio.Event) -> int:
+        """ :return: Port du serveur """
+        self._stop_event = stop_event
+        await self.__app_simulee.fichiers_dechiffres_handler.setup()
+        await self._preparer_routes()
+        await self.__app_simulee.reception_handler.setup()
+        # Dispatcher de l'outbox (mode async)
+        self.__task_handler = asyncio.create_task(self.__app_simulee.reception_handler.run(stop_event))
+        self.__task_surveillance = asyncio.create_task(self.etat.surveillance_boucle.run(stop_event))
+
+        self.__runner = web.AppRunner(self.app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, '127.0.0.1', 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    async def arreter(self):
+        self._stop_event.set()
+        await self.__task_handler
+        await self.__task_surveillance
+        await self.__runner.cleanup()
+
+
+def preparer_configuration(args) -> ConfigurationReception:
+    configuration = ConfigurationReception()
+    configuration.parse_config(configuration={
+        ConstantesReception.ENV_MODE_ACK: args.mode_ack,
+        # Aucune limite de debit, la concurrence du client est admise au complet
+        ConstantesReception.ENV_LIMITE_REQUETES_TAUX: '0',
+        ConstantesReception.ENV_LIMITE_BYTES_TAUX: '0',
+        ConstantesReception.ENV_ADMISSION_JSON_CONCURRENCE: str(args.concurrence),
+        ConstantesReception.ENV_ADMISSION_JSON_FILE: str(args.concurrence),
+        ConstantesReception.ENV_ADMISSION_MULTIPART_FILE: str(args.concurrence),
+        ConstantesReception.ENV_CRYPTO_WORKERS: str(args.crypto_workers),
+    })
+    return configuration
+
+
+class ClientCharge:
+
+    def __init__(self, url: str, args):
+        self.__url = url
+        self.__args = args
+        self.__message_bytes = json.dumps(MESSAGE).encode('utf-8')
+        # Le contenu des fichiers est genere une seule fois, le cout de generation n'est pas mesure
+        self.__contenu_fichier = os.urandom(args.taille_fichier)
+        self.__random = random.Random(args.seed)
+
+        self.latences: list[float] = list()
+        self.codes: dict[str, int] = dict()
+        self.erreurs = 0
+        self.bytes_envoyes = 0
+
+    def __choisir_multipart(self) -> bool:
+        scenario = self.__args.scenario
+        if scenario == 'multipart':
+            return True
+        if scenario == 'mixte':
+            return self.__random.random() < self.__args.ratio_multipart
+        return False
+
+    def __formdata(self) -> aiohttp.FormData:
+        data = aiohttp.FormData()
+        data.add_field('message', self.__message_bytes, content_type='application/json')
+        for i in range(self.__args.fichiers):
+            data.add_field('files[]', self.__contenu_fichier, filename='fichier_%d.bin' % i,
+                           content_type='application/octet-stream')
+        return data
+
+    async def __poster(self, session: aiohttp.ClientSession):
+        if self.__choisir_multipart():
+            kwargs = {'data': self.__formdata()}
+            taille = len(self.__message_bytes) + self.__args.fichiers * len(self.__contenu_fichier)
+        else:
+            kwargs = {'data': self.__message_bytes, 'headers': {'Content-Type': 'application/json'}}
+            taille = len(self.__message_bytes)
+
+        debut = time.perf_counter()
+        try:
+            async with session.post(self.__url, **kwargs) as reponse:
+                await reponse.read()
+                code = str(reponse.status)
+        except aiohttp.ClientError:
+            self.erreurs += 1
+            return
+        self.latences.append(time.perf_counter() - debut)
+        self.codes[code] = self.codes.get(code, 0) + 1
+        self.bytes_envoyes += taille
+
+    async def executer(self) -> float:
+        """ :return: Duree totale (secondes) """
+        restantes = self.__args.requetes
+
+        async def worker(session):
+            nonlocal restantes
+            while restantes > 0:
+                restantes -= 1
+                await self.__poster(session)
+
+        connecteur = aiohttp.TCPConnector(limit=self.__args.concurrence, ssl=self.__args.verifier_ssl)
+        async with aiohttp.ClientSession(connector=connecteur) as session:
+            debut = time.perf_counter()
+            await asyncio.gather(*[worker(session) for _ in range(self.__args.concurrence)])
+            return time.perf_counter() - debut
+
+
+def percentile(valeurs_triees: list[float], p: float) -> float:
+    if len(valeurs_triees) == 0:
+        return 0.0
+    index = min(len(valeurs_triees) - 1, int(round(p / 100.0 * (len(valeurs_triees) - 1))))
+    return valeurs_triees[index]
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def preparer_resultats(args, client: ClientCharge, duree: float, usage_debut, usage_fin,
+                       boucle: Optional[dict]) -> dict:
+    nombre = len(client.latences)
+    latences = sorted(client.latences)
+    cpu = (usage_fin.ru_utime - usage_debut.ru_utime) + (usage_fin.ru_stime - usage_debut.ru_stime)
+
+    return {
+        'date': datetime.datetime.utcnow().isoformat(),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'parametres': {
+            'scenario': args.scenario, 'requetes': args.requetes, 'concurrence': args.concurrence,
+            'fichiers': args.fichiers, 'taille_fichier': args.taille_fichier,
+            'ratio_multipart': args.ratio_multipart, 'mode_ack': args.mode_ack, 'latence_mq': args.latence_mq,
+            'url': args.url, 'crypto_workers': args.crypto_workers,
+        },
+        'duree': duree,
+        'requetes_ok': nombre,
+        'erreurs': client.erreurs,
+        'codes': client.codes,
+        'req_par_sec': nombre / duree if duree > 0 else 0.0,
+        'mb_par_sec': client.bytes_envoyes / duree / 1024 / 1024 if duree > 0 else 0.0,
+        'latence_ms': {
+            'p50': percentile(latences, 50) * 1000,
+            'p90': percentile(latences, 90) * 1000,
+            'p99': percentile(latences, 99) * 1000,
+            'max': latences[-1] * 1000 if nombre > 0 else 0.0,
+        },
+        # En mode in-process, le CPU du client de charge est inclus
+        'cpu_ms_par_requete': cpu / nombre * 1000 if nombre > 0 else 0.0,
+        'rss_max_mb': usage_fin.ru_maxrss / 1024,  # ru_maxrss en kB sous Linux
+        # Retard de la boucle asyncio du serveur (in-process seulement)
+        'boucle_retard_max_ms': boucle['retard_max'] * 1000 if boucle is not None else None,
+    }
+
+
+def afficher_resultats(resultats: dict):
+    latence = resultats['latence_ms']
+    print("%d requetes en %.2f secs, codes %s, erreurs %d" % (
+        resultats['requetes_ok'], resultats['duree'], resultats['codes'], resultats['erreurs']))
+    print("Debit    : %.1f req/s, %.1f MB/s" % (resultats['req_par_sec'], resultats['mb_par_sec']))
+    print("Latence  : p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+        latence['p50'], latence['p90'], latence['p99'], latence['max']))
+    print("CPU      : %.2f ms/requete" % resultats['cpu_ms_par_requete'])
+    print("RSS max  : %.1f MB" % resultats['rss_max_mb'])
+    if resultats['boucle_retard_max_ms'] is not None:
+        print("Boucle   : retard max %.1f ms" % resultats['boucle_retard_max_ms'])
+
+
+async def executer_benchmark(args) -> dict:
+    stop_event = asyncio.Event()
+    serveur = None
+    boucle = None
+
+    with tempfile.TemporaryDirectory(prefix='benchmark_reception_') as dir_staging:
+        url = args.url
+        if url is None:
+            etat = EtatSimule(dir_staging, preparer_configuration(args), args.latence_mq)
+            serveur = WebServerBenchmark(AppSimulee(etat))
+            port = await serveur.demarrer(stop_event)
+            url = 'http://127.0.0.1:%d%s/message' % (port, ConstantesReception.WEB_APP_PATH)
+
+        client = ClientCharge(url, args)
+        usage_debut = resource.getrusage(resource.RUSAGE_SELF)
+        duree = await client.executer()
+        usage_fin = resource.getrusage(resource.RUSAGE_SELF)
+
+        if serveur is not None:
+            boucle = serveur.etat.surveillance_boucle.get_metriques()
+            await serveur.arreter()
+
+    return preparer_resultats(args, client, duree, usage_debut, usage_fin, boucle)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark de charge de la reception de messages")
+    parser.add_argument('--scenario', choices=['json', 'multipart', 'mixte'], default='json')
+    parser.add_argument('--requetes', type=int, default=1000)
+    parser.add_argument('--concurrence', type=int, default=10)
+    parser.add_argument('--fichiers', type=int, default=1, help="Nombre de fichiers par post multipart")
+    parser.add_argument('--taille-fichier', type=int, default=256 * 1024, help="Taille de chaque fichier (bytes)")
+    parser.add_argument('--ratio-multipart', type=float, default=0.1, help="Scenario mixte : proportion multipart")
+    parser.add_argument('--mode-ack', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--latence-mq', type=float, default=0.002, help="Delai de reponse du producer simule (secs)")
+    parser.add_argument('--crypto-workers', type=int, default=2, help="Threads du service crypto (0 : dans la boucle)")
+    parser.add_argument('--url', default=None, help="Serveur existant, e.g. https://HOST/reception/message")
+    parser.add_argument('--no-verify-ssl', dest='verifier_ssl', action='store_false')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--sortie', default=None, help="Fichier json des resultats")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    resultats = asyncio.run(executer_benchmark(args))
+    afficher_resultats(resultats)
+
+    if args.sortie is not None:
+        with open(args.sortie, 'wt') as fichier:
+            json.dump(resultats, fichier, indent=2)
+        print("Resultats ecrits dans %s" % args.sortie)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Voies d'admission (concurrence, file d'attente bornee, timeout) et controle d'admission par type de post.
+
+Usage : python -m pytest test/test_controle_admission.py
+"""
+import asyncio
+import unittest
+
+from types import SimpleNamespace
+
+from millegrilles_reception.ControleAdmission import ControleAdmission, VoieAdmission, FileAdmissionPleine, \
+    AttenteAdmissionExpiree
+from millegrilles_reception.Metriques import MetriquesReception
+
+
+class VoieAdmissionTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrence(self):
+        voie = VoieAdmission('json', 2, 10, 1.0)
+        actifs = 0
+        actifs_max = 0
+
+        async def requete():
+            nonlocal actifs, actifs_max
+            async with voie.admettre():
+                actifs += 1
+                actifs_max = max(actifs_max, actifs)
+                await asyncio.sleep(0.01)
+                actifs -= 1
+
+        await asyncio.gather(*[requete() for _ in range(6)])
+
+        self.assertEqual(2, actifs_max)
+        metriques = voie.get_metriques()
+        self.assertEqual(6, metriques['admis'])
+        self.assertEqual(0, metriques['actifs'])
+        self.assertEqual(0, metriques['en_attente'])
+
+    async def test_file_pleine(self):
+        voie = VoieAdmission('json', 1, 1, 1.0)
+        await voie.acquerir()
+        attente = asyncio.create_task(voie.acquerir())
+        await asyncio.sleep(0)
+
+        with self.assertRaises(FileAdmissionPleine):
+            await voie.acquerir()
+
+        voie.liberer()
+        await attente
+        voie.liberer()
+        self.assertEqual(1, voie.get_metriques()['rejets_file_pleine'])
+
+    async def test_timeout(self):
+        metriques = MetriquesReception()
+        voie = VoieAdmission('multipart', 1, 5, 0.01, metriques)
+        await voie.acquerir()
+
+        with self.assertRaises(AttenteAdmissionExpiree):
+            await voie.acquerir()
+
+        self.assertEqual(1, voie.get_metriques()['rejets_timeout'])
+        self.assertEqual(0, voie.get_metriques()['en_attente'])
+        self.assertIn('reception_attente_admission_secondes_count{voie="multipart"} 2', metriques.exporter())
+
+    async def test_liberer_sur_exception(self):
+        voie = VoieAdmission('json', 1, 0, 0.01)
+
+        with self.assertRaises(ValueError):
+            async with voie.admettre():
+                raise ValueError()
+
+        async with voie.admettre():
+            pass
+        self.assertEqual(0, voie.get_metriques()['actifs'])
+
+
+class ControleAdmissionTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_voies_independantes(self):
+        """ Un lot ou un upload lent n'occupe pas la voie des messages json """
+        configuration = SimpleNamespace(
+            admission_timeout_attente=0.01, admission_retry_after=3,
+            admission_json_concurrence=1, admission_json_file=0,
+            admission_multipart_concurrence=1, admission_multipart_file=0,
+            admission_batch_concurrence=1, admission_batch_file=0)
+        controle = ControleAdmission(configuration)
+
+        async with controle.voie_batch.admettre(), controle.voie_multipart.admettre():
+            async with controle.voie_json.admettre():
+                pass
+            with self.assertRaises(FileAdmissionPleine):
+                await controle.voie_batch.acquerir()
+
+        self.assertEqual(['json', 'multipart', 'batch'], list(controle.get_metriques().keys()))
+        self.assertEqual(3, controle.retry_after)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Index de deduplication des fichiers recus (LRU et expiration).
+
+Usage : python -m pytest test/test_dedup_fichiers.py
+"""
+import time
+import unittest
+
+from millegrilles_reception.DedupFichiers import EntreeDedup, IndexDedup, nouveau_hacheur
+
+
+def entree(fuuid: str, date_ajout: float = None) -> EntreeDedup:
+    if date_ajout is None:
+        date_ajout = time.time()
+    return EntreeDedup(fuuid, 'cle_' + fuuid, 'nonce', 'mgs4', 100, date_ajout)
+
+
+class IndexDedupTest(unittest.TestCase):
+
+    def test_hit_miss(self):
+        index = IndexDedup(10, 60)
+        index.ajouter(b'a', entree('fa'))
+
+        self.assertEqual('fa', index.get(b'a').fuuid)
+        self.assertIsNone(index.get(b'b'))
+        self.assertEqual({'entrees': 1, 'hits': 1, 'miss': 1, 'taux_hits': 0.5}, index.get_metriques())
+
+    def test_lru(self):
+        index = IndexDedup(2, 60)
+        index.ajouter(b'a', entree('fa'))
+        index.ajouter(b'b', entree('fb'))
+        index.get(b'a')  # a devient le plus recent, b est retire
+        index.ajouter(b'c', entree('fc'))
+
+        self.assertEqual(2, len(index))
+        self.assertIsNone(index.get(b'b'))
+        self.assertIsNotNone(index.get(b'a'))
+        self.assertIsNotNone(index.get(b'c'))
+
+    def test_ajout_existant_rafraichi(self):
+        index = IndexDedup(2, 60)
+        index.ajouter(b'a', entree('fa'))
+        index.ajouter(b'b', entree('fb'))
+        index.ajouter(b'a', entree('fa2'))
+        index.ajouter(b'c', entree('fc'))
+
+        self.assertIsNone(index.get(b'b'))
+        self.assertEqual('fa2', index.get(b'a').fuuid)
+
+    def test_ttl(self):
+        index = IndexDedup(10, 60)
+        index.ajouter(b'a', entree('fa', time.time() - 61))
+        index.ajouter(b'b', entree('fb', time.time() - 59))
+
+        self.assertIsNone(index.get(b'a'))
+        self.assertEqual(1, len(index))  # Entree expiree retiree
+        self.assertIsNotNone(index.get(b'b'))
+
+    def test_hacheur(self):
+        hacheur = nouveau_hacheur()
+        hacheur.update(b'abc')
+        hacheur.update(b'def')
+        hacheur_complet = nouveau_hacheur()
+        hacheur_complet.update(b'abcdef')
+
+        self.assertEqual(32, len(hacheur.digest()))
+        self.assertEqual(hacheur_complet.digest(), hacheur.digest())
+
+
+if __name__ == '__main__':
+    unittest.main()
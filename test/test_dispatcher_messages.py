@@ -0,0 +1,152 @@
+"""
+Emission en arriere-plan des messages de l'outbox (DispatcherMessages), producer MQ simule.
+
+Requiert millegrilles_messages.
+
+Usage : python -m pytest test/test_dispatcher_messages.py
+"""
+import asyncio
+import importlib.util
+import json
+import tempfile
+import unittest
+
+from types import SimpleNamespace
+
+from millegrilles_reception.Metriques import MetriquesReception
+from millegrilles_reception.Outbox import ETAT_EN_ATTENTE, ETAT_LIVRE, ETAT_REJETE, ETAT_ECHEC
+
+LIBRAIRIES_MILLEGRILLES = importlib.util.find_spec('millegrilles_messages') is not None
+
+if LIBRAIRIES_MILLEGRILLES:
+    from millegrilles_reception.DispatcherMessages import DispatcherMessages
+
+
+class ProducerSimule:
+    """ Repond a posterV1 selon le message : erreur d'emission, rejet ou ok """
+
+    def __init__(self):
+        self.emis: list[str] = list()
+        self.erreurs: dict[str, int] = dict()  # Nombre d'erreurs d'emission restantes par message
+        self.rejets: set[str] = set()
+
+    async def emettre_attendre(self, message: str, routing_key: str, exchange=None, correlation_id=None,
+                               timeout=None):
+        self.emis.append(correlation_id)
+        if self.erreurs.get(correlation_id, 0) > 0:
+            self.erreurs[correlation_id] -= 1
+            raise asyncio.TimeoutError()
+        ok = correlation_id not in self.rejets
+        return SimpleNamespace(parsed={'ok': ok, 'contenu': json.loads(message), '__original': None})
+
+
+class FichiersSimule:
+
+    def __init__(self):
+        self.evenements: list[tuple[str, str]] = list()
+
+    async def marquer_intake_batch(self, batch_id: str):
+        self.evenements.append(('marqueur', batch_id))
+
+    async def intake_batch(self, batch_id: str):
+        self.evenements.append(('intake', batch_id))
+
+    async def cleanup_batch(self, batch_id: str):
+        self.evenements.append(('cleanup', batch_id))
+
+
+class EtatSimule:
+
+    def __init__(self, dir_staging: str, dispatch_concurrence: int, dispatch_tentatives_max: int):
+        self.configuration = SimpleNamespace(dir_staging=dir_staging)
+        self.configuration_reception = SimpleNamespace(
+            dispatch_concurrence=dispatch_concurrence, dispatch_tentatives_max=dispatch_tentatives_max)
+        self.metriques = MetriquesReception()
+        self.producer = ProducerSimule()
+
+    async def producer_wait(self):
+        return self.producer
+
+
+@unittest.skipIf(LIBRAIRIES_MILLEGRILLES is False, 'millegrilles_messages non installe')
+class DispatcherMessagesTest(unittest.IsolatedAsyncioTestCase):
+
+    async def demarrer(self, dispatch_concurrence=1, dispatch_tentatives_max=30):
+        self.repertoire = tempfile.TemporaryDirectory()
+        self.etat = EtatSimule(self.repertoire.name, dispatch_concurrence, dispatch_tentatives_max)
+        self.fichiers = FichiersSimule()
+        self.dispatcher = DispatcherMessages(SimpleNamespace(etat=self.etat, fichiers_dechiffres_handler=self.fichiers))
+        await self.dispatcher.setup()
+        self.stop_event = asyncio.Event()
+        self.task = asyncio.create_task(self.dispatcher.run(self.stop_event))
+
+    async def asyncTearDown(self):
+        self.stop_event.set()
+        await self.task
+        self.repertoire.cleanup()
+
+    async def attendre_etat(self, message_id: str, etat: str, timeout=2.0) -> dict:
+        async def verifier():
+            while True:
+                etat_message = await self.dispatcher.get_etat(message_id)
+                if etat_message['etat'] == etat:
+                    return etat_message
+                await asyncio.sleep(0.01)
+        return await asyncio.wait_for(verifier(), timeout)
+
+    async def test_livraison_en_ordre(self):
+        await self.demarrer(dispatch_concurrence=1)
+
+        for i in range(5):
+            await self.dispatcher.soumettre({'i': i}, 'm%d' % i, None)
+        await self.attendre_etat('m4', ETAT_LIVRE)
+
+        self.assertEqual(['m0', 'm1', 'm2', 'm3', 'm4'], self.etat.producer.emis)
+
+    async def test_erreur_libere_la_place(self):
+        """ Un message en erreur est reporte dans l'outbox sans bloquer les suivants pendant son delai """
+        await self.demarrer(dispatch_concurrence=1)
+        self.etat.producer.erreurs['m1'] = 1
+
+        for i in range(1, 4):
+            await self.dispatcher.soumettre({'i': i}, 'm%d' % i, None)
+        await self.attendre_etat('m3', ETAT_LIVRE, timeout=0.5)
+
+        etat_m1 = await self.dispatcher.get_etat('m1')
+        self.assertEqual(ETAT_EN_ATTENTE, etat_m1['etat'])
+        self.assertEqual(1, etat_m1['tentatives'])
+        self.assertEqual(['m1', 'm2', 'm3'], self.etat.producer.emis)
+
+    async def test_echec_tentatives_max(self):
+        await self.demarrer(dispatch_tentatives_max=1)
+        self.etat.producer.erreurs['m1'] = 1
+
+        await self.dispatcher.soumettre({}, 'm1', 'batch1')
+        etat_m1 = await self.attendre_etat('m1', ETAT_ECHEC)
+
+        self.assertEqual({'ok': False, 'err': 'TimeoutError()'}, etat_m1['reponse'])
+        self.assertEqual([('cleanup', 'batch1')], self.fichiers.evenements)
+        self.assertIn('reception_outbox_echecs_total 1', self.etat.metriques.exporter())
+
+    async def test_livraison_batch(self):
+        await self.demarrer()
+
+        await self.dispatcher.soumettre({}, 'm1', 'batch1')
+        await self.attendre_etat('m1', ETAT_LIVRE)
+        await asyncio.sleep(0.05)
+
+        # Marqueur d'intake avant l'etat livre, intake apres
+        self.assertEqual([('marqueur', 'batch1'), ('intake', 'batch1')], self.fichiers.evenements)
+
+    async def test_rejet(self):
+        await self.demarrer()
+        self.etat.producer.rejets.add('m1')
+
+        await self.dispatcher.soumettre({}, 'm1', 'batch1')
+        await self.attendre_etat('m1', ETAT_REJETE)
+
+        self.assertEqual([('cleanup', 'batch1')], self.fichiers.evenements)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+Serialisation des headers de requetes aiohttp (champ origine des messages).
+
+Usage : python -m pytest test/test_json_utils.py
+"""
+import json
+import unittest
+
+from aiohttp.test_utils import make_mocked_request
+
+from millegrilles_reception import JsonUtils
+from millegrilles_reception.JsonUtils import json_dumps, json_loads
+
+HEADERS = {
+    'Host': 'reception.example.com',
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/124.0',
+    'Content-Type': 'application/json',
+    'X-Forwarded-For': '192.0.2.10',
+}
+
+
+class JsonUtilsTest(unittest.TestCase):
+
+    def test_dumps_headers_request(self):
+        request = make_mocked_request('POST', '/reception/message', headers=HEADERS)
+        headers_web = dict(request.headers)
+
+        origine = json_dumps(headers_web)
+
+        self.assertEqual(json.loads(origine), HEADERS)
+
+    @unittest.skipIf(JsonUtils.orjson is None, 'orjson non installe')
+    def test_dumps_headers_request_sans_orjson(self):
+        request = make_mocked_request('POST', '/reception/message', headers=HEADERS)
+        orjson = JsonUtils.orjson
+        JsonUtils.orjson = None
+        try:
+            origine = json_dumps(dict(request.headers))
+        finally:
+            JsonUtils.orjson = orjson
+
+        self.assertEqual(json.loads(origine), HEADERS)
+
+    def test_loads(self):
+        self.assertEqual(json_loads(b'{"contenu": "abc"}'), {'contenu': 'abc'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Limites de debit par client (GCRA) et adresse du client derriere les proxies de confiance.
+
+Usage : python -m pytest test/test_limiteur_debit.py
+"""
+import unittest
+
+from types import SimpleNamespace
+from unittest import mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+
+from millegrilles_reception.LimiteurDebit import LimiteurDebitReception, LimiteurGcra, get_adresse_client, \
+    parse_reseaux
+
+
+def requete(remote: str, headers: dict = None, path='/reception/message', method='POST'):
+    transport = mock.Mock()
+    transport.get_extra_info.side_effect = lambda nom, defaut=None: (remote, 443) if nom == 'peername' else defaut
+    return make_mocked_request(method, path, headers=headers or {}, transport=transport)
+
+
+def configuration(**params):
+    valeurs = {
+        'limite_proxies_confiance': [], 'limite_cles_max': 100,
+        'limite_requetes_taux': 0.0, 'limite_requetes_rafale': 1.0,
+        'limite_bytes_taux': 0.0, 'limite_bytes_rafale': 1.0,
+    }
+    valeurs.update(params)
+    return SimpleNamespace(**valeurs)
+
+
+class LimiteurGcraTest(unittest.TestCase):
+
+    def test_rafale(self):
+        limiteur = LimiteurGcra(1.0, 3, 100)
+
+        self.assertEqual([None, None, None], [limiteur.verifier('a') for _ in range(3)])
+        attente = limiteur.verifier('a')
+        self.assertIsNotNone(attente)
+        self.assertGreater(attente, 0.9)
+        self.assertLessEqual(attente, 1.0)
+        # Les autres cles ne sont pas affectees
+        self.assertIsNone(limiteur.verifier('b'))
+        self.assertEqual({'cles': 2, 'acceptes': 4, 'refuses': 1}, limiteur.get_metriques())
+
+    def test_cout(self):
+        limiteur = LimiteurGcra(1000.0, 1000, 100)
+
+        self.assertIsNone(limiteur.verifier('a', 800))
+        self.assertIsNotNone(limiteur.verifier('a', 800))
+        self.assertIsNone(limiteur.verifier('a', 100))
+
+    def test_consommer_dette(self):
+        limiteur = LimiteurGcra(1000.0, 1000, 100)
+
+        limiteur.consommer('a', 5000)
+
+        self.assertIsNotNone(limiteur.verifier('a', 0))
+
+    def test_cles_max_lru(self):
+        limiteur = LimiteurGcra(1.0, 1, 2)
+        limiteur.verifier('a')
+        limiteur.verifier('b')
+        limiteur.verifier('c')  # a est retiree
+
+        self.assertEqual(2, limiteur.get_metriques()['cles'])
+        self.assertIsNone(limiteur.verifier('a'))
+        self.assertIsNotNone(limiteur.verifier('c'))
+
+
+class AdresseClientTest(unittest.TestCase):
+
+    def test_sans_proxy_en_tete_ignoree(self):
+        request = requete('203.0.113.5', {'X-Forwarded-For': '198.51.100.1', 'X-Real-IP': '198.51.100.2'})
+
+        self.assertEqual('203.0.113.5', get_adresse_client(request, []))
+
+    def test_connexion_hors_proxies_confiance(self):
+        request = requete('203.0.113.5', {'X-Forwarded-For': '198.51.100.1'})
+
+        self.assertEqual('203.0.113.5', get_adresse_client(request, parse_reseaux(['10.0.0.0/8'])))
+
+    def test_proxy_confiance(self):
+        # Le client a ajoute 198.51.100.1 lui-meme, le proxy a ajoute l'adresse reelle 203.0.113.7
+        request = requete('10.0.0.2', {'X-Forwarded-For': '198.51.100.1, 203.0.113.7'})
+
+        self.assertEqual('203.0.113.7', get_adresse_client(request, parse_reseaux(['10.0.0.0/8'])))
+
+    def test_plusieurs_proxies_confiance(self):
+        request = requete('10.0.0.2', {'X-Forwarded-For': '203.0.113.7, 10.0.0.9'})
+
+        self.assertEqual('203.0.113.7', get_adresse_client(request, parse_reseaux(['10.0.0.0/8', ' '])))
+
+    def test_proxy_sans_en_tete(self):
+        request = requete('10.0.0.2')
+
+        self.assertEqual('10.0.0.2', get_adresse_client(request, parse_reseaux(['10.0.0.0/8'])))
+
+
+class LimiteurDebitReceptionTest(unittest.TestCase):
+
+    def test_desactive_par_defaut(self):
+        limiteur = LimiteurDebitReception(configuration(), ['/reception/message'])
+
+        self.assertIsNone(limiteur.verifier(requete('203.0.113.5')))
+        self.assertEqual({}, limiteur.get_metriques())
+
+    def test_requetes_par_client(self):
+        limiteur = LimiteurDebitReception(
+            configuration(limite_requetes_taux=1.0, limite_requetes_rafale=2), ['/reception/message'])
+
+        self.assertIsNone(limiteur.verifier(requete('203.0.113.5')))
+        self.assertIsNone(limiteur.verifier(requete('203.0.113.5')))
+        self.assertIsNotNone(limiteur.verifier(requete('203.0.113.5')))
+        # X-Forwarded-For d'un client (aucun proxy de confiance) ne contourne pas la limite
+        self.assertIsNotNone(limiteur.verifier(requete('203.0.113.5', {'X-Forwarded-For': '198.51.100.1'})))
+        self.assertIsNone(limiteur.verifier(requete('203.0.113.6')))
+
+    def test_lot_par_message(self):
+        limiteur = LimiteurDebitReception(
+            configuration(limite_requetes_taux=1.0, limite_requetes_rafale=5), ['/reception/message'],
+            ['/reception/messages/batch'])
+        request = requete('203.0.113.5', path='/reception/messages/batch')
+
+        # La requete du lot ne consomme aucun jeton, chaque message en consomme un
+        self.assertIsNone(limiteur.verifier(request))
+        self.assertIsNone(limiteur.verifier_messages(request, 5))
+        self.assertIsNotNone(limiteur.verifier_messages(request, 1))
+        self.assertIsNotNone(limiteur.verifier(requete('203.0.113.5')))
+
+    def test_bytes_content_length(self):
+        limiteur = LimiteurDebitReception(
+            configuration(limite_bytes_taux=1000.0, limite_bytes_rafale=1000), ['/reception/message'])
+        headers = {'Content-Type': 'multipart/form-data; boundary=x', 'Content-Length': '900'}
+
+        self.assertIsNone(limiteur.verifier(requete('203.0.113.5', headers)))
+        self.assertIsNotNone(limiteur.verifier(requete('203.0.113.5', headers)))
+        # Les posts json ne sont pas comptes en bytes
+        self.assertIsNone(limiteur.verifier(requete('203.0.113.5', {'Content-Type': 'application/json'})))
+
+
+class MiddlewareTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_multipart_chunked(self):
+        """ Sans Content-Length, les bytes recus sont consommes a la fin du post """
+        limiteur = LimiteurDebitReception(
+            configuration(limite_bytes_taux=1000.0, limite_bytes_rafale=1000), ['/reception/message'])
+
+        async def handler(request):
+            await request.read()
+            return web.HTTPOk()
+
+        app = web.Application(middlewares=[limiteur.middleware])
+        app.router.add_post('/reception/message', handler)
+
+        async def body():
+            for _ in range(5):
+                yield b'x' * 1000
+
+        headers = {'Content-Type': 'multipart/form-data; boundary=x'}
+        async with TestClient(TestServer(app)) as client:
+            reponse = await client.post('/reception/message', data=body(), headers=headers)
+            self.assertEqual(200, reponse.status)
+
+            # Dette de 5000 bytes : le post suivant est refuse avant la lecture du body
+            reponse = await client.post('/reception/message', data=b'', headers=headers)
+            self.assertEqual(429, reponse.status)
+            self.assertIn('Retry-After', reponse.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
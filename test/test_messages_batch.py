@@ -0,0 +1,117 @@
+"""
+Soumission de messages en lot : decoupage du flux NDJSON et fin de la file des resultats.
+
+Les tests de MessagesBatchHandler requierent millegrilles_messages.
+
+Usage : python -m pytest test/test_messages_batch.py
+"""
+import asyncio
+import importlib.util
+import unittest
+
+from types import SimpleNamespace
+
+from millegrilles_reception.FluxNdjson import BatchTropGrosse, iterer_ndjson
+from millegrilles_reception.Metriques import MetriquesReception
+
+LIBRAIRIES_MILLEGRILLES = importlib.util.find_spec('millegrilles_messages') is not None
+
+if LIBRAIRIES_MILLEGRILLES:
+    from millegrilles_reception.MessagesBatchHandler import MessagesBatchHandler
+
+
+async def flux(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+async def lignes(chunks, taille_max=1000, messages_max=10, taille_max_message=100) -> list:
+    return [ligne async for ligne in iterer_ndjson(flux(*chunks), taille_max, messages_max, taille_max_message)]
+
+
+class IterNdjsonTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_lignes(self):
+        resultat = await lignes([b'{"a":1}\n{"b":2}\n'])
+
+        self.assertEqual([(0, b'{"a":1}'), (1, b'{"b":2}')], resultat)
+
+    async def test_ligne_sur_plusieurs_chunks(self):
+        resultat = await lignes([b'{"a"', b':1}\n{"b', b'":2}', b'\n'])
+
+        self.assertEqual([(0, b'{"a":1}'), (1, b'{"b":2}')], resultat)
+
+    async def test_derniere_ligne_sans_fin(self):
+        resultat = await lignes([b'{"a":1}\n', b'{"b":2}'])
+
+        self.assertEqual([(0, b'{"a":1}'), (1, b'{"b":2}')], resultat)
+
+    async def test_lignes_vides_et_crlf(self):
+        resultat = await lignes([b'\n{"a":1}\r\n  \n\n{"b":2}\r\n'])
+
+        self.assertEqual([(0, b'{"a":1}'), (1, b'{"b":2}')], resultat)
+
+    async def test_taille_max(self):
+        with self.assertRaisesRegex(BatchTropGrosse, 'batch trop grosse'):
+            await lignes([b'{"a":1}\n' * 10, b'{"a":1}\n' * 10], taille_max=100)
+
+    async def test_messages_max(self):
+        with self.assertRaisesRegex(BatchTropGrosse, 'trop de messages'):
+            await lignes([b'{}\n{}\n{}\n'], messages_max=2)
+        with self.assertRaisesRegex(BatchTropGrosse, 'trop de messages'):
+            await lignes([b'{}\n{}\n{}'], messages_max=2)
+
+    async def test_message_trop_gros(self):
+        """ Une ligne sans fin au-dela de la taille d'un message est refusee sans attendre la fin du flux """
+        recus = list()
+        with self.assertRaisesRegex(BatchTropGrosse, 'message trop gros'):
+            async for ligne in iterer_ndjson(flux(b'{}\n' + b'x' * 60, b'x' * 60, b'\n'), 1000, 10, 100):
+                recus.append(ligne)
+
+        self.assertEqual([(0, b'{}')], recus)
+
+
+@unittest.skipIf(LIBRAIRIES_MILLEGRILLES is False, 'millegrilles_messages non installe')
+class MessagesBatchHandlerTest(unittest.IsolatedAsyncioTestCase):
+
+    def handler(self) -> 'MessagesBatchHandler':
+        configuration = SimpleNamespace(
+            batch_messages_max=10, batch_taille_max=1000, batch_concurrence=4, message_taille_max=100,
+            mode_ack='async', outbox_absorber=False)
+        etat = SimpleNamespace(configuration_reception=configuration, metriques=MetriquesReception(), traceur=None)
+        return MessagesBatchHandler(etat, SimpleNamespace())
+
+    async def test_source_interrompue(self):
+        """ Aucun resultat n'est ajoute a la file apres l'interruption de la source (ex. client deconnecte) """
+        handler = self.handler()
+        messages_annules = list()
+
+        async def traiter_message(message_recu, origine, mode_async, producer):
+            try:
+                await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                messages_annules.append(message_recu)
+                raise
+            return {'code': 202, 'ok': True}
+
+        handler._MessagesBatchHandler__traiter_message = traiter_message
+
+        async def source():
+            yield 0, {'a': 1}
+            yield 1, {'b': 2}
+            await asyncio.sleep(0.01)  # Messages en cours de traitement
+            raise ConnectionResetError()
+
+        resultats = asyncio.Queue()
+        with self.assertRaises(ConnectionResetError):
+            await handler._MessagesBatchHandler__traiter_messages(None, source(), '{}', True, resultats)
+        await resultats.put(None)
+        await asyncio.sleep(0.1)
+
+        self.assertCountEqual([{'a': 1}, {'b': 2}], messages_annules)
+        self.assertIsNone(resultats.get_nowait())
+        self.assertTrue(resultats.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
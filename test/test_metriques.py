@@ -0,0 +1,100 @@
+"""
+Exposition des metriques en format texte Prometheus.
+
+Usage : python -m pytest test/test_metriques.py
+"""
+import unittest
+
+from millegrilles_reception.Metriques import Compteur, Histogramme, MetriquesReception, formatter_labels, \
+    formatter_valeur
+
+
+class FormatTest(unittest.TestCase):
+
+    def test_formatter_valeur(self):
+        self.assertEqual('3', formatter_valeur(3.0))
+        self.assertEqual('0.25', formatter_valeur(0.25))
+        self.assertEqual('+Inf', formatter_valeur(float('inf')))
+        self.assertEqual('-Inf', formatter_valeur(float('-inf')))
+
+    def test_formatter_labels(self):
+        self.assertEqual('', formatter_labels((), ()))
+        self.assertEqual('{code="201"}', formatter_labels(('code',), (201,)))
+        self.assertEqual('{nom="a\\"b\\\\c",le="1"}', formatter_labels(('nom',), ('a"b\\c',), 'le="1"'))
+
+
+class CompteurTest(unittest.TestCase):
+
+    def test_exporter(self):
+        compteur = Compteur('test_total', 'Aide', ('type',))
+        compteur.incrementer(('json',))
+        compteur.incrementer(('json',), 2)
+        compteur.incrementer(('multipart',))
+
+        self.assertEqual([
+            '# HELP test_total Aide',
+            '# TYPE test_total counter',
+            'test_total{type="json"} 3',
+            'test_total{type="multipart"} 1',
+        ], list(compteur.exporter()))
+
+
+class HistogrammeTest(unittest.TestCase):
+
+    def test_buckets_cumulatifs(self):
+        histogramme = Histogramme('test_secondes', 'Aide', (0.1, 1.0))
+        for valeur in (0.05, 0.1, 0.5, 2.0):
+            histogramme.observer(valeur)
+
+        self.assertEqual([
+            '# HELP test_secondes Aide',
+            '# TYPE test_secondes histogram',
+            'test_secondes_bucket{le="0.1"} 2',
+            'test_secondes_bucket{le="1"} 3',
+            'test_secondes_bucket{le="+Inf"} 4',
+            'test_secondes_sum 2.65',
+            'test_secondes_count 4',
+        ], list(histogramme.exporter()))
+
+    def test_labels(self):
+        histogramme = Histogramme('test_secondes', 'Aide', (1.0,), ('voie',))
+        histogramme.observer(0.5, ('json',))
+
+        lignes = list(histogramme.exporter())
+
+        self.assertIn('test_secondes_bucket{voie="json",le="1"} 1', lignes)
+        self.assertIn('test_secondes_count{voie="json"} 1', lignes)
+
+
+class MetriquesReceptionTest(unittest.TestCase):
+
+    def test_compter_post(self):
+        metriques = MetriquesReception()
+        metriques.compter_post('application/json', 201)
+        metriques.compter_post('multipart/form-data', 202)
+        metriques.compter_post(None, 400)
+
+        texte = metriques.exporter()
+
+        self.assertIn('reception_posts_total{content_type="json",code="201"} 1', texte)
+        self.assertIn('reception_posts_total{content_type="multipart",code="202"} 1', texte)
+        self.assertIn('reception_posts_total{content_type="autre",code="400"} 1', texte)
+
+    def test_jauge(self):
+        metriques = MetriquesReception()
+        metriques.ajouter_jauge('test_jauge', 'Aide', lambda: [(('a',), 2.0)], ('nom',))
+
+        texte = metriques.exporter()
+
+        self.assertIn('# TYPE test_jauge gauge\ntest_jauge{nom="a"} 2\n', texte)
+
+    def test_format(self):
+        texte = MetriquesReception().exporter()
+
+        self.assertTrue(texte.endswith('\n'))
+        noms = [ligne.split(' ')[2] for ligne in texte.splitlines() if ligne.startswith('# TYPE')]
+        self.assertEqual(len(noms), len(set(noms)))
+
+
+if __name__ == '__main__':
+    unittest.main()
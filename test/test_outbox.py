@@ -0,0 +1,91 @@
+"""
+Outbox sqlite des commandes posterV1.
+
+Usage : python -m pytest test/test_outbox.py
+"""
+import asyncio
+import datetime
+import tempfile
+import unittest
+
+from os import path
+
+from millegrilles_reception.Outbox import Outbox, ETAT_EN_ATTENTE, ETAT_LIVRE, ETAT_ECHEC
+
+
+class OutboxTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.repertoire = tempfile.TemporaryDirectory()
+        self.outbox = Outbox(path.join(self.repertoire.name, 'outbox.sqlite'))
+        await self.outbox.ouvrir()
+
+    async def asyncTearDown(self):
+        await self.outbox.fermer()
+        self.repertoire.cleanup()
+
+    async def test_ajouts_concurrents_en_ordre(self):
+        await asyncio.gather(*[self.outbox.ajouter('m%d' % i, None, {'i': i}) for i in range(20)])
+
+        entrees = await self.outbox.get_en_attente(50, set())
+
+        self.assertEqual(['m%d' % i for i in range(20)], [e.message_id for e in entrees])
+        self.assertEqual({'i': 3}, entrees[3].message)
+
+    async def test_limite_exclure(self):
+        for i in range(5):
+            await self.outbox.ajouter('m%d' % i, None, {})
+
+        entrees = await self.outbox.get_en_attente(2, {'m0', 'm2'})
+
+        self.assertEqual(['m1', 'm3'], [e.message_id for e in entrees])
+
+    async def test_reporter(self):
+        await self.outbox.ajouter('m1', None, {})
+        await self.outbox.ajouter('m2', None, {})
+
+        await self.outbox.reporter('m1', 60)
+
+        entrees = await self.outbox.get_en_attente(10, set())
+        self.assertEqual(['m2'], [e.message_id for e in entrees])
+        etat = await self.outbox.get_etat('m1')
+        self.assertEqual(ETAT_EN_ATTENTE, etat['etat'])
+        self.assertEqual(1, etat['tentatives'])
+
+        await self.outbox.reporter('m2', 0)
+        entrees = await self.outbox.get_en_attente(10, set())
+        self.assertEqual([('m2', 1)], [(e.message_id, e.tentatives) for e in entrees])
+
+    async def test_marquer_termine(self):
+        await self.outbox.ajouter('m1', 'batch1', {'contenu': 'abc'})
+        self.assertTrue(await self.outbox.contient_batch('batch1'))
+
+        await self.outbox.marquer_termine('m1', ETAT_LIVRE, {'ok': True})
+
+        self.assertEqual([], await self.outbox.get_en_attente(10, set()))
+        self.assertFalse(await self.outbox.contient_batch('batch1'))
+        etat = await self.outbox.get_etat('m1')
+        self.assertEqual(ETAT_LIVRE, etat['etat'])
+        self.assertEqual({'ok': True}, etat['reponse'])
+        self.assertIsNone(await self.outbox.get_etat('inconnu'))
+
+    async def test_ajout_duplique_ignore(self):
+        await self.outbox.ajouter('m1', None, {'version': 1})
+        await self.outbox.ajouter('m1', None, {'version': 2})
+
+        entrees = await self.outbox.get_en_attente(10, set())
+        self.assertEqual([{'version': 1}], [e.message for e in entrees])
+
+    async def test_purger(self):
+        await self.outbox.ajouter('m1', None, {})
+        await self.outbox.ajouter('m2', None, {})
+        await self.outbox.marquer_termine('m1', ETAT_ECHEC, {'ok': False})
+
+        # Seuls les messages termines sont retires
+        self.assertEqual(1, await self.outbox.purger(datetime.timedelta(days=-1)))
+        self.assertIsNone(await self.outbox.get_etat('m1'))
+        self.assertIsNotNone(await self.outbox.get_etat('m2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
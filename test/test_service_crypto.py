@@ -0,0 +1,60 @@
+"""
+Execution des jobs de chiffrage dans le pool de threads (ServiceCrypto).
+
+Usage : python -m pytest test/test_service_crypto.py
+"""
+import asyncio
+import threading
+import unittest
+
+from types import SimpleNamespace
+
+from millegrilles_reception.Metriques import MetriquesReception
+from millegrilles_reception.ServiceCrypto import ServiceCrypto
+
+
+def thread_courante(valeur):
+    return valeur, threading.current_thread().name
+
+
+def erreur():
+    raise ValueError('chiffrage')
+
+
+class ServiceCryptoTest(unittest.IsolatedAsyncioTestCase):
+
+    def preparer(self, crypto_workers=2, crypto_lot=16) -> ServiceCrypto:
+        configuration = SimpleNamespace(crypto_workers=crypto_workers, crypto_lot=crypto_lot, crypto_file=256)
+        self.metriques = MetriquesReception()
+        service = ServiceCrypto(configuration, self.metriques)
+        self.addCleanup(service.fermer)
+        return service
+
+    async def test_pool(self):
+        service = self.preparer(crypto_lot=4)
+
+        resultats = await asyncio.gather(*[service.executer(thread_courante, i) for i in range(10)])
+
+        self.assertEqual(list(range(10)), [r[0] for r in resultats])
+        self.assertTrue(all(r[1].startswith('crypto') for r in resultats))
+        self.assertIn('reception_crypto_jobs_total{mode="pool"} 10', self.metriques.exporter())
+        # Lots d'au plus 4 jobs : 4, 4, 2
+        self.assertIn('reception_crypto_lot_jobs_count 3', self.metriques.exporter())
+
+    async def test_erreur(self):
+        service = self.preparer()
+
+        with self.assertRaises(ValueError):
+            await service.executer(erreur)
+
+    async def test_sans_workers(self):
+        service = self.preparer(crypto_workers=0)
+
+        valeur, thread = await service.executer(thread_courante, 1)
+
+        self.assertEqual(threading.current_thread().name, thread)
+        self.assertIn('reception_crypto_jobs_total{mode="inline"} 1', self.metriques.exporter())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Ecriture vectorielle du contenu chiffre recu (SpoolChiffre), incluant les ecritures partielles de writev.
+
+Usage : python -m pytest test/test_spool_chiffre.py
+"""
+import os
+import tempfile
+import unittest
+
+from os import path
+from unittest import mock
+
+from millegrilles_reception import SpoolChiffre as ModuleSpool
+from millegrilles_reception.SpoolChiffre import SpoolChiffre, estimer_taille_chiffree, MGS4_OVERHEAD_BLOC
+
+
+class WritevPartiel:
+    """ writev qui ecrit au plus taille_max bytes par appel """
+
+    def __init__(self, taille_max: int):
+        self.taille_max = taille_max
+        self.appels: list[int] = list()
+
+    def __call__(self, fd: int, buffers: list) -> int:
+        self.appels.append(len(buffers))
+        donnees = b''.join(bytes(b) for b in buffers)[:self.taille_max]
+        return os.write(fd, donnees)
+
+
+class SpoolChiffreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repertoire = tempfile.TemporaryDirectory()
+        self.path_fichier = path.join(self.repertoire.name, '0.part')
+
+    def tearDown(self):
+        self.repertoire.cleanup()
+
+    def lire(self) -> bytes:
+        with open(self.path_fichier, 'rb') as fichier:
+            return fichier.read()
+
+    def test_ecrire(self):
+        with SpoolChiffre(self.path_fichier) as fichier:
+            self.assertEqual(6, fichier.ecrire([b'abc', b'', b'def']))
+            self.assertEqual(1, fichier.ecrire([b'g']))
+
+        self.assertEqual(b'abcdefg', self.lire())
+
+    def test_ecriture_partielle(self):
+        buffers = [b'a' * 5, b'b' * 7, b'c' * 3, b'd' * 10]
+        writev = WritevPartiel(4)
+
+        with mock.patch.object(ModuleSpool.os, 'writev', writev), SpoolChiffre(self.path_fichier) as fichier:
+            self.assertEqual(25, fichier.ecrire(buffers))
+
+        self.assertEqual(b''.join(buffers), self.lire())
+        self.assertEqual(7, len(writev.appels))
+
+    def test_iov_max(self):
+        buffers = [bytes([i]) * 3 for i in range(10)]
+        writev = WritevPartiel(1000)
+
+        with mock.patch.object(ModuleSpool, 'IOV_MAX', 4), mock.patch.object(ModuleSpool.os, 'writev', writev), \
+                SpoolChiffre(self.path_fichier) as fichier:
+            fichier.ecrire(buffers)
+
+        self.assertEqual(b''.join(buffers), self.lire())
+        self.assertEqual([4, 4, 2], writev.appels)
+
+    def test_preallocation_ramenee_a_la_taille_reelle(self):
+        with SpoolChiffre(self.path_fichier, 100_000) as fichier:
+            fichier.ecrire([b'x' * 1000])
+
+        self.assertEqual(1000, path.getsize(self.path_fichier))
+
+    def test_fermer_deux_fois(self):
+        fichier = SpoolChiffre(self.path_fichier)
+        fichier.fermer()
+        fichier.fermer()
+
+
+class EstimerTailleTest(unittest.TestCase):
+
+    def test_estimer(self):
+        self.assertIsNone(estimer_taille_chiffree(None))
+        self.assertIsNone(estimer_taille_chiffree('abc'))
+        self.assertIsNone(estimer_taille_chiffree('0'))
+        self.assertEqual(100 + 2 * MGS4_OVERHEAD_BLOC, estimer_taille_chiffree('100'))
+        self.assertEqual(2 * 64 * 1024 + 4 * MGS4_OVERHEAD_BLOC, estimer_taille_chiffree(str(2 * 64 * 1024)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+"""
+Reprise du staging des workers retires lorsque le nombre de workers (RECEPTION_WORKERS) change.
+
+Usage : python -m pytest test/test_staging_workers.py
+"""
+import os
+import tempfile
+import unittest
+
+from os import path
+
+from millegrilles_reception.Outbox import Outbox, ETAT_EN_ATTENTE, ETAT_LIVRE
+from millegrilles_reception.StagingWorkers import get_dir_staging_worker, lister_staging_orphelins, \
+    reprendre_staging
+
+
+class ListerOrphelinsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repertoire = tempfile.TemporaryDirectory()
+        self.dir_staging = self.repertoire.name
+        for worker_id in range(5):
+            os.makedirs(get_dir_staging_worker(self.dir_staging, worker_id))
+        os.makedirs(path.join(self.dir_staging, 'upload'))
+
+    def tearDown(self):
+        self.repertoire.cleanup()
+
+    def noms(self, worker_id, nombre_workers) -> list[str]:
+        return [path.relpath(p, self.dir_staging)
+                for p in lister_staging_orphelins(self.dir_staging, worker_id, nombre_workers)]
+
+    def test_workers_reduits(self):
+        self.assertEqual(['worker_2', 'worker_4', '.'], self.noms(0, 2))
+        self.assertEqual(['worker_3'], self.noms(1, 2))
+        self.assertEqual([], self.noms(1, 5))
+
+    def test_un_seul_processus(self):
+        self.assertEqual(['worker_0', 'worker_1', 'worker_2', 'worker_3', 'worker_4'], self.noms(None, 1))
+
+    def test_staging_absent(self):
+        self.assertEqual([], lister_staging_orphelins(path.join(self.dir_staging, 'absent'), 0, 2))
+
+
+class ReprendreStagingTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.repertoire = tempfile.TemporaryDirectory()
+        self.dir_source = path.join(self.repertoire.name, 'worker_3')
+        self.dir_destination = path.join(self.repertoire.name, 'worker_1')
+
+    def tearDown(self):
+        self.repertoire.cleanup()
+
+    async def remplir_outbox(self, dir_staging: str, message_ids: list[str], livres: list[str] = None):
+        os.makedirs(dir_staging, exist_ok=True)
+        outbox = Outbox(path.join(dir_staging, 'outbox.sqlite'))
+        await outbox.ouvrir()
+        for message_id in message_ids:
+            await outbox.ajouter(message_id, None, {'id': message_id})
+        for message_id in livres or []:
+            await outbox.marquer_termine(message_id, ETAT_LIVRE, {'ok': True})
+        await outbox.fermer()
+
+    async def test_outbox(self):
+        await self.remplir_outbox(self.dir_source, ['m1', 'm2', 'm3'], ['m1'])
+        await self.remplir_outbox(self.dir_destination, ['d1'])
+
+        reprendre_staging(self.dir_source, self.dir_destination)
+
+        self.assertFalse(path.exists(self.dir_source))
+        outbox = Outbox(path.join(self.dir_destination, 'outbox.sqlite'))
+        await outbox.ouvrir()
+        try:
+            en_attente = await outbox.get_en_attente(10, set())
+            self.assertEqual(['d1', 'm2', 'm3'], [e.message_id for e in en_attente])
+            self.assertEqual({'id': 'm2'}, en_attente[1].message)
+            self.assertEqual(ETAT_LIVRE, (await outbox.get_etat('m1'))['etat'])
+            self.assertEqual(ETAT_EN_ATTENTE, (await outbox.get_etat('m3'))['etat'])
+        finally:
+            await outbox.fermer()
+
+    async def test_reprise_repetee(self):
+        """ Une reprise interrompue apres la fusion de l'outbox ne duplique pas les messages """
+        await self.remplir_outbox(self.dir_source, ['m1'])
+        os.makedirs(self.dir_destination)
+        copie = path.join(self.repertoire.name, 'copie.sqlite')
+        with open(path.join(self.dir_source, 'outbox.sqlite'), 'rb') as source, open(copie, 'wb') as destination:
+            destination.write(source.read())
+
+        reprendre_staging(self.dir_source, self.dir_destination)
+        os.makedirs(self.dir_source)
+        os.rename(copie, path.join(self.dir_source, 'outbox.sqlite'))
+        reprendre_staging(self.dir_source, self.dir_destination)
+
+        outbox = Outbox(path.join(self.dir_destination, 'outbox.sqlite'))
+        await outbox.ouvrir()
+        try:
+            self.assertEqual(1, len(await outbox.get_en_attente(10, set())))
+        finally:
+            await outbox.fermer()
+
+    def test_batches(self):
+        os.makedirs(path.join(self.dir_source, 'upload', 'batch_a'))
+        with open(path.join(self.dir_source, 'upload', 'batch_a', '0.part'), 'wb') as fichier:
+            fichier.write(b'abc')
+        os.makedirs(path.join(self.dir_source, 'ready', 'fuuid_1'))
+        with open(path.join(self.dir_source, 'certificats_chiffrage.json'), 'wt') as fichier:
+            fichier.write('{}')
+
+        reprendre_staging(self.dir_source, self.dir_destination)
+
+        self.assertTrue(path.isfile(path.join(self.dir_destination, 'upload', 'batch_a', '0.part')))
+        self.assertTrue(path.isdir(path.join(self.dir_destination, 'ready', 'fuuid_1')))
+        self.assertFalse(path.exists(self.dir_source))
+
+    def test_conflit_conserve_source(self):
+        os.makedirs(path.join(self.dir_source, 'upload', 'batch_a'))
+        os.makedirs(path.join(self.dir_destination, 'upload', 'batch_a'))
+
+        reprendre_staging(self.dir_source, self.dir_destination)
+
+        self.assertTrue(path.isdir(path.join(self.dir_source, 'upload', 'batch_a')))
+
+    def test_staging_racine_conserve(self):
+        """ Le staging racine (sans workers) est repris par le worker 0 sans retirer les repertoires des workers """
+        dir_racine = self.repertoire.name
+        os.makedirs(path.join(dir_racine, 'upload', 'batch_a'))
+        dir_worker_0 = get_dir_staging_worker(dir_racine, 0)
+
+        reprendre_staging(dir_racine, dir_worker_0)
+
+        self.assertTrue(path.isdir(path.join(dir_worker_0, 'upload', 'batch_a')))
+        self.assertTrue(path.isdir(dir_racine))
+
+
+if __name__ == '__main__':
+    unittest.main()
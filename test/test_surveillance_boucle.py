@@ -0,0 +1,67 @@
+"""
+Surveillance de la boucle asyncio : retard de planification et capture des callbacks bloquants.
+
+Usage : python -m pytest test/test_surveillance_boucle.py
+"""
+import asyncio
+import threading
+import time
+import unittest
+
+from types import SimpleNamespace
+
+from millegrilles_reception.Metriques import MetriquesReception
+from millegrilles_reception.SurveillanceBoucle import SurveillanceBoucle
+
+
+def configuration(**params):
+    valeurs = {'boucle_intervalle': 0.01, 'boucle_seuil_blocage': 0.05, 'boucle_blocages_conserves': 5}
+    valeurs.update(params)
+    return SimpleNamespace(**valeurs)
+
+
+def callback_bloquant():
+    time.sleep(0.2)
+
+
+class SurveillanceBoucleTest(unittest.IsolatedAsyncioTestCase):
+
+    async def demarrer(self, surveillance: SurveillanceBoucle):
+        self.stop_event = asyncio.Event()
+        self.tache = asyncio.create_task(surveillance.run(self.stop_event))
+        await asyncio.sleep(0.05)
+
+    async def arreter(self):
+        self.stop_event.set()
+        await self.tache
+
+    async def test_blocage(self):
+        metriques = MetriquesReception()
+        surveillance = SurveillanceBoucle(configuration(), metriques)
+        await self.demarrer(surveillance)
+
+        callback_bloquant()
+        await asyncio.sleep(0.05)
+        await self.arreter()
+
+        blocages = surveillance.get_blocages()
+        self.assertEqual(1, blocages['blocages'])
+        blocage = blocages['derniers_blocages'][0]
+        self.assertGreaterEqual(blocage['duree'], 0.1)
+        self.assertIn('callback_bloquant', ''.join(blocage['pile']))
+        self.assertIn('reception_boucle_blocages_total 1', metriques.exporter())
+
+    async def test_desactivee(self):
+        surveillance = SurveillanceBoucle(configuration(boucle_seuil_blocage=0), MetriquesReception())
+        await self.demarrer(surveillance)
+
+        callback_bloquant()
+        await asyncio.sleep(0.05)
+        await self.arreter()
+
+        self.assertEqual(0, surveillance.get_blocages()['blocages'])
+        self.assertNotIn('surveillance_boucle', [t.name for t in threading.enumerate()])
+
+
+if __name__ == '__main__':
+    unittest.main()
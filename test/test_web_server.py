@@ -0,0 +1,109 @@
+"""
+Posts recus par WebServerReception (etat simule de benchmark_reception, producer MQ local).
+
+Requiert millegrilles_web et millegrilles_messages.
+
+Usage : python -m pytest test/test_web_server.py
+"""
+import asyncio
+import importlib.util
+import json
+import tempfile
+import unittest
+
+import aiohttp
+
+LIBRAIRIES_MILLEGRILLES = all(importlib.util.find_spec(nom) is not None
+                              for nom in ('millegrilles_web', 'millegrilles_messages', 'cryptography'))
+
+if LIBRAIRIES_MILLEGRILLES:
+    from benchmark_reception import MESSAGE, AppSimulee, EtatSimule, WebServerBenchmark
+    from millegrilles_reception import Constantes as ConstantesReception
+    from millegrilles_reception.Configuration import ConfigurationReception
+
+
+def parcourir_spans(span: dict):
+    yield span
+    for enfant in span.get('enfants', []):
+        yield from parcourir_spans(enfant)
+
+
+@unittest.skipIf(LIBRAIRIES_MILLEGRILLES is False, 'millegrilles_web/millegrilles_messages non installes')
+class WebServerReceptionTest(unittest.IsolatedAsyncioTestCase):
+
+    async def demarrer(self, params: dict):
+        configuration = ConfigurationReception()
+        configuration.parse_config(configuration=params)
+        self.dir_staging = tempfile.TemporaryDirectory()
+        self.app = AppSimulee(EtatSimule(self.dir_staging.name, configuration, 0.0))
+        self.serveur = WebServerBenchmark(self.app)
+        port = await self.serveur.demarrer(asyncio.Event())
+        self.url = 'http://127.0.0.1:%d%s' % (port, ConstantesReception.WEB_APP_PATH)
+
+    async def asyncTearDown(self):
+        await self.serveur.arreter()
+        await self.app.fichiers_dechiffres_handler.fermer()
+        self.app.etat.service_crypto.fermer()
+        self.dir_staging.cleanup()
+
+    async def poster_multipart(self, fichiers: list[bytes]) -> int:
+        data = aiohttp.FormData()
+        data.add_field('message', json.dumps(MESSAGE), content_type='application/json')
+        for i, contenu in enumerate(fichiers):
+            data.add_field('files[]', contenu, filename='fichier_%d.bin' % i, content_type='application/octet-stream')
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self.url + '/message', data=data) as reponse:
+                return reponse.status
+
+    async def test_multipart_fichier(self):
+        await self.demarrer({})
+
+        code = await self.poster_multipart([b'a' * 300_000, b'b' * 10])
+
+        self.assertEqual(201, code)
+        self.assertEqual(2, self.app.uploads)  # Un upload par fichier transfere vers ready/
+
+    async def test_multipart_fichier_traces(self):
+        await self.demarrer({
+            ConstantesReception.ENV_TRACES: 'true', ConstantesReception.ENV_TRACES_ECHANTILLONNAGE: '1'})
+
+        code = await self.poster_multipart([b'a' * 1000])
+
+        self.assertEqual(201, code)
+        traces = self.app.etat.traceur.get_traces()['traces']
+        self.assertEqual(1, len(traces))
+        spans = list(parcourir_spans(traces[0]))
+        span_fichier = next(s for s in spans if s['nom'] == 'fichier.chiffrage')
+        self.assertEqual('fichier_0.bin', span_fichier['attributs']['fichier'])
+
+    async def test_json(self):
+        await self.demarrer({})
+
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self.url + '/message', json=MESSAGE) as reponse:
+                self.assertEqual(201, reponse.status)
+
+    async def test_metriques_sans_jeton(self):
+        await self.demarrer({})
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(self.url + '/metrics') as reponse:
+                self.assertEqual(404, reponse.status)
+
+    async def test_metriques_jeton(self):
+        await self.demarrer({ConstantesReception.ENV_ADMIN_JETON: 'jeton-test'})
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(self.url + '/metrics') as reponse:
+                self.assertEqual(401, reponse.status)
+            headers = {'Authorization': 'Bearer autre'}
+            async with session.get(self.url + '/metrics', headers=headers) as reponse:
+                self.assertEqual(401, reponse.status)
+            headers = {'Authorization': 'Bearer jeton-test'}
+            async with session.get(self.url + '/metrics', headers=headers) as reponse:
+                self.assertEqual(200, reponse.status)
+                self.assertIn('reception_posts_total', await reponse.text())
+
+
+if __name__ == '__main__':
+    unittest.main()